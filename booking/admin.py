@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Booking, BusTrip
+from .models import Booking, BookingTombstone, BusTrip, RevenueLedgerEntry
 
 
 @admin.register(Booking)
@@ -10,3 +10,15 @@ class BookingAdmin(admin.ModelAdmin):
 @admin.register(BusTrip)
 class BusTripAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'bus', 'route', 'start_time')
+
+
+@admin.register(RevenueLedgerEntry)
+class RevenueLedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'bus_trip', 'booking', 'entry_type',
+                    'revenue_delta', 'created_at', 'is_rolled_up')
+    list_filter = ('entry_type', 'is_rolled_up')
+
+
+@admin.register(BookingTombstone)
+class BookingTombstoneAdmin(admin.ModelAdmin):
+    list_display = ('id', 'booking_id', 'user_id', 'deleted_at')
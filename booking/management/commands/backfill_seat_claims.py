@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from booking.models import Booking, CANCELED_BOOKING_STATUSES
+
+
+class Command(BaseCommand):
+    help = ("Set seat_claim on active bookings made before the column existed, "
+            "so the unique (bus_trip, seat_claim) constraint covers them. Safe to re-run.")
+
+    def handle(self, *args, **options):
+        # updated_at is left alone: nothing changed for the passenger
+        backfilled = Booking.objects.filter(seat_claim=None).exclude(
+            booking_status__in=CANCELED_BOOKING_STATUSES).update(seat_claim=F('seat_id'))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfilled the seat claim of {backfilled} bookings."))
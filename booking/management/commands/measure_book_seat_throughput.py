@@ -0,0 +1,148 @@
+import random
+import threading
+import time
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count
+from django.utils.timezone import now
+from rest_framework.test import APIRequestFactory, force_authenticate
+from booking.models import Booking, BusTrip, CANCELED_BOOKING_STATUSES
+from booking.views import book_seat
+from busstops.models import BoardingPoint, BusRoute, Buses, Seat, Section
+from members.models import User
+
+# Outcome of each booking request, by response status
+OUTCOMES = {201: 'booked', 409: 'conflict'}
+
+
+class Command(BaseCommand):
+    help = ("Measure book_seat throughput with concurrent clients racing for the seats "
+            "of a scratch trip, and check that no seat was booked twice. "
+            "Writes (and then deletes) test data: use a development or staging database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=8,
+                            help="Number of concurrent clients.")
+        parser.add_argument('--requests', type=int, default=20,
+                            help="Booking requests sent by each client.")
+        parser.add_argument('--seats-per-booking', type=int, default=1)
+        parser.add_argument('--seat-count', type=int, default=64, choices=[32, 40, 52, 64],
+                            help="Seats of the scratch bus, fewer seats mean more conflicts.")
+        parser.add_argument('--keep', action='store_true',
+                            help="Keep the scratch trip and its bookings.")
+
+    def handle(self, *args, **options):
+        run = uuid.uuid4().hex[:6]
+        scratch = self.create_scratch_trip(run, options['seat_count'], options['clients'])
+        bus_trip, users = scratch['bus_trip'], scratch['users']
+        seat_ids = list(Seat.objects.filter(bus=bus_trip.bus).values_list('id', flat=True))
+
+        hosts = [host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*']
+        factory = APIRequestFactory(HTTP_HOST=hosts[0] if hosts else 'localhost')
+        results = []  # (outcome, seconds)
+        errors = []
+        barrier = threading.Barrier(len(users))
+
+        def client(user):
+            rng = random.Random(f"{run}-{user.id}")
+            barrier.wait()
+            try:
+                for _ in range(options['requests']):
+                    request = factory.post('/api/booking/book_seat/', {
+                        "trip_id": bus_trip.id,
+                        "seat_ids": rng.sample(seat_ids, options['seats_per_booking']),
+                        "start_point_id": scratch['start_point'].id,
+                        "end_point_id": scratch['end_point'].id,
+                        "fare_price": 1000,
+                    }, format='json')
+                    force_authenticate(request, user)
+
+                    started = time.perf_counter()
+                    try:
+                        response = book_seat(request)
+                        outcome = OUTCOMES.get(response.status_code, 'other')
+                        if outcome == 'conflict' and "being booked" in response.data['error']:
+                            # Lock retries ran out, not a seat that was taken
+                            outcome = 'contended'
+                    except Exception as error:
+                        outcome = 'other'
+                        errors.append(repr(error))
+                    results.append((outcome, time.perf_counter() - started))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=client, args=(user,)) for user in users]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        try:
+            self.report(results, elapsed, bus_trip, errors)
+        finally:
+            if not options['keep']:
+                self.delete_scratch_trip(scratch)
+
+    def create_scratch_trip(self, run, seat_count, clients):
+        start_point = BoardingPoint.objects.create(name=f"Load test {run} start")
+        end_point = BoardingPoint.objects.create(name=f"Load test {run} end")
+        route = BusRoute.objects.create(name=f"Load test {run}")
+        route.route_boarding_points.set([start_point, end_point])
+        for position, boarding_point in enumerate((start_point, end_point), 1):
+            section = Section.objects.create(
+                bus_route=route, name=f"Load test {run} {position}", position=position,
+                time=timedelta(minutes=30), distance=10)
+            section.section_boarding_points.set([boarding_point])
+
+        bus = Buses.objects.create(
+            bus_name=f"Load test {run}", bus_number=f"LT-{run}", seat_count=seat_count)
+        return {
+            "start_point": start_point,
+            "end_point": end_point,
+            "route": route,
+            "bus": bus,
+            "bus_trip": BusTrip.objects.create(
+                bus=bus, route=route, start_time=now() + timedelta(days=1)),
+            "users": [User.objects.create(phone_number=f"LT{run}{index:03d}")
+                      for index in range(clients)],
+        }
+
+    def delete_scratch_trip(self, scratch):
+        scratch['bus_trip'].delete()
+        scratch['bus'].delete()
+        scratch['route'].delete()
+        BoardingPoint.objects.filter(
+            id__in=[scratch['start_point'].id, scratch['end_point'].id]).delete()
+        User.objects.filter(id__in=[user.id for user in scratch['users']]).delete()
+
+    def report(self, results, elapsed, bus_trip, errors):
+        latencies = sorted(seconds for _, seconds in results)
+        counts = {outcome: 0 for outcome in ('booked', 'conflict', 'contended', 'other')}
+        for outcome, _ in results:
+            counts[outcome] += 1
+
+        self.stdout.write(
+            f"{len(results)} requests in {elapsed:.2f}s: "
+            f"{len(results) / elapsed:.1f} requests/s, {counts['booked'] / elapsed:.1f} bookings/s")
+        self.stdout.write(
+            f"booked: {counts['booked']}, seat taken: {counts['conflict']}, "
+            f"lock retries exhausted: {counts['contended']}, errors: {counts['other']}")
+        if errors:
+            self.stdout.write(self.style.WARNING(f"First error: {errors[0]}"))
+        if latencies:
+            self.stdout.write(
+                f"latency p50 {latencies[len(latencies) // 2] * 1000:.0f}ms, "
+                f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.0f}ms, "
+                f"max {latencies[-1] * 1000:.0f}ms")
+
+        double_booked = Booking.objects.filter(bus_trip=bus_trip).exclude(
+            booking_status__in=CANCELED_BOOKING_STATUSES
+        ).values('seat_id').annotate(count=Count('id')).filter(count__gt=1)
+        if double_booked.exists():
+            raise CommandError(f"{double_booked.count()} seats were booked more than once.")
+        self.stdout.write(self.style.SUCCESS("No seat was booked more than once."))
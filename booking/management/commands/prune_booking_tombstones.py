@@ -0,0 +1,20 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from booking.models import BookingTombstone
+from booking.sync import SYNC_TOMBSTONE_RETENTION
+
+
+class Command(BaseCommand):
+    help = "Delete booking tombstones older than the sync token retention."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int,
+                            default=SYNC_TOMBSTONE_RETENTION.days)
+
+    def handle(self, *args, **options):
+        deleted, _ = BookingTombstone.objects.filter(
+            deleted_at__lt=now() - timedelta(days=options['retention_days'])).delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted} booking tombstones."))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from booking.revenue import roll_up_revenue_ledger, ROLL_UP_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Fold pending revenue ledger entries into the bus trip revenue totals."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trip', type=int, action='append', dest='trip_ids',
+                            help="Only roll up this bus trip (can be repeated).")
+        parser.add_argument('--batch-size', type=int, default=ROLL_UP_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        rolled_up = roll_up_revenue_ledger(
+            bus_trip_ids=options['trip_ids'], batch_size=options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rolled up {rolled_up} revenue ledger entries."))
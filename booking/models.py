@@ -1,5 +1,6 @@
 from django.conf import settings
 from django.db import models
+from django.utils.timezone import is_naive, make_aware, now
 from busstops.models import Seat, BoardingPoint, BusRoute, Buses
 from members.models import User
 
@@ -17,6 +18,20 @@ BOOOKING_STATUS = [
     ('RESCHEDULED_3', 'Rescheduled_3'),
 ]
 
+# Bookings in these states no longer hold their seat
+CANCELED_BOOKING_STATUSES = ['BOOKING_CANCELED', 'BUS_TRIP_CANCELED']
+
+REVENUE_ENTRY_TYPES = [
+    ('BOOKING', 'Booking'),
+    ('BOOKING_CANCELED', 'Booking_canceled'),
+    ('RESCHEDULED_OUT', 'Rescheduled_out'),
+    ('RESCHEDULED_IN', 'Rescheduled_in'),
+    ('BUS_TRIP_CANCELED', 'Bus_trip_canceled'),
+]
+
+# Materialized from the revenue ledger by the roll-up, never written by BusTrip.save()
+ROLLED_UP_REVENUE_FIELDS = ('revenue', 'company_3_percent_cut')
+
 
 class BusTrip(models.Model):
     name = models.CharField(max_length=255, blank=True, editable=False)
@@ -25,9 +40,17 @@ class BusTrip(models.Model):
     route = models.ForeignKey(
         BusRoute, on_delete=models.CASCADE, related_name="trips")
     start_time = models.DateTimeField()
-    revenue = models.DecimalField(default=0.0, max_digits=10, decimal_places=2)
+    # Materialized from the route sections when the trip is saved
+    end_time = models.DateTimeField(
+        null=True, blank=True, db_index=True, editable=False)
+    timetable = models.JSONField(
+        default=dict, blank=True, editable=False,
+        help_text="Arrival offset in seconds from start_time, keyed by section position")
+    # Rolled-up totals of the revenue ledger (see booking.revenue)
+    revenue = models.DecimalField(
+        default=0.0, max_digits=10, decimal_places=2, editable=False)
     company_3_percent_cut = models.DecimalField(
-        default=0.0, max_digits=10, decimal_places=2)
+        default=0.0, max_digits=10, decimal_places=2, editable=False)
     is_revenue_released = models.BooleanField(default=False)
     is_bustrip_canceled = models.BooleanField(default=False)
     cancellation_fee_resolved = models.BooleanField(default=False)
@@ -37,14 +60,59 @@ class BusTrip(models.Model):
 
         self.name = f"{self.bus.bus_name} | on | {self.route.name}"
 
+        update_fields = kwargs.get('update_fields')
+        timetable_changed = update_fields is None or {
+            'start_time', 'route'} & set(update_fields)
+        if timetable_changed and not self._state.adding:
+            # Full saves (admin, status changes) mostly keep the schedule
+            self.start_time = self._aware_start_time()
+            stored = BusTrip.objects.filter(pk=self.pk).values(
+                'start_time', 'route_id', 'end_time').first()
+            timetable_changed = stored is None or stored['end_time'] is None or (
+                stored['start_time'], stored['route_id']) != (self.start_time, self.route_id)
+        if timetable_changed:
+            self.refresh_timetable()
+
+        if not self._state.adding and update_fields is None:
+            # Don't overwrite totals rolled up since this trip was loaded
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ROLLED_UP_REVENUE_FIELDS
+            ]
+
     # If the trip is canceled, update all related bookings
         if self.is_bustrip_canceled:
-            self.revenue = 0.0
+            from .revenue import void_trip_revenue
+
+            void_trip_revenue(self)
             Booking.objects.filter(bus_trip=self).update(
-                booking_status='BUS_TRIP_CANCELED')
+                booking_status='BUS_TRIP_CANCELED', seat_claim=None, updated_at=now())
+        elif timetable_changed and not self._state.adding:
+            # Arrival times shown with the bookings have moved
+            Booking.objects.filter(bus_trip=self).update(updated_at=now())
 
         super().save(*args, **kwargs)  # Call the parent save method
 
+    def refresh_timetable(self):
+        """
+        Rebuild the arrival timetable and end time from the route sections.
+        """
+        from busstops.utils import build_trip_timetable
+
+        self.start_time = self._aware_start_time()
+        sections = self.route.sections.order_by('position')
+        self.timetable, duration = build_trip_timetable(
+            self.start_time, sections)
+        self.end_time = self.start_time + duration
+
+    def _aware_start_time(self):
+        start_time = self.start_time
+        if isinstance(start_time, str):
+            start_time = self._meta.get_field('start_time').to_python(start_time)
+        if is_naive(start_time):
+            start_time = make_aware(start_time)
+        return start_time
+
     def __str__(self):
         return f"Bus {self.bus.bus_name} on {self.route.name} at {self.start_time}"
 
@@ -61,6 +129,8 @@ class Booking(models.Model):
     end_point = models.ForeignKey(
         BoardingPoint, on_delete=models.CASCADE, related_name='end_bookings')
     booked_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
+    # Bulk .update() calls must set it too, the app syncs on it
+    updated_at = models.DateTimeField(auto_now=True)
     fare_price = models.DecimalField(
         max_digits=10, decimal_places=2, default=0.0)
     company_4_precent_cut = models.DecimalField(
@@ -68,9 +138,78 @@ class Booking(models.Model):
     qr_code = models.ImageField(upload_to='qrcodes/', blank=True, null=True)
     booking_status = models.CharField(max_length=55,
                                       choices=BOOOKING_STATUS, default='BOOKED')
+    # The seat while the booking holds it, NULL once canceled: only active
+    # bookings are unique per trip and seat (MySQL has no partial unique
+    # indexes, but allows any number of NULLs). Kept in sync by save(),
+    # bulk_create() and bulk .update() calls must set it too.
+    seat_claim = models.PositiveBigIntegerField(
+        null=True, blank=True, editable=False)
 
     class Meta:
-        unique_together = ('bus_trip', 'seat')
+        unique_together = ('bus_trip', 'seat_claim')
+        indexes = [
+            models.Index(fields=['user', 'updated_at']),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.seat_claim = active_seat_claim(self.seat_id, self.booking_status)
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'seat', 'booking_status'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'seat_claim'}
+
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"Booking {self.id} - {self.user} - {self.fare_price}"
+
+
+def active_seat_claim(seat_id, booking_status):
+    """
+    Value of Booking.seat_claim: the seat, unless the booking was canceled.
+    """
+    return None if booking_status in CANCELED_BOOKING_STATUSES else seat_id
+
+
+class RevenueLedgerEntry(models.Model):
+    """
+    Append-only record of a change to a trip's revenue. Entries are written
+    without touching the BusTrip row and rolled up into its totals later.
+    """
+    bus_trip = models.ForeignKey(
+        BusTrip, on_delete=models.CASCADE, related_name='revenue_entries')
+    booking = models.ForeignKey(
+        Booking, on_delete=models.SET_NULL, null=True, blank=True, related_name='revenue_entries')
+    entry_type = models.CharField(max_length=55, choices=REVENUE_ENTRY_TYPES)
+    revenue_delta = models.DecimalField(
+        default=0.0, max_digits=10, decimal_places=2)
+    company_3_percent_cut_delta = models.DecimalField(
+        default=0.0, max_digits=10, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+    is_rolled_up = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_rolled_up', 'bus_trip']),
+        ]
+
+    def __str__(self):
+        return f"{self.entry_type} {self.revenue_delta} on trip {self.bus_trip_id}"
+
+
+class BookingTombstone(models.Model):
+    """
+    A deleted booking, so that incremental syncs can tell the app to drop it.
+    Plain IDs: the booking is gone and the user may be deleted in the same cascade.
+    """
+    booking_id = models.BigIntegerField()
+    user_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'deleted_at']),
+        ]
+
+    def __str__(self):
+        return f"Booking {self.booking_id} deleted at {self.deleted_at}"
@@ -0,0 +1,164 @@
+# booking/revenue.py
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from .models import BusTrip, RevenueLedgerEntry, CANCELED_BOOKING_STATUSES
+
+ZERO = Decimal('0.00')
+
+# Entries that credit a booking's fare to a trip
+CREDIT_ENTRY_TYPES = ['BOOKING', 'RESCHEDULED_IN']
+
+# Entries rolled up per transaction, keeps the trip rows locked only briefly
+ROLL_UP_BATCH_SIZE = 1000
+
+
+def record_booking_revenue(bookings, revenue_per_seat, company_3_percent_cut_per_seat):
+    """
+    Append one BOOKING entry per booked seat.
+    """
+    RevenueLedgerEntry.objects.bulk_create([
+        RevenueLedgerEntry(
+            bus_trip_id=booking.bus_trip_id,
+            booking=booking,
+            entry_type='BOOKING',
+            revenue_delta=revenue_per_seat,
+            company_3_percent_cut_delta=company_3_percent_cut_per_seat
+        )
+        for booking in bookings
+    ])
+
+
+def get_booking_revenue(booking, bus_trip_id):
+    """
+    Net revenue and company cut a booking has contributed to a trip.
+    Bookings made before the ledger existed were credited with their fare price.
+    """
+    entries = RevenueLedgerEntry.objects.filter(
+        booking=booking, bus_trip_id=bus_trip_id)
+    totals = entries.aggregate(
+        revenue=Sum('revenue_delta'),
+        company_3_percent_cut=Sum('company_3_percent_cut_delta')
+    )
+    revenue = totals['revenue'] or ZERO
+    company_3_percent_cut = totals['company_3_percent_cut'] or ZERO
+
+    if not entries.filter(entry_type__in=CREDIT_ENTRY_TYPES).exists():
+        revenue += Decimal(booking.fare_price)
+
+    return revenue, company_3_percent_cut
+
+
+def reverse_booking_revenue(booking, entry_type):
+    """
+    Append an entry taking the booking's contribution back out of its trip.
+    Canceled bookings have nothing left to take out.
+    """
+    if booking.booking_status in CANCELED_BOOKING_STATUSES:
+        return None
+
+    revenue, company_3_percent_cut = get_booking_revenue(
+        booking, booking.bus_trip_id)
+    if revenue == 0 and company_3_percent_cut == 0:
+        return None
+
+    return RevenueLedgerEntry.objects.create(
+        bus_trip_id=booking.bus_trip_id,
+        booking=booking,
+        entry_type=entry_type,
+        revenue_delta=-revenue,
+        company_3_percent_cut_delta=-company_3_percent_cut
+    )
+
+
+def void_trip_revenue(bus_trip):
+    """
+    Append an entry bringing a canceled trip's revenue back to zero.
+    Safe to call on every save: nothing is written once the total is zero.
+    """
+    totals = annotate_trip_revenue(
+        BusTrip.objects.filter(id=bus_trip.id)
+    ).values('total_revenue', 'total_company_3_percent_cut').first()
+
+    if not totals or (totals['total_revenue'] == 0 and totals['total_company_3_percent_cut'] == 0):
+        return None
+
+    return RevenueLedgerEntry.objects.create(
+        bus_trip_id=bus_trip.id,
+        entry_type='BUS_TRIP_CANCELED',
+        revenue_delta=-totals['total_revenue'],
+        company_3_percent_cut_delta=-totals['total_company_3_percent_cut']
+    )
+
+
+def _pending_sum(field):
+    pending = RevenueLedgerEntry.objects.filter(
+        bus_trip=OuterRef('pk'), is_rolled_up=False
+    ).order_by().values('bus_trip').annotate(total=Sum(field)).values('total')
+
+    return Coalesce(
+        Subquery(pending, output_field=DecimalField(max_digits=10, decimal_places=2)),
+        Value(ZERO),
+        output_field=DecimalField(max_digits=10, decimal_places=2)
+    )
+
+
+def annotate_trip_revenue(queryset):
+    """
+    Annotate trips with their up-to-date totals: the rolled-up values plus
+    the ledger entries that have not been rolled up yet.
+    """
+    return queryset.annotate(
+        total_revenue=F('revenue') + _pending_sum('revenue_delta'),
+        total_company_3_percent_cut=F(
+            'company_3_percent_cut') + _pending_sum('company_3_percent_cut_delta')
+    )
+
+
+def get_trip_revenue(bus_trip):
+    """
+    Up-to-date revenue of a single trip.
+    """
+    return annotate_trip_revenue(
+        BusTrip.objects.filter(id=bus_trip.id)
+    ).values_list('total_revenue', flat=True).first()
+
+
+def roll_up_revenue_ledger(bus_trip_ids=None, batch_size=ROLL_UP_BATCH_SIZE):
+    """
+    Fold pending ledger entries into BusTrip.revenue and company_3_percent_cut.
+    Each trip row is updated once per batch, however many entries it has.
+
+    Returns:
+        int: Number of entries rolled up.
+    """
+    rolled_up = 0
+
+    while True:
+        with transaction.atomic():
+            pending = RevenueLedgerEntry.objects.select_for_update().filter(
+                is_rolled_up=False)
+            if bus_trip_ids is not None:
+                pending = pending.filter(bus_trip_id__in=bus_trip_ids)
+
+            entry_ids = list(pending.order_by(
+                'id').values_list('id', flat=True)[:batch_size])
+            if not entry_ids:
+                return rolled_up
+
+            entries = RevenueLedgerEntry.objects.filter(id__in=entry_ids)
+            totals = entries.order_by().values('bus_trip_id').annotate(
+                revenue=Sum('revenue_delta'),
+                company_3_percent_cut=Sum('company_3_percent_cut_delta')
+            )
+
+            for total in totals:
+                BusTrip.objects.filter(id=total['bus_trip_id']).update(
+                    revenue=F('revenue') + total['revenue'],
+                    company_3_percent_cut=F(
+                        'company_3_percent_cut') + total['company_3_percent_cut']
+                )
+
+            entries.update(is_rolled_up=True)
+            rolled_up += len(entry_ids)
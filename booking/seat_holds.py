@@ -0,0 +1,67 @@
+# booking/seat_holds.py
+from django.conf import settings
+from django.core.cache import cache
+
+# How long a seat stays reserved for a user during checkout (in seconds)
+SEAT_HOLD_TTL = getattr(settings, 'SEAT_HOLD_TTL', 5 * 60)
+
+
+def seat_hold_key(trip_id, seat_id):
+    return f"seat_hold_{trip_id}_{seat_id}"
+
+
+def hold_seats(trip_id, seat_ids, user_id, ttl=SEAT_HOLD_TTL):
+    """
+    Hold all the given seats of a trip for a user, or none of them.
+    Each seat is claimed with an atomic cache add, so a seat is never held by
+    two users at once; if any seat is already held by someone else the seats
+    claimed by this call are released again.
+    Seats the user already holds have their expiry extended.
+
+    Returns:
+        list: IDs of the seats held by another user (empty on success).
+    """
+    claimed_keys = []
+    refreshed_keys = []
+    conflicts = []
+
+    for seat_id in seat_ids:
+        key = seat_hold_key(trip_id, seat_id)
+        if cache.add(key, user_id, timeout=ttl):
+            claimed_keys.append(key)
+        elif cache.get(key) == user_id:
+            refreshed_keys.append(key)
+        else:
+            conflicts.append(seat_id)
+
+    if conflicts:
+        cache.delete_many(claimed_keys)
+        return conflicts
+
+    for key in refreshed_keys:
+        cache.touch(key, timeout=ttl)
+
+    return []
+
+
+def release_seats(trip_id, seat_ids, user_id):
+    """
+    Release the holds the user has on the given seats of a trip.
+    """
+    keys = [seat_hold_key(trip_id, seat_id) for seat_id in seat_ids]
+    holders = cache.get_many(keys)
+    cache.delete_many([key for key, holder in holders.items() if holder == user_id])
+
+
+def get_seat_holds(trip_seat_pairs):
+    """
+    Current holders of the given (trip_id, seat_id) pairs, fetched in one round-trip.
+
+    Returns:
+        dict: {(trip_id, seat_id): user_id} for the held seats only.
+    """
+    keys = {seat_hold_key(trip_id, seat_id): (trip_id, seat_id)
+            for trip_id, seat_id in trip_seat_pairs}
+    holders = cache.get_many(keys.keys())
+
+    return {keys[key]: holder for key, holder in holders.items()}
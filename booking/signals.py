@@ -1,17 +1,14 @@
 # booking/signals.py
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
 from django.dispatch import receiver
-from .models import Booking
-# Import your QR code generation function
-from .utils import generate_secure_qr_data
+from .models import Booking, BookingTombstone
 
 
-@receiver(post_save, sender=Booking)
-def generate_qr_code_for_booking(sender, instance, created, **kwargs):
+@receiver(post_delete, sender=Booking)
+def record_booking_tombstone(sender, instance, **kwargs):
     """
-    Signal to generate the QR code for the newly created Booking instance.
+    Remember deleted bookings for incremental syncs (see user_booking_history).
     """
-    if created:  # Only run for newly created bookings
-        # Generate the QR code for the booking
-        # This can be your function to generate the QR code
-        generate_secure_qr_data(instance)
+    if instance.user_id:
+        BookingTombstone.objects.create(
+            booking_id=instance.id, user_id=instance.user_id)
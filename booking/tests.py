@@ -1,3 +1,780 @@
-from django.test import TestCase
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections, IntegrityError, OperationalError, transaction
+from django.test import TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.timezone import localtime, now
+from rest_framework.test import APIClient, APITestCase
+from busstops.models import BoardingPoint, BusRoute, Buses, Section, Seat
+from members.models import Notification, User
+from busstops.search_cache import get_route_versions
+from busstops.utils import get_seat_availability
+from live_location.eta import get_live_stop_eta
+from .models import Booking, BusTrip
+from .revenue import get_trip_revenue, reverse_booking_revenue
+from .sync import make_sync_token
+from .seat_holds import hold_seats
 
-# Create your tests here.
+
+class UserBookingHistoryTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000000")
+        cls.boarding_points = [
+            BoardingPoint.objects.create(name=f"Stop {i}") for i in range(4)]
+        cls.route = BusRoute.objects.create(name="Colombo - Kandy")
+        for position in range(1, 3):
+            section = Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(minutes=30), distance=10)
+            section.section_boarding_points.set(
+                cls.boarding_points[2 * position - 2:2 * position])
+        cls.bus = Buses.objects.create(
+            bus_name="Express", bus_number="NB-1234", seat_count=40)
+        cls.seats = list(Seat.objects.filter(bus=cls.bus))
+
+    def book_trips(self, trip_count, seats_per_trip):
+        for trip_number in range(trip_count):
+            bus_trip = BusTrip.objects.create(
+                bus=self.bus, route=self.route,
+                start_time=now() + timedelta(days=trip_number - 2))
+            for seat in self.seats[:seats_per_trip]:
+                Booking.objects.create(
+                    user=self.user, bus_trip=bus_trip, seat=seat,
+                    start_point=self.boarding_points[0], end_point=self.boarding_points[3])
+
+    def get_history(self, **params):
+        self.client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('user_booking_history'), params, HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(queries)
+
+    def test_query_count_does_not_grow_with_bookings(self):
+        self.book_trips(trip_count=2, seats_per_trip=2)
+        _, few_bookings_queries = self.get_history()
+
+        self.book_trips(trip_count=5, seats_per_trip=8)
+        data, many_bookings_queries = self.get_history()
+
+        self.assertEqual(few_bookings_queries, many_bookings_queries)
+        self.assertLessEqual(many_bookings_queries, 2)
+        self.assertEqual(sum(len(data[category]) for category in (
+            "verified_bookings", "ongoing_bookings", "completed_bookings", "failed_bookings")), 44)
+
+    def test_legacy_trip_timetables_are_filled_in_one_batch(self):
+        self.book_trips(trip_count=3, seats_per_trip=2)
+        BusTrip.objects.update(end_time=None, timetable={})
+
+        _, queries = self.get_history()
+
+        # bookings, sections of the routes, bulk update, stop positions
+        self.assertLessEqual(queries, 4)
+        self.assertFalse(BusTrip.objects.filter(end_time__isnull=True).exists())
+
+    def test_cursor_pagination(self):
+        self.book_trips(trip_count=1, seats_per_trip=5)
+
+        first_page, _ = self.get_history(limit=3)
+        self.assertIsNotNone(first_page["next_cursor"])
+
+        second_page, _ = self.get_history(limit=3, cursor=first_page["next_cursor"])
+        self.assertIsNone(second_page["next_cursor"])
+
+        def booking_ids(page):
+            return {booking["booking_id"] for category in (
+                "verified_bookings", "ongoing_bookings", "completed_bookings", "failed_bookings")
+                for booking in page[category]}
+
+        self.assertEqual(len(booking_ids(first_page)), 3)
+        self.assertEqual(len(booking_ids(second_page)), 2)
+        self.assertFalse(booking_ids(first_page) & booking_ids(second_page))
+
+    def test_since_token_only_returns_changed_bookings(self):
+        self.book_trips(trip_count=2, seats_per_trip=3)
+        first_sync, _ = self.get_history()
+        self.assertIsNone(first_sync["next_cursor"])
+
+        # Older than the sync token, even with the overlap window
+        Booking.objects.update(updated_at=now() - timedelta(minutes=5))
+        changed = Booking.objects.order_by('id').first()
+        changed.booking_status = "VERIFIED"
+        changed.save()
+
+        second_sync, _ = self.get_history(since=first_sync["sync_token"])
+        self.assertEqual(
+            [booking["booking_id"] for category in (
+                "verified_bookings", "ongoing_bookings", "completed_bookings", "failed_bookings")
+                for booking in second_sync[category]],
+            [changed.id])
+
+
+class OngoingBookingsTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000703")
+        cls.boarding_points = [
+            BoardingPoint.objects.create(name=f"Stop {i}") for i in range(4)]
+        cls.route = BusRoute.objects.create(name="Kurunegala - Anuradhapura")
+        for position in range(1, 3):
+            section = Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(minutes=45), distance=30)
+            section.section_boarding_points.set(
+                cls.boarding_points[2 * position - 2:2 * position])
+        cls.bus = Buses.objects.create(
+            bus_name="Rajarata", bus_number="NW-7", seat_count=40)
+        cls.seats = list(Seat.objects.filter(bus=cls.bus))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(self.user)
+
+    def book_trips(self, trip_count, seats_per_trip):
+        bookings = []
+        for trip_number in range(trip_count):
+            bus_trip = BusTrip.objects.create(
+                bus=self.bus, route=self.route,
+                start_time=now() + timedelta(days=trip_number + 1))
+            for seat in self.seats[:seats_per_trip]:
+                bookings.append(Booking.objects.create(
+                    user=self.user, bus_trip=bus_trip, seat=seat,
+                    start_point=self.boarding_points[2], end_point=self.boarding_points[3]))
+        return bookings
+
+    def get_ongoing_bookings(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home_ongoing_bookings'), HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 200)
+        return response.json()["ongoing_bookings"], len(queries)
+
+    def test_query_count_does_not_grow_with_bookings(self):
+        self.book_trips(trip_count=2, seats_per_trip=2)
+        _, few_bookings_queries = self.get_ongoing_bookings()
+
+        self.book_trips(trip_count=5, seats_per_trip=8)
+        ongoing_bookings, many_bookings_queries = self.get_ongoing_bookings()
+
+        self.assertEqual(few_bookings_queries, many_bookings_queries)
+        self.assertEqual(len(ongoing_bookings), 7)
+        self.assertEqual(
+            sorted(len(trip["booked_seats"]) for trip in ongoing_bookings), [2, 2] + [8] * 5)
+
+    def test_eta_is_computed_once_per_trip(self):
+        self.book_trips(trip_count=3, seats_per_trip=4)
+        with mock.patch('booking.views.get_live_stop_eta', wraps=get_live_stop_eta) as live_stop_eta:
+            ongoing_bookings, _ = self.get_ongoing_bookings()
+        self.assertEqual(live_stop_eta.call_count, 3)
+
+        # Second section of the route
+        trip = ongoing_bookings[0]
+        bus_trip = BusTrip.objects.get(id=trip["bus_trip_id"])
+        self.assertEqual(
+            trip["start_point_arrival_time"],
+            localtime(bus_trip.start_time + timedelta(minutes=45)).strftime("%Y-%m-%d %H:%M:%S"))
+        self.assertEqual(trip["start_point_eta"], trip["start_point_arrival_time"])
+
+    def test_legacy_trip_timetables_are_filled_in_one_batch(self):
+        self.book_trips(trip_count=3, seats_per_trip=2)
+        BusTrip.objects.update(end_time=None, timetable={})
+
+        ongoing_bookings, _ = self.get_ongoing_bookings()
+        self.assertEqual(len(ongoing_bookings), 3)
+        self.assertFalse(BusTrip.objects.filter(end_time__isnull=True).exists())
+
+    def test_ticket_details_query_count(self):
+        booking = self.book_trips(trip_count=1, seats_per_trip=1)[0]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('get_ticket_details', args=[booking.id]), HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["route_name"], "Kurunegala - Anuradhapura")
+        # booking with its trip, bus, route and points, then the stop position
+        self.assertLessEqual(len(queries), 2)
+
+
+class SeatClaimTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000001")
+        cls.start_point = BoardingPoint.objects.create(name="Start")
+        cls.end_point = BoardingPoint.objects.create(name="End")
+        cls.route = BusRoute.objects.create(name="Galle - Matara")
+        cls.bus = Buses.objects.create(
+            bus_name="Coastal", bus_number="SP-1", seat_count=32)
+        cls.seat = Seat.objects.filter(bus=cls.bus).first()
+        cls.bus_trip = BusTrip.objects.create(
+            bus=cls.bus, route=cls.route, start_time=now() + timedelta(days=1))
+
+    def book(self):
+        return Booking.objects.create(
+            user=self.user, bus_trip=self.bus_trip, seat=self.seat,
+            start_point=self.start_point, end_point=self.end_point)
+
+    def test_active_booking_blocks_the_seat(self):
+        self.book()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.book()
+
+    def test_canceled_booking_is_kept_and_frees_the_seat(self):
+        canceled = self.book()
+        canceled.booking_status = "BOOKING_CANCELED"
+        canceled.save(update_fields=['booking_status'])
+
+        availability = get_seat_availability([self.bus_trip])[self.bus_trip.id]
+        self.assertIn(self.seat.id, availability["available_seat_ids"])
+
+        rebooked = self.book()
+        availability = get_seat_availability([self.bus_trip])[self.bus_trip.id]
+        self.assertNotIn(self.seat.id, availability["available_seat_ids"])
+        self.assertEqual(
+            set(Booking.objects.filter(seat=self.seat).values_list('id', flat=True)),
+            {canceled.id, rebooked.id})
+
+    def test_trip_cancellation_frees_every_seat(self):
+        self.book()
+        self.bus_trip.is_bustrip_canceled = True
+        self.bus_trip.save()
+
+        self.bus_trip.is_bustrip_canceled = False
+        self.bus_trip.save()
+        self.book()
+        self.assertEqual(Booking.objects.filter(seat_claim=self.seat.id).count(), 1)
+
+
+class BookingQrCodeTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.passenger = User.objects.create(phone_number="0770000700")
+        cls.conductor = User.objects.create(phone_number="0770000701")
+        cls.stranger = User.objects.create(phone_number="0770000702")
+        cls.start_point = BoardingPoint.objects.create(name="Start")
+        cls.end_point = BoardingPoint.objects.create(name="End")
+        cls.route = BusRoute.objects.create(name="Kandy - Nuwara Eliya")
+        cls.bus = Buses.objects.create(
+            bus_name="Hill Express", bus_number="CP-9", seat_count=32, owner=cls.conductor)
+        cls.seat = Seat.objects.filter(bus=cls.bus).first()
+        cls.bus_trip = BusTrip.objects.create(
+            bus=cls.bus, route=cls.route, start_time=now() + timedelta(days=1))
+        cls.booking = Booking.objects.create(
+            user=cls.passenger, bus_trip=cls.bus_trip, seat=cls.seat,
+            start_point=cls.start_point, end_point=cls.end_point, fare_price=1000)
+
+    def get_qr_code(self, user, booking_id=None, if_none_match='', **params):
+        self.client.force_authenticate(user)
+        return self.client.get(
+            reverse('booking_qr_code', args=[booking_id or self.booking.id]), params,
+            HTTP_HOST='passenger.lk', HTTP_IF_NONE_MATCH=if_none_match)
+
+    def test_png_by_default(self):
+        response = self.get_qr_code(self.passenger)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response.content.startswith(b'\x89PNG'))
+        self.assertEqual(response['Cache-Control'], 'private, max-age=86400')
+
+    def test_svg_on_request(self):
+        response = self.get_qr_code(self.passenger, image_format='svg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'<svg', response.content)
+
+    def test_unknown_image_format_is_rejected(self):
+        response = self.get_qr_code(self.passenger, image_format='gif')
+        self.assertEqual(response.status_code, 400)
+
+    def test_strong_etag_answers_not_modified(self):
+        etag = self.get_qr_code(self.passenger)['ETag']
+        self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+        self.assertEqual(self.get_qr_code(self.passenger)['ETag'], etag)
+        # Each image format is its own representation
+        self.assertNotEqual(self.get_qr_code(self.passenger, image_format='svg')['ETag'], etag)
+
+        response = self.get_qr_code(self.passenger, if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_conductor_of_the_bus_sees_the_qr_code(self):
+        response = self.get_qr_code(self.conductor)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], self.get_qr_code(self.passenger)['ETag'])
+
+    def test_other_users_get_not_found(self):
+        self.assertEqual(self.get_qr_code(self.stranger).status_code, 404)
+        self.assertEqual(self.get_qr_code(self.passenger, booking_id=self.booking.id + 1000).status_code, 404)
+
+    def test_etag_changes_after_reschedule(self):
+        etag = self.get_qr_code(self.passenger)['ETag']
+        new_trip = BusTrip.objects.create(
+            bus=self.bus, route=self.route, start_time=now() + timedelta(days=2))
+
+        self.client.force_authenticate(self.passenger)
+        response = self.client.post(reverse('reschedule'), {
+            "old_booking": self.booking.id,
+            "trip_id": new_trip.id,
+            "seat_ids": [self.seat.id],
+            "start_point_id": self.start_point.id,
+            "end_point_id": self.end_point.id,
+            "fare_price": 1000,
+        }, format='json', HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.get_qr_code(self.passenger, if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class BusTripScheduleTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000002")
+        cls.start_point = BoardingPoint.objects.create(name="Start")
+        cls.end_point = BoardingPoint.objects.create(name="End")
+        cls.route = BusRoute.objects.create(name="Kandy - Jaffna")
+        Section.objects.create(
+            bus_route=cls.route, name="Section 1", position=1,
+            time=timedelta(hours=2), distance=80)
+        cls.bus = Buses.objects.create(
+            bus_name="Northern", bus_number="NP-1", seat_count=32)
+
+    def setUp(self):
+        self.bus_trip = BusTrip.objects.create(
+            bus=self.bus, route=self.route, start_time=now() + timedelta(days=1))
+        self.booking = Booking.objects.create(
+            user=self.user, bus_trip=self.bus_trip, seat=Seat.objects.filter(bus=self.bus).first(),
+            start_point=self.start_point, end_point=self.end_point)
+
+    def test_full_save_keeps_an_unchanged_schedule(self):
+        updated_at = self.booking.updated_at
+        bus_trip = BusTrip.objects.get(id=self.bus_trip.id)
+        bus_trip.is_revenue_released = True
+        bus_trip.save()
+
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.updated_at, updated_at)
+
+    def test_new_start_time_moves_the_schedule(self):
+        updated_at = self.booking.updated_at
+        bus_trip = BusTrip.objects.get(id=self.bus_trip.id)
+        bus_trip.start_time += timedelta(hours=1)
+        bus_trip.save()
+
+        bus_trip.refresh_from_db()
+        self.booking.refresh_from_db()
+        self.assertEqual(bus_trip.end_time, bus_trip.start_time + timedelta(hours=2))
+        self.assertGreater(self.booking.updated_at, updated_at)
+
+
+class BookSeatTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create(phone_number=f"07710000{i:02d}") for i in range(6)]
+        self.start_point = BoardingPoint.objects.create(name="Start")
+        self.end_point = BoardingPoint.objects.create(name="End")
+        self.route = BusRoute.objects.create(name="Colombo - Galle")
+        self.bus = Buses.objects.create(
+            bus_name="Southern", bus_number="SP-2", seat_count=32)
+        self.seat_ids = list(Seat.objects.filter(bus=self.bus).values_list('id', flat=True))
+        self.bus_trip = BusTrip.objects.create(
+            bus=self.bus, route=self.route, start_time=now() + timedelta(days=1))
+
+    def book(self, user, seat_ids):
+        client = APIClient(HTTP_HOST='passenger.lk')
+        client.force_authenticate(user)
+        return client.post(reverse('book_seat'), {
+            "trip_id": self.bus_trip.id, "seat_ids": seat_ids,
+            "start_point_id": self.start_point.id, "end_point_id": self.end_point.id,
+            "fare_price": 1000,
+        }, format='json')
+
+    # SQLite has no row locks, concurrent writers fail with "table is locked"
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_bookings_claim_each_seat_once(self):
+        barrier = threading.Barrier(len(self.users))
+        responses = []
+
+        def book(user):
+            barrier.wait()
+            try:
+                responses.append(self.book(user, self.seat_ids[:2]))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=book, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        booked = [response for response in responses if response.status_code == 201]
+        self.assertEqual(len(booked), 1)
+        for response in responses:
+            if response.status_code != 201:
+                self.assertEqual(response.status_code, 409)
+                self.assertTrue(response.json()["conflicts"])
+        self.assertEqual(Booking.objects.filter(bus_trip=self.bus_trip).count(), 2)
+
+    def test_throughput_measurement(self):
+        stdout = StringIO()
+        call_command('measure_book_seat_throughput', clients=1, requests=5,
+                     seat_count=32, stdout=stdout)
+        self.assertIn("5 requests in", stdout.getvalue())
+        self.assertIn("No seat was booked more than once.", stdout.getvalue())
+        # The scratch trip is removed afterwards
+        self.assertEqual(BusTrip.objects.count(), 1)
+        self.assertEqual(User.objects.count(), len(self.users))
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_throughput_measurement_with_concurrent_clients(self):
+        stdout = StringIO()
+        call_command('measure_book_seat_throughput', clients=8, requests=10,
+                     seat_count=32, stdout=stdout)
+        self.assertIn("errors: 0", stdout.getvalue())
+        self.assertIn("No seat was booked more than once.", stdout.getvalue())
+
+    def test_canceled_seat_is_booked_again_and_history_kept(self):
+        self.assertEqual(self.book(self.users[0], self.seat_ids[:1]).status_code, 201)
+        Booking.objects.filter(bus_trip=self.bus_trip).update(
+            booking_status="BOOKING_CANCELED", seat_claim=None)
+
+        response = self.book(self.users[1], self.seat_ids[:1])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Booking.objects.filter(bus_trip=self.bus_trip).count(), 2)
+
+    def test_legacy_booking_without_a_claim_blocks_its_seat(self):
+        self.assertEqual(self.book(self.users[0], self.seat_ids[:1]).status_code, 201)
+        # Booked before seat_claim existed
+        Booking.objects.filter(bus_trip=self.bus_trip).update(seat_claim=None)
+
+        response = self.book(self.users[1], self.seat_ids[:2])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            [conflict["seat_id"] for conflict in response.json()["conflicts"]], self.seat_ids[:1])
+
+    def test_backfill_seat_claims(self):
+        self.assertEqual(self.book(self.users[0], self.seat_ids[:2]).status_code, 201)
+        Booking.objects.filter(bus_trip=self.bus_trip).update(seat_claim=None)
+        Booking.objects.filter(seat_id=self.seat_ids[1]).update(booking_status="BOOKING_CANCELED")
+
+        stdout = StringIO()
+        call_command('backfill_seat_claims', stdout=stdout)
+        self.assertIn("Backfilled the seat claim of 1 bookings.", stdout.getvalue())
+        self.assertEqual(
+            dict(Booking.objects.values_list('seat_id', 'seat_claim')),
+            {self.seat_ids[0]: self.seat_ids[0], self.seat_ids[1]: None})
+
+        with self.assertRaises(IntegrityError):
+            Booking.objects.create(
+                user=self.users[1], bus_trip=self.bus_trip, seat_id=self.seat_ids[0],
+                start_point=self.start_point, end_point=self.end_point)
+
+    def test_deadlock_is_retried(self):
+        with mock.patch('booking.views.record_booking_revenue', side_effect=[
+                OperationalError(1213, "Deadlock found when trying to get lock"), None]):
+            response = self.book(self.users[0], self.seat_ids[:2])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Booking.objects.filter(bus_trip=self.bus_trip).count(), 2)
+
+    def test_sqlite_lock_errors_are_retried(self):
+        with mock.patch('booking.views.record_booking_revenue', side_effect=[
+                OperationalError("database is locked"), None]):
+            response = self.book(self.users[0], self.seat_ids[:1])
+        self.assertEqual(response.status_code, 201)
+
+    def test_lost_race_reports_the_seats(self):
+        with mock.patch('booking.views.record_booking_revenue',
+                        side_effect=OperationalError(1213, "Deadlock found when trying to get lock")):
+            response = self.book(self.users[0], self.seat_ids[:2])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            [conflict["seat_id"] for conflict in response.json()["conflicts"]], self.seat_ids[:2])
+
+
+class SeatHoldTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000003")
+        cls.other_user = User.objects.create(phone_number="0770000004")
+        cls.boarding_points = [
+            BoardingPoint.objects.create(name=f"Stop {i}") for i in range(2)]
+        cls.route = BusRoute.objects.create(name="Colombo - Negombo")
+        cls.route.route_boarding_points.set(cls.boarding_points)
+        for position, boarding_point in enumerate(cls.boarding_points, 1):
+            section = Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(minutes=30), distance=10)
+            section.section_boarding_points.set([boarding_point])
+        cls.bus = Buses.objects.create(
+            bus_name="Airport", bus_number="WP-1", seat_count=32)
+        cls.seat_ids = list(Seat.objects.filter(bus=cls.bus).values_list('id', flat=True))
+        cls.bus_trip = BusTrip.objects.create(
+            bus=cls.bus, route=cls.route, start_time=now() + timedelta(days=1))
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, user=None):
+        self.client.force_authenticate(user)
+        response = self.client.get(reverse('booking_search'), {
+            "start_point": self.boarding_points[0].id,
+            "end_point": self.boarding_points[1].id,
+        }, HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 200)
+        return response.json()[0]["available_seats"]
+
+    def hold(self, seat_ids, view='hold_seats'):
+        self.client.force_authenticate(self.user)
+        return self.client.post(reverse(view), {
+            "trip_id": self.bus_trip.id, "seat_ids": seat_ids,
+        }, format='json', HTTP_HOST='passenger.lk')
+
+    def test_holds_apply_to_cached_searches(self):
+        self.assertEqual(self.search(), 32)
+
+        self.assertEqual(self.hold(self.seat_ids[:2]).status_code, 200)
+        self.assertEqual(self.search(), 30)
+        self.assertEqual(self.search(self.other_user), 30)
+        # The holder still sees their seats as available
+        self.assertEqual(self.search(self.user), 32)
+
+    def test_released_seats_are_available_again(self):
+        self.hold(self.seat_ids[:2])
+        self.assertEqual(self.search(), 30)
+
+        self.assertEqual(self.hold(self.seat_ids[:2], view='release_seats').status_code, 200)
+        self.assertEqual(self.search(), 32)
+
+    def test_expired_holds_are_available_again(self):
+        self.assertEqual(self.search(), 32)
+        hold_seats(self.bus_trip.id, self.seat_ids[:3], self.user.id, ttl=1)
+        self.assertEqual(self.search(), 29)
+
+        time.sleep(1.1)
+        self.assertEqual(self.search(), 32)
+
+    def test_held_seats_are_taken_for_other_users_only(self):
+        self.hold(self.seat_ids[:1])
+        for user, availability in ((self.user, "Available"), (self.other_user, "Not-Available")):
+            self.client.force_authenticate(user)
+            response = self.client.get(reverse('booking_details'), {
+                "bus_trip_id": self.bus_trip.id}, HTTP_HOST='passenger.lk')
+            self.assertEqual(
+                response.json()["seat_availability"][str(self.seat_ids[0])], availability)
+
+    def test_seat_held_by_another_user_cannot_be_held(self):
+        hold_seats(self.bus_trip.id, self.seat_ids[:1], self.other_user.id)
+        response = self.hold(self.seat_ids[:2])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            [conflict["seat_id"] for conflict in response.json()["conflicts"]], self.seat_ids[:1])
+
+
+class RevenueLedgerTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000005")
+        cls.boarding_points = [
+            BoardingPoint.objects.create(name=f"Stop {i}") for i in range(2)]
+        cls.routes = []
+        for name in ("Colombo - Kurunegala", "Colombo - Chilaw"):
+            route = BusRoute.objects.create(name=name)
+            route.route_boarding_points.set(cls.boarding_points)
+            for position, boarding_point in enumerate(cls.boarding_points, 1):
+                section = Section.objects.create(
+                    bus_route=route, name=f"{name} {position}", position=position,
+                    time=timedelta(minutes=30), distance=10)
+                section.section_boarding_points.set([boarding_point])
+            cls.routes.append(route)
+        cls.bus = Buses.objects.create(
+            bus_name="Wayamba", bus_number="NW-1", seat_count=32)
+        cls.seats = list(Seat.objects.filter(bus=cls.bus))
+
+    def setUp(self):
+        cache.clear()
+        self.bus_trips = [
+            BusTrip.objects.create(bus=self.bus, route=route, start_time=now() + timedelta(days=1))
+            for route in self.routes]
+
+    def book(self, seat):
+        self.client.force_authenticate(self.user)
+        response = self.client.post(reverse('book_seat'), {
+            "trip_id": self.bus_trips[0].id, "seat_ids": [seat.id],
+            "start_point_id": self.boarding_points[0].id,
+            "end_point_id": self.boarding_points[1].id, "fare_price": 1000,
+        }, format='json', HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 201)
+        return Booking.objects.get(id=response.json()["bookings"][0]["booking_id"])
+
+    def test_reverse_takes_the_booking_revenue_out(self):
+        booking = self.book(self.seats[0])
+        self.assertEqual(get_trip_revenue(self.bus_trips[0]), Decimal('970.00'))
+
+        entry = reverse_booking_revenue(booking, 'BOOKING_CANCELED')
+        self.assertEqual(entry.revenue_delta, Decimal('-970.00'))
+        self.assertEqual(get_trip_revenue(self.bus_trips[0]), 0)
+
+        booking.booking_status = 'BOOKING_CANCELED'
+        self.assertIsNone(reverse_booking_revenue(booking, 'BOOKING_CANCELED'))
+
+    def test_reverse_credits_bookings_older_than_the_ledger(self):
+        booking = Booking.objects.create(
+            user=self.user, bus_trip=self.bus_trips[0], seat=self.seats[0],
+            start_point=self.boarding_points[0], end_point=self.boarding_points[1],
+            fare_price=500)
+
+        entry = reverse_booking_revenue(booking, 'RESCHEDULED_OUT')
+        self.assertEqual(entry.revenue_delta, Decimal('-500.00'))
+
+    def test_rollup_command_folds_pending_entries(self):
+        self.book(self.seats[0])
+        self.book(self.seats[1])
+
+        call_command('rollup_revenue_ledger', stdout=StringIO())
+
+        bus_trip = BusTrip.objects.get(id=self.bus_trips[0].id)
+        self.assertEqual(bus_trip.revenue, Decimal('1940.00'))
+        self.assertFalse(bus_trip.revenue_entries.filter(is_rolled_up=False).exists())
+        self.assertEqual(get_trip_revenue(bus_trip), Decimal('1940.00'))
+
+        # Nothing is rolled up twice
+        call_command('rollup_revenue_ledger', stdout=StringIO())
+        bus_trip.refresh_from_db()
+        self.assertEqual(bus_trip.revenue, Decimal('1940.00'))
+
+    def test_reschedule_moves_revenue_and_clears_old_searches(self):
+        booking = self.book(self.seats[0])
+        old_route_id = self.routes[0].id
+        old_route_version = get_route_versions([old_route_id])[old_route_id]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('reschedule'), {
+                "old_booking": booking.id, "trip_id": self.bus_trips[1].id,
+                "seat_ids": [self.seats[0].id],
+                "start_point_id": self.boarding_points[0].id,
+                "end_point_id": self.boarding_points[1].id, "fare_price": 800,
+            }, format='json', HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(get_trip_revenue(self.bus_trips[0]), 0)
+        self.assertEqual(get_trip_revenue(self.bus_trips[1]), Decimal('800.00'))
+        self.assertNotEqual(get_route_versions([old_route_id])[old_route_id], old_route_version)
+
+
+class BookingSyncTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000006")
+        cls.start_point = BoardingPoint.objects.create(name="Start")
+        cls.end_point = BoardingPoint.objects.create(name="End")
+        cls.route = BusRoute.objects.create(name="Badulla - Ella")
+        Section.objects.create(
+            bus_route=cls.route, name="Section 1", position=1,
+            time=timedelta(hours=1), distance=20)
+        cls.bus = Buses.objects.create(
+            bus_name="Hill Country", bus_number="UP-1", seat_count=32)
+        cls.seats = list(Seat.objects.filter(bus=cls.bus))
+
+    def setUp(self):
+        self.bus_trip = BusTrip.objects.create(
+            bus=self.bus, route=self.route, start_time=now() + timedelta(hours=2))
+        self.booking = Booking.objects.create(
+            user=self.user, bus_trip=self.bus_trip, seat=self.seats[0],
+            start_point=self.start_point, end_point=self.end_point)
+        # Last synced well after the booking was made
+        Booking.objects.filter(id=self.booking.id).update(updated_at=now() - timedelta(hours=1))
+        self.sync_token = make_sync_token(now())
+
+    def sync(self, since):
+        self.client.force_authenticate(self.user)
+        return self.client.get(reverse('user_booking_history'), {"since": since},
+                               HTTP_HOST='passenger.lk')
+
+    def synced_ids(self, data):
+        return [booking["booking_id"] for category in (
+            "verified_bookings", "ongoing_bookings", "completed_bookings", "failed_bookings")
+            for booking in data[category]]
+
+    def test_unchanged_bookings_are_not_sent(self):
+        data = self.sync(self.sync_token).json()
+        self.assertEqual(self.synced_ids(data), [])
+        self.assertEqual(data["deleted_booking_ids"], [])
+
+    def test_deleted_booking_is_sent_as_tombstone(self):
+        booking_id = self.booking.id
+        self.booking.delete()
+
+        data = self.sync(self.sync_token).json()
+        self.assertEqual(data["deleted_booking_ids"], [booking_id])
+
+    def test_booking_is_resent_when_its_trip_ends(self):
+        # Time passes: the trip ends after the last sync, nothing writes the booking
+        BusTrip.objects.filter(id=self.bus_trip.id).update(
+            start_time=now() - timedelta(hours=1), end_time=now())
+
+        data = self.sync(self.sync_token).json()
+        self.assertEqual(self.synced_ids(data), [self.booking.id])
+        self.assertEqual(data["failed_bookings"][0]["booking_id"], self.booking.id)
+
+    def test_expired_sync_token_is_refused(self):
+        response = self.sync(make_sync_token(now() - timedelta(days=365)))
+        self.assertEqual(response.status_code, 410)
+
+
+class NotificationTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000704")
+        cls.notifications = [
+            Notification.objects.create(
+                user=cls.user, message=f"Booking {i} confirmed",
+                notification_type='BOOKING_CONFIRMATION')
+            for i in range(3)]
+
+    def get_notifications(self, **params):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(
+            reverse('get_notifications'), params, HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_since_is_not_supported(self):
+        sync_token = make_sync_token(now() + timedelta(minutes=5))
+        Notification.objects.filter(id=self.notifications[0].id).update(is_read=True)
+
+        data = self.get_notifications(since=sync_token)
+        self.assertTrue(data["append_only"])
+        self.assertIsNone(data["sync_token"])
+        # Read state changes are not lost to a since filter
+        self.assertEqual(
+            [(notification["id"], notification["is_read"]) for notification in data["notifications"]],
+            [(self.notifications[2].id, False), (self.notifications[1].id, False),
+             (self.notifications[0].id, True)])
+
+    def test_cursor_pagination(self):
+        first_page = self.get_notifications(limit=2)
+        self.assertEqual(len(first_page["notifications"]), 2)
+
+        second_page = self.get_notifications(limit=2, cursor=first_page["next_cursor"])
+        self.assertEqual(
+            [notification["id"] for notification in second_page["notifications"]],
+            [self.notifications[0].id])
+        self.assertIsNone(second_page["next_cursor"])
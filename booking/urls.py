@@ -1,8 +1,10 @@
 from django.urls import path
-from .views import book_seat, user_booking_history, home_ongoing_bookings, get_notifications, mark_notifications_as_read, get_ticket_details, reschedule_booking, cancel_booking, update_customer_id
+from .views import book_seat, hold_seats_for_checkout, release_seat_holds, user_booking_history, home_ongoing_bookings, get_notifications, mark_notifications_as_read, get_ticket_details, get_booking_qr_code, reschedule_booking, cancel_booking, update_customer_id
 
 urlpatterns = [
     path('book-seat/', book_seat, name='book_seat'),
+    path('hold-seats/', hold_seats_for_checkout, name='hold_seats'),
+    path('release-seats/', release_seat_holds, name='release_seats'),
     path('reschedule/', reschedule_booking, name='reschedule'),
     path('cancel-booking/<int:booking_id>/',
          cancel_booking, name='cancel_booking'),
@@ -13,5 +15,6 @@ urlpatterns = [
     path('notifications/read/', mark_notifications_as_read,
          name='mark_notifications_as_read'),
     path('ticket/<int:booking_id>/', get_ticket_details, name='get_ticket_details'),
+    path('qr/<int:booking_id>/', get_booking_qr_code, name='booking_qr_code'),
     path('update-customer-id/', update_customer_id, name='update-customer-id'),
 ]
@@ -2,37 +2,110 @@
 import base64
 import hmac
 import hashlib
+from functools import lru_cache
 import qrcode
+import qrcode.image.svg
 from django.conf import settings
 from io import BytesIO
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.db.models import Sum
-from .models import Booking
+from django.core.cache import cache
 
+# Rendered QR images kept in memory per process (most recently used first)
+QR_IMAGE_LRU_SIZE = getattr(settings, 'QR_IMAGE_LRU_SIZE', 512)
+# How long rendered QR images stay in the shared cache (in seconds)
+QR_IMAGE_CACHE_TIMEOUT = getattr(settings, 'QR_IMAGE_CACHE_TIMEOUT', 24 * 60 * 60)
 
-def generate_secure_qr_data(booking):
+QR_IMAGE_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+
+def sign_qr_payload(booking_id, user_id, bus_trip_id):
     """
-    Generate secure QR code for the booking.
-    The QR code data includes booking id, user id, bus trip id, and a secure signature.
+    Build the signed QR code data: Booking ID | User ID | Trip ID | signature.
     """
-    qr_payload = f"{booking.id}|{booking.user.id}|{booking.bus_trip.id}"  # Booking ID | User ID | Trip ID
+    qr_payload = f"{booking_id}|{user_id}|{bus_trip_id}"  # Booking ID | User ID | Trip ID
     signature = hmac.new(settings.SECRET_KEY.encode(),
                          qr_payload.encode(), hashlib.sha256).digest()
     encoded_signature = base64.urlsafe_b64encode(signature).decode()
 
     # Combine data and signature
-    qr_code_data = f"{qr_payload}|{encoded_signature}"
+    return f"{qr_payload}|{encoded_signature}"
+
+
+def generate_secure_qr_data(booking):
+    """
+    Signed QR code data of a booking.
+    The QR code data includes booking id, user id, bus trip id, and a secure signature.
+    """
+    return sign_qr_payload(booking.id, booking.user_id, booking.bus_trip_id)
+
+
+def parse_qr_code_data(qr_code_data):
+    """
+    Split scanned QR code data into (booking_id, user_id, bus_trip_id, signature).
+    Returns None when the data is not in the expected format.
+    """
+    parts = str(qr_code_data).split("|")
+    if len(parts) != 4:
+        return None
+
+    booking_id, user_id, bus_trip_id, signature = parts
+    if not (booking_id.isdigit() and user_id.isdigit() and bus_trip_id.isdigit()):
+        return None
+
+    return int(booking_id), int(user_id), int(bus_trip_id), signature
+
 
-    # Generate the QR code from the data
-    qr = qrcode.make(qr_code_data)
+def is_valid_qr_code_data(booking, qr_code_data):
+    """
+    Check scanned QR code data against the signature expected for the booking.
+    """
+    return hmac.compare_digest(
+        generate_secure_qr_data(booking).encode(), str(qr_code_data).encode())
+
+
+def qr_code_data_digest(qr_code_data):
+    """
+    SHA-256 of the full QR code data. Shipped in trip manifests so conductor
+    devices can check scans offline without ever holding the signing key.
+    """
+    return hashlib.sha256(str(qr_code_data).encode()).hexdigest()
+
+
+def qr_image_digest(qr_code_data, image_format):
+    """
+    Content digest of a QR image, used for its cache key and strong ETag.
+    The image only depends on the signed data, so a reschedule (new trip ID)
+    automatically produces a new digest.
+    """
+    return hashlib.sha256(
+        f"{image_format}|{qr_code_data}".encode()).hexdigest()[:32]
+
+
+def _render_qr_image(qr_code_data, image_format):
+    if image_format == 'svg':
+        image = qrcode.make(
+            qr_code_data, image_factory=qrcode.image.svg.SvgPathImage)
+        return image.to_string()
+
+    image = qrcode.make(qr_code_data)
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=QR_IMAGE_LRU_SIZE)
+def render_qr_image(qr_code_data, image_format='png'):
+    """
+    QR image bytes for the signed data, rendered on demand.
+    Looked up in the in-process LRU first, then in the shared cache.
+    """
+    cache_key = f"qr_image_{qr_image_digest(qr_code_data, image_format)}"
 
-    # Save the QR code image to the booking object
-    qr_code_image = BytesIO()
-    qr.save(qr_code_image, format='PNG')
-    qr_code_image.seek(0)
+    image = cache.get(cache_key)
+    if image is None:
+        image = _render_qr_image(qr_code_data, image_format)
+        cache.set(cache_key, image, timeout=QR_IMAGE_CACHE_TIMEOUT)
 
-    # Store the QR code in the booking object
-    booking.qr_code = InMemoryUploadedFile(
-        qr_code_image, None, f"booking_{booking.id}_qr.png", 'image/png', qr_code_image.tell(), None
-    )
-    booking.save()  # Save the booking with the generated QR code
+    return image
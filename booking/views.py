@@ -1,33 +1,130 @@
 from members.models import NormalUserProfile
 from decimal import Decimal
-from django.db import transaction
+from django.db import transaction, IntegrityError, OperationalError
+from django.db.models import Q
 from django.utils.timezone import now
 from django.utils.timezone import localtime
 from django.conf import settings
+from django.http import HttpResponse
+from django.urls import reverse
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
-from booking.models import BusTrip, Booking
+from booking.models import BusTrip, Booking, BookingTombstone, RevenueLedgerEntry, CANCELED_BOOKING_STATUSES
 from busstops.models import Seat, BoardingPoint
-from .utils import generate_secure_qr_data
-from busstops.utils import calculate_bus_trip_end_time, calculate_rough_arrival_time
+from .utils import generate_secure_qr_data, render_qr_image, qr_image_digest, QR_IMAGE_FORMATS
+from .revenue import record_booking_revenue, reverse_booking_revenue
+from .sync import paginate_by_cursor, changed_since, is_sync_token_expired
+from .seat_holds import hold_seats, release_seats, get_seat_holds, SEAT_HOLD_TTL
+from busstops.utils import calculate_bus_trip_end_time, get_stop_arrival_time, get_seat_availability
+from busstops.utils import ensure_trip_timetables, get_stop_positions, get_arrival_time
+from busstops.search_cache import bump_route_version
+from conductor.rollups import queue_trip_rollup_refresh
+from live_location.eta import get_live_stop_eta
 from members.models import User
 from members.models import Notification
 
 
 SECRET_QR_KEY = settings.SECRET_KEY  # Use a secret key to sign QR codes
 
+CENTS = Decimal('0.01')
 
-def send_booking_notification(user, bus_trip):
+BOOKING_HISTORY_PAGE_SIZE = 50
+BOOKING_HISTORY_MAX_PAGE_SIZE = 100
+NOTIFICATIONS_PAGE_SIZE = 50
+NOTIFICATIONS_MAX_PAGE_SIZE = 100
+
+# Concurrent bookings of the same seats are retried this many times in total
+BOOK_SEAT_ATTEMPTS = getattr(settings, 'BOOK_SEAT_ATTEMPTS', 3)
+# MySQL errors of transactions aborted by lock contention (deadlock, lock wait timeout)
+LOCK_CONFLICT_ERROR_CODES = (1213, 1205)
+SQLITE_LOCK_CONFLICT_MESSAGES = ('database is locked', 'database table is locked')
+
+
+def send_booking_notification(user, bus_trip, seat_count=1):
     """
-    Sends a notification when the user books a trip.
+    Sends a notification for each seat the user books on a trip.
     """
-    Notification.objects.create(
-        user=user,
-        message=f"Your booking for {bus_trip.bus.bus_name} on {bus_trip.route.name} has been confirmed!",
-        notification_type="BOOKING_CONFIRMATION"
-    )
+    Notification.objects.bulk_create([
+        Notification(
+            user=user,
+            message=f"Your booking for {bus_trip.bus.bus_name} on {bus_trip.route.name} has been confirmed!",
+            notification_type="BOOKING_CONFIRMATION"
+        )
+        for _ in range(seat_count)
+    ])
+
+
+def booking_qr_code_url(request, booking_id):
+    """
+    Absolute URL of the on-demand QR code image of a booking.
+    """
+    return request.build_absolute_uri(reverse('booking_qr_code', args=[booking_id]))
+
+
+def start_point_eta_fields(bus_trip, start_point_id, start_point_arrival_time):
+    """
+    Live ETA of the bus at the passenger's start point, falling back to the
+    timetable when the bus isn't tracked. start_point_eta is None once the bus has passed.
+    """
+    live_eta = get_live_stop_eta(
+        bus_trip, start_point_id, start_point_arrival_time)
+
+    return {
+        "start_point_eta": localtime(live_eta["eta"]).strftime("%Y-%m-%d %H:%M:%S") if live_eta["eta"] else None,
+        "start_point_passed": live_eta["eta"] is None,
+        "eta_source": live_eta["source"],
+        "delay_minutes": live_eta["delay_minutes"],
+    }
+
+
+def is_lock_conflict(error):
+    """
+    Whether a database error only means the transaction lost a lock race
+    and can be retried.
+    """
+    if not error.args:
+        return False
+    # SQLite (development) reports lock contention by message only
+    return error.args[0] in LOCK_CONFLICT_ERROR_CODES or str(error.args[0]).startswith(
+        SQLITE_LOCK_CONFLICT_MESSAGES)
+
+
+def parse_seat_ids(seat_ids):
+    """
+    Normalize the seat IDs of a request to a list of unique integers.
+    Returns None if any of them is not a valid ID.
+    """
+    try:
+        return list(dict.fromkeys(int(seat_id) for seat_id in seat_ids))
+    except (TypeError, ValueError):
+        return None
+
+
+def seat_conflicts_response(seat_ids, reason="already booked for this trip"):
+    """
+    Per-seat conflict report for seats that cannot be taken on the trip.
+    """
+    return Response({
+        "error": f"Some of the selected seats are {reason}.",
+        "conflicts": [
+            {"seat_id": seat_id, "error": f"Seat {seat_id} is {reason}."}
+            for seat_id in seat_ids
+        ]
+    }, status=status.HTTP_409_CONFLICT)
+
+
+def active_seat_bookings(bus_trip, seat_ids):
+    """
+    Active bookings of the seats on the trip. Bookings made before seat_claim
+    existed have none until backfill_seat_claims has run, they are matched on
+    their seat instead.
+    """
+    return Booking.objects.filter(
+        Q(seat_claim__in=seat_ids) | Q(seat_claim=None, seat_id__in=seat_ids),
+        bus_trip=bus_trip
+    ).exclude(booking_status__in=CANCELED_BOOKING_STATUSES)
 
 
 @api_view(['POST'])
@@ -36,6 +133,8 @@ def book_seat(request):
     """
     API to book seats for a bus trip.
     Requires: trip_id, seat_ids (list), start_point_id, end_point_id, fare_price.
+    All seats are claimed together: either every seat is booked or none is,
+    and seats that are already taken are reported individually.
     """
     user = request.user
     trip_id = request.data.get('trip_id')
@@ -48,76 +147,199 @@ def book_seat(request):
         return Response({"error": "Missing required fields."}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        bus_trip = BusTrip.objects.get(id=trip_id)
+        bus_trip = BusTrip.objects.select_related(
+            'bus', 'route').get(id=trip_id)
         bus = bus_trip.bus  # Get the bus
         start_point = BoardingPoint.objects.get(id=start_point_id)
         end_point = BoardingPoint.objects.get(id=end_point_id)
     except (BusTrip.DoesNotExist, BoardingPoint.DoesNotExist):
         return Response({"error": "Invalid trip ID or boarding points."}, status=status.HTTP_400_BAD_REQUEST)
 
-    bookings = []
+    seat_ids = parse_seat_ids(seat_ids)
+    if seat_ids is None:
+        return Response({"error": "Invalid seat IDs."}, status=status.HTTP_400_BAD_REQUEST)
+
+    seats = {seat.id: seat for seat in Seat.objects.filter(
+        id__in=seat_ids, bus=bus)}
+    for seat_id in seat_ids:
+        if seat_id not in seats:
+            return Response({"error": f"Seat ID {seat_id} does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # 🔍 Seats another passenger is checking out with cannot be booked
+    held_by_others = [
+        seat_id for (_, seat_id), holder_id in get_seat_holds(
+            (bus_trip.id, seat_id) for seat_id in seat_ids).items()
+        if holder_id != user.id
+    ]
+    if held_by_others:
+        return seat_conflicts_response(held_by_others, "held by another passenger")
+
+    seat_count = len(seat_ids)
+    fare_per_seat = (Decimal(str(fare_price)) / seat_count).quantize(CENTS)
+    company_4_percent_cut = (fare_per_seat * Decimal('0.04')).quantize(CENTS)
+    company_3_percent_cut = (fare_per_seat * Decimal('0.03')).quantize(CENTS)
+
+    for attempt in range(BOOK_SEAT_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                # 🔒 Claim all requested seats at once (canceled bookings hold no claim)
+                taken_seat_ids = list(active_seat_bookings(
+                    bus_trip, seat_ids).select_for_update().values_list('seat_id', flat=True))
+                if taken_seat_ids:
+                    return seat_conflicts_response(taken_seat_ids)
+
+                # ✅ Save bookings with fare price from frontend
+                Booking.objects.bulk_create([
+                    Booking(
+                        user=user,
+                        bus_trip=bus_trip,
+                        seat=seats[seat_id],
+                        seat_claim=seat_id,
+                        fare_price=fare_per_seat + company_4_percent_cut,
+                        company_4_precent_cut=company_4_percent_cut,
+                        start_point=start_point,
+                        end_point=end_point
+                    )
+                    for seat_id in seat_ids
+                ])
+
+                # bulk_create does not return primary keys on every database, read the bookings back
+                created_bookings = {
+                    booking.seat_id: booking
+                    for booking in Booking.objects.filter(bus_trip=bus_trip, seat_claim__in=seat_ids)
+                }
 
-    with transaction.atomic():
-        for seat_id in seat_ids:
-            try:
-                seat = Seat.objects.get(id=seat_id)
-
-                # 🔍 Check if seat is already booked for this trip
-                if Booking.objects.filter(bus_trip=bus_trip, seat=seat).exists():
-                    return Response({"error": f"Seat {seat_id} is already booked for this trip."}, status=status.HTTP_400_BAD_REQUEST)
-
-                # ✅ Save booking with fare price from frontend
-                booking = Booking.objects.create(
-                    user=user,
-                    bus_trip=bus_trip,
-                    seat=seat,
-                    # Now using the frontend-provided fare
-                    fare_price=fare_price / len(seat_ids) +
-                    (fare_price / len(seat_ids)) * 0.04,
-                    company_4_precent_cut=(fare_price / len(seat_ids)) * 0.04,
-                    start_point=start_point,
-                    end_point=end_point
+                # 📒 Append the revenue to the ledger, the trip row is not touched
+                record_booking_revenue(
+                    created_bookings.values(),
+                    fare_per_seat - company_3_percent_cut,
+                    company_3_percent_cut
                 )
 
-                send_booking_notification(user, bus_trip)
-
-                bus_trip.revenue += Decimal((fare_price / len(seat_ids)) -
-                                            (fare_price / len(seat_ids)) * 0.03)
-                bus_trip.company_3_percent_cut += Decimal(
-                    (fare_price / len(seat_ids)) * 0.03)
-                bus_trip.save()
-
-                generate_secure_qr_data(booking)
+                send_booking_notification(user, bus_trip, seat_count)
+
+                transaction.on_commit(
+                    lambda: release_seats(bus_trip.id, seat_ids, user.id))
+                transaction.on_commit(
+                    lambda: bump_route_version(bus_trip.route_id))
+                # bulk_create sends no signals, refresh the daily roll-up here
+                queue_trip_rollup_refresh(bus_trip)
+            break
+
+        except (IntegrityError, OperationalError) as error:
+            if isinstance(error, OperationalError) and not is_lock_conflict(error):
+                raise
+            # Another request claimed one of the seats at the same time
+            taken_seat_ids = list(active_seat_bookings(
+                bus_trip, seat_ids).values_list('seat_id', flat=True))
+            if taken_seat_ids:
+                return seat_conflicts_response(taken_seat_ids)
+            # The competing booking was rolled back, try again
+    else:
+        return seat_conflicts_response(seat_ids, "being booked by another passenger")
 
-                bookings.append({
-                    "booking_id": booking.id,
-                    "seat_id": seat.id,
-                    "seat_number": seat.seat_number,
-                    "booked_at": localtime(booking.booked_at).strftime("%Y-%m-%d %H:%M:%S"),
-                    "fare_price": fare_price/len(seat_ids),
-                    "bus_type": bus.bus_type,  # Return bus type
-                    "qr_code_url": request.build_absolute_uri(booking.qr_code.url),
-                    "message": "Booking confirmed!"
-                })
+    bookings = []
+    for seat_id in seat_ids:
+        booking = created_bookings[seat_id]
+        seat = seats[seat_id]
 
-            except Seat.DoesNotExist:
-                return Response({"error": f"Seat ID {seat_id} does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+        bookings.append({
+            "booking_id": booking.id,
+            "seat_id": seat.id,
+            "seat_number": seat.seat_number,
+            "booked_at": localtime(booking.booked_at).strftime("%Y-%m-%d %H:%M:%S"),
+            "fare_price": fare_price/seat_count,
+            "bus_type": bus.bus_type,  # Return bus type
+            "qr_code_data": generate_secure_qr_data(booking),
+            "qr_code_url": booking_qr_code_url(request, booking.id),
+            "message": "Booking confirmed!"
+        })
 
     return Response({
         "message": "Booking successful!",
         "bus_type": bus.bus_type,
-        "total_fare": fare_price * len(seat_ids),
+        "total_fare": fare_price * seat_count,
         "bookings": bookings
     }, status=status.HTTP_201_CREATED)
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def hold_seats_for_checkout(request):
+    """
+    API to reserve seats on a bus trip for a short time while the user checks out.
+    Requires: trip_id, seat_ids (list).
+    Held seats are unavailable to other users until they are booked,
+    released or the hold expires.
+    """
+    user = request.user
+    trip_id = request.data.get('trip_id')
+    seat_ids = parse_seat_ids(request.data.get('seat_ids', []))
+
+    if not trip_id or not seat_ids:
+        return Response({"error": "trip_id and seat_ids are required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        bus_trip = BusTrip.objects.get(id=trip_id)
+    except BusTrip.DoesNotExist:
+        return Response({"error": "Invalid trip ID."}, status=status.HTTP_400_BAD_REQUEST)
+
+    availability = get_seat_availability(
+        [bus_trip], holder_id=user.id)[bus_trip.id]
+
+    bus_seat_ids = {seat_id for seat_id, _ in availability["seats"]}
+    for seat_id in seat_ids:
+        if seat_id not in bus_seat_ids:
+            return Response({"error": f"Seat ID {seat_id} does not exist."}, status=status.HTTP_400_BAD_REQUEST)
+
+    booked_seat_ids = [
+        seat_id for seat_id in seat_ids if seat_id in availability["booked_seat_ids"]]
+    if booked_seat_ids:
+        return seat_conflicts_response(booked_seat_ids)
+
+    held_by_others = hold_seats(bus_trip.id, seat_ids, user.id)
+    if held_by_others:
+        return seat_conflicts_response(held_by_others, "held by another passenger")
+
+    return Response({
+        "message": "Seats held successfully!",
+        "trip_id": bus_trip.id,
+        "held_seat_ids": seat_ids,
+        "hold_expires_in": SEAT_HOLD_TTL
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def release_seat_holds(request):
+    """
+    API to release seats the user reserved with hold_seats_for_checkout.
+    Requires: trip_id, seat_ids (list).
+    """
+    user = request.user
+    trip_id = request.data.get('trip_id')
+    seat_ids = parse_seat_ids(request.data.get('seat_ids', []))
+
+    if not trip_id or not seat_ids:
+        return Response({"error": "trip_id and seat_ids are required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        bus_trip = BusTrip.objects.get(id=trip_id)
+    except BusTrip.DoesNotExist:
+        return Response({"error": "Invalid trip ID."}, status=status.HTTP_400_BAD_REQUEST)
+
+    release_seats(bus_trip.id, seat_ids, user.id)
+
+    return Response({"message": "Seat holds released."}, status=status.HTTP_200_OK)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def reschedule_booking(request):
     """
     API to reschedule an existing booking.
     - Updates the old booking with new trip details.
-    - Deducts revenue from old trip and adds it to the new trip.
+    - Records the revenue moving from the old trip to the new trip in the ledger.
     - Updates `booked_at` to the new reschedule time.
     - Regenerates the QR code.
     - Sets booking_status to 'RESCHEDULED_1'.
@@ -152,14 +374,19 @@ def reschedule_booking(request):
     except (BusTrip.DoesNotExist, BoardingPoint.DoesNotExist, Seat.DoesNotExist):
         return Response({"error": "Invalid trip ID, seat, or boarding points."}, status=status.HTTP_400_BAD_REQUEST)
 
+    fare_price = Decimal(str(fare_price))
+
     with transaction.atomic():
-        # ✅ Deduct the fare from the old bus trip's revenue
-        old_bus_trip.revenue -= booking.fare_price
-        old_bus_trip.save()
+        # ✅ Take the booking's revenue out of the old bus trip
+        reverse_booking_revenue(booking, 'RESCHEDULED_OUT')
 
         # ✅ Add the fare to the new bus trip's revenue
-        new_bus_trip.revenue += fare_price
-        new_bus_trip.save()
+        RevenueLedgerEntry.objects.create(
+            bus_trip=new_bus_trip,
+            booking=booking,
+            entry_type='RESCHEDULED_IN',
+            revenue_delta=fare_price
+        )
 
         # ✅ Update the existing booking with new details
         booking.bus_trip = new_bus_trip
@@ -171,8 +398,10 @@ def reschedule_booking(request):
         booking.booked_at = now()  # Update the booked_at time
         booking.save()
 
-        # ✅ Regenerate QR code with updated details
-        generate_secure_qr_data(booking)
+        # The booking signal only sees the new trip, the old one has a seat free again
+        transaction.on_commit(lambda: bump_route_version(old_bus_trip.route_id))
+
+        # ✅ The QR code is rendered on demand from the updated details
 
         return Response({
             "message": "Booking successfully rescheduled!",
@@ -186,7 +415,8 @@ def reschedule_booking(request):
             "fare_price": booking.fare_price,
             "booking_status": booking.booking_status,
             "booked_at": localtime(booking.booked_at).strftime("%Y-%m-%d %H:%M:%S"),
-            "qr_code_url": request.build_absolute_uri(booking.qr_code.url)
+            "qr_code_data": generate_secure_qr_data(booking),
+            "qr_code_url": booking_qr_code_url(request, booking.id)
         }, status=status.HTTP_200_OK)
 
 
@@ -197,12 +427,10 @@ def cancel_booking(request, booking_id):
     try:
         # Fetch the booking by ID
         booking = Booking.objects.get(id=booking_id)
-        bus_trip = booking.bus_trip  # Get the associated bus trip
 
         with transaction.atomic():
-            # Deduct the fare from the bus trip's revenue
-            bus_trip.revenue -= booking.fare_price
-            bus_trip.save()
+            # Take the booking's revenue back out of the bus trip
+            reverse_booking_revenue(booking, 'BOOKING_CANCELED')
 
             # Update booking status to 'BOOKING_CANCELED'
             booking.booking_status = "BOOKING_CANCELED"
@@ -220,11 +448,20 @@ def cancel_booking(request, booking_id):
 @permission_classes([IsAuthenticated])
 def user_booking_history(request):
     """
-    Fetch the booking history for the logged-in user.
+    Fetch the booking history for the logged-in user, newest first.
     Categorized into:
       - Verified Bookings
       - Ongoing Bookings
       - Completed Bookings (Bus trip ended)
+    Paginated with a cursor: pass the returned next_cursor as ?cursor= to get
+    the following page (?limit= sets the page size).
+    Incremental sync: the last page carries a sync_token; pass it as ?since=
+    on the next app open to only get bookings created or updated after it,
+    or whose trip ended since (they move to completed / failed). The first
+    page lists the IDs of bookings deleted since in deleted_booking_ids.
+    Tokens older than SYNC_TOMBSTONE_RETENTION are refused with 410, the app
+    then syncs again without since.
+    Runs a fixed number of queries however many bookings the user has.
     """
     user = request.user
     verified_bookings = []
@@ -233,16 +470,49 @@ def user_booking_history(request):
     failed_bookings = []
 
     bookings = Booking.objects.filter(
-        user=user).select_related('bus_trip', 'seat')
+        user=user, bus_trip__isnull=False
+    ).select_related(
+        'bus_trip', 'seat', 'start_point', 'end_point'
+    )
+
+    since = request.GET.get('since')
+    try:
+        if since and is_sync_token_expired(since):
+            return Response({"error": "Sync token expired, sync again without since."}, status=status.HTTP_410_GONE)
+        # Bookings change category when their trip ends, without being written
+        bookings, pagination = paginate_by_cursor(
+            bookings, request, BOOKING_HISTORY_PAGE_SIZE, BOOKING_HISTORY_MAX_PAGE_SIZE,
+            ('updated_at', 'bus_trip__end_time'))
+    except ValueError:
+        return Response({"error": "Invalid cursor, since token or limit."}, status=status.HTTP_400_BAD_REQUEST)
+
+    deleted_booking_ids = []
+    if since and not request.GET.get('cursor'):
+        deleted_booking_ids = list(BookingTombstone.objects.filter(
+            user_id=user.id, deleted_at__gte=changed_since(since)
+        ).values_list('booking_id', flat=True))
+
+    # 🚍 Share one trip instance (and its timetable) across its bookings
+    bus_trips = {}
+    for booking in bookings:
+        booking.bus_trip = bus_trips.setdefault(
+            booking.bus_trip_id, booking.bus_trip)
+    ensure_trip_timetables(bus_trips.values())
+
+    stop_positions = get_stop_positions(
+        {bus_trip.route_id for bus_trip in bus_trips.values()},
+        {point_id for booking in bookings
+         for point_id in (booking.start_point_id, booking.end_point_id)}
+    )
 
+    current_time = now()
     for booking in bookings:
         bus_trip = booking.bus_trip
-        bus_trip_end_time = calculate_bus_trip_end_time(bus_trip)
-        route_sections = bus_trip.route.sections.order_by('position')
-        start_point_arrival_time = calculate_rough_arrival_time(
-            bus_trip.start_time, route_sections, booking.start_point.name)
-        end_point_arrival_time = calculate_rough_arrival_time(
-            bus_trip.start_time, route_sections, booking.end_point.name)
+        bus_trip_end_time = bus_trip.end_time
+        start_point_arrival_time = get_arrival_time(
+            bus_trip, stop_positions.get((bus_trip.route_id, booking.start_point_id)))
+        end_point_arrival_time = get_arrival_time(
+            bus_trip, stop_positions.get((bus_trip.route_id, booking.end_point_id)))
 
         booking_data = {
             "booking_id": booking.id,
@@ -257,27 +527,29 @@ def user_booking_history(request):
             "end_point_id": booking.end_point.id,
             "fare_price": booking.fare_price,
             "booked_at": localtime(booking.booked_at).strftime("%Y-%m-%d %H:%M:%S"),
-            "qr_code_url": request.build_absolute_uri(booking.qr_code.url) if booking.qr_code else None,
+            "qr_code_url": booking_qr_code_url(request, booking.id),
             "bus_trip_start_time": localtime(bus_trip.start_time).strftime("%Y-%m-%d %H:%M:%S"),
             "bus_trip_end_time": localtime(bus_trip_end_time).strftime("%Y-%m-%d %H:%M:%S"),
             "booking_status": booking.booking_status,
             "is_bus_trip_canceled": bus_trip.is_bustrip_canceled
         }
 
-        if booking.booking_status == "VERIFIED" and now() >= bus_trip_end_time:
+        if booking.booking_status == "VERIFIED" and current_time >= bus_trip_end_time:
             completed_bookings.append(booking_data)
-        elif not booking.booking_status == "VERIFIED" and now() >= bus_trip_end_time:
+        elif not booking.booking_status == "VERIFIED" and current_time >= bus_trip_end_time:
             failed_bookings.append(booking_data)
         elif booking.booking_status == "VERIFIED":
             verified_bookings.append(booking_data)
-        elif now() < bus_trip_end_time:
+        elif current_time < bus_trip_end_time:
             ongoing_bookings.append(booking_data)
 
     return Response({
         "verified_bookings": verified_bookings,
         "ongoing_bookings": ongoing_bookings,
         "completed_bookings": completed_bookings,
-        "failed_bookings": failed_bookings
+        "failed_bookings": failed_bookings,
+        "deleted_booking_ids": deleted_booking_ids,
+        **pagination
     }, status=200)
 
 
@@ -287,47 +559,68 @@ def home_ongoing_bookings(request):
     """
     Fetch only the ongoing bookings for the logged-in user.
     If a user has multiple seats booked for the same trip, group them into one entry.
+    Runs a fixed number of queries, and the ETA of each trip is computed once.
     """
     user = request.user
     grouped_bookings = {}
 
+    # Trips with a materialized end time are filtered in SQL; older trips
+    # without one are checked below once their timetable is filled in
     bookings = Booking.objects.filter(
-        user=user, booking_status__in=["BOOKED", "RESCHEDULED_1"]
-    ).select_related('bus_trip', 'seat')
+        user=user, bus_trip__isnull=False, booking_status__in=["BOOKED", "RESCHEDULED_1"]
+    ).filter(
+        Q(bus_trip__end_time__gt=now()) | Q(bus_trip__end_time__isnull=True)
+    ).select_related(
+        'bus_trip__bus', 'bus_trip__route', 'seat', 'start_point', 'end_point'
+    )
 
+    # 🚍 Share one trip instance (and its timetable) across its bookings
+    bus_trips = {}
+    for booking in bookings:
+        booking.bus_trip = bus_trips.setdefault(
+            booking.bus_trip_id, booking.bus_trip)
+    ensure_trip_timetables(bus_trips.values())
+
+    stop_positions = get_stop_positions(
+        {bus_trip.route_id for bus_trip in bus_trips.values()},
+        {booking.start_point_id for booking in bookings}
+    )
+
+    current_time = now()
     for booking in bookings:
         bus_trip = booking.bus_trip
-        bus_trip_end_time = calculate_bus_trip_end_time(bus_trip)
+        bus_trip_end_time = bus_trip.end_time
 
         # Only include bookings where the trip is still ongoing
-        if now() < bus_trip_end_time:
-            route_sections = bus_trip.route.sections.order_by('position')
-            start_point_arrival_time = calculate_rough_arrival_time(
-                bus_trip.start_time, route_sections, booking.start_point.name
-            )
-
-            # If this trip is already in the dictionary, add the seat to the list
-            if bus_trip.id in grouped_bookings:
-                grouped_bookings[bus_trip.id]["booked_seats"].append({
-                    "seat_number": booking.seat.seat_number
-                })
-            else:
-                # First time adding this trip → Create a new entry
-                grouped_bookings[bus_trip.id] = {
-                    "bus_trip_id": bus_trip.id,
-                    "bus_trip_name": bus_trip.name,
-                    "bus_name": bus_trip.bus.bus_name,
-                    "bus_number": bus_trip.bus.bus_number,
-                    "start_point": booking.start_point.name,
-                    "start_point_arrival_time": localtime(start_point_arrival_time).strftime("%Y-%m-%d %H:%M:%S"),
-                    "end_point": booking.end_point.name,
-                    "bus_trip_start_time": localtime(bus_trip.start_time).strftime("%Y-%m-%d %H:%M:%S"),
-                    "bus_trip_end_time": localtime(bus_trip_end_time).strftime("%Y-%m-%d %H:%M:%S"),
-                    "booking_status": booking.booking_status,
-                    "booked_seats": [{
-                        "seat_number": booking.seat.seat_number
-                    }]
-                }
+        if current_time >= bus_trip_end_time:
+            continue
+
+        # If this trip is already in the dictionary, add the seat to the list
+        if bus_trip.id in grouped_bookings:
+            grouped_bookings[bus_trip.id]["booked_seats"].append({
+                "seat_number": booking.seat.seat_number
+            })
+            continue
+
+        # First time adding this trip → Create a new entry
+        start_point_arrival_time = get_arrival_time(
+            bus_trip, stop_positions.get((bus_trip.route_id, booking.start_point_id)))
+        grouped_bookings[bus_trip.id] = {
+            "bus_trip_id": bus_trip.id,
+            "bus_trip_name": bus_trip.name,
+            "bus_name": bus_trip.bus.bus_name,
+            "bus_number": bus_trip.bus.bus_number,
+            "start_point": booking.start_point.name,
+            "start_point_arrival_time": localtime(start_point_arrival_time).strftime("%Y-%m-%d %H:%M:%S"),
+            **start_point_eta_fields(bus_trip, booking.start_point_id, start_point_arrival_time),
+            "end_point": booking.end_point.name,
+            "bus_trip_start_time": localtime(bus_trip.start_time).strftime("%Y-%m-%d %H:%M:%S"),
+            "bus_trip_end_time": localtime(bus_trip_end_time).strftime("%Y-%m-%d %H:%M:%S"),
+            "booking_status": booking.booking_status,
+            "booked_seats": [{
+                "seat_number": booking.seat.seat_number
+            }]
+        }
 
     return Response({
         "ongoing_bookings": list(grouped_bookings.values())
@@ -338,11 +631,21 @@ def home_ongoing_bookings(request):
 @permission_classes([IsAuthenticated])
 def get_notifications(request):
     """
-    Get all notifications for the logged-in user.
+    Get the notifications for the logged-in user, newest first, paginated
+    like the booking history (?cursor=, ?limit=).
+    Notifications are append-only: new ones get higher IDs and only is_read
+    changes, which the app sets itself (mark_notifications_as_read). There is
+    no updated_at to sync on, so ?since= is not supported: the app reads pages
+    until it reaches a notification it already has.
     """
     user = request.user
-    notifications = Notification.objects.filter(
-        user=user).order_by('-created_at')
+
+    try:
+        notifications, pagination = paginate_by_cursor(
+            Notification.objects.filter(user=user), request,
+            NOTIFICATIONS_PAGE_SIZE, NOTIFICATIONS_MAX_PAGE_SIZE, None)
+    except ValueError:
+        return Response({"error": "Invalid cursor or limit."}, status=status.HTTP_400_BAD_REQUEST)
 
     return Response({
         "notifications": [
@@ -353,7 +656,10 @@ def get_notifications(request):
                 "created_at": localtime(notif.created_at).strftime("%Y-%m-%d %H:%M:%S"),
                 "is_read": notif.is_read
             } for notif in notifications
-        ]
+        ],
+        # Tells the app not to send since: there is no incremental sync
+        "append_only": True,
+        **pagination
     }, status=status.HTTP_200_OK)
 
 
@@ -388,17 +694,16 @@ def get_ticket_details(request, booking_id):
 
     try:
         booking = Booking.objects.select_related(
-            'bus_trip', 'seat').get(id=booking_id, user=user)
+            'bus_trip__bus', 'bus_trip__route', 'seat', 'start_point', 'end_point'
+        ).get(id=booking_id, user=user)
     except Booking.DoesNotExist:
         return Response({"error": "Booking not found or does not belong to this user."}, status=status.HTTP_404_NOT_FOUND)
 
     bus_trip = booking.bus_trip
     bus_trip_end_time = calculate_bus_trip_end_time(bus_trip)
-    route_sections = bus_trip.route.sections.order_by('position')
 
-    start_point_arrival_time = calculate_rough_arrival_time(
-        bus_trip.start_time, route_sections, booking.start_point.name
-    )
+    start_point_arrival_time = get_stop_arrival_time(
+        bus_trip, booking.start_point_id)
 
     ticket_data = {
         "booking_id": booking.id,
@@ -411,11 +716,12 @@ def get_ticket_details(request, booking_id):
         "start_point": booking.start_point.name,
         "start_point_province": booking.start_point.province,
         "start_point_arrival_time": localtime(start_point_arrival_time).strftime("%Y-%m-%d %H:%M:%S"),
+        **start_point_eta_fields(bus_trip, booking.start_point_id, start_point_arrival_time),
         "end_point": booking.end_point.name,
         "end_point_province": booking.end_point.province,
         "fare_price": booking.fare_price,
         "booked_at": localtime(booking.booked_at).strftime("%Y-%m-%d %H:%M:%S"),
-        "qr_code_url": request.build_absolute_uri(booking.qr_code.url) if booking.qr_code else None,
+        "qr_code_url": booking_qr_code_url(request, booking.id),
         "bus_trip_start_date": localtime(bus_trip.start_time).strftime("%Y-%m-%d"),
         "bus_trip_start_time": localtime(bus_trip.start_time).strftime("%H:%M:%S"),
         "bus_trip_end_date": localtime(bus_trip_end_time).strftime("%Y-%m-%d"),
@@ -429,6 +735,47 @@ def get_ticket_details(request, booking_id):
     return Response(ticket_data, status=status.HTTP_200_OK)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_booking_qr_code(request, booking_id):
+    """
+    Render the QR code of a booking on demand from its signed data.
+    Query params: image_format=png (default) or svg.
+    Responds with 304 when the client's ETag still matches.
+    """
+    user = request.user
+    image_format = request.GET.get('image_format', 'png').lower()
+
+    if image_format not in QR_IMAGE_FORMATS:
+        return Response({"error": "image_format must be png or svg."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        booking = Booking.objects.select_related(
+            'bus_trip__bus').get(id=booking_id)
+    except Booking.DoesNotExist:
+        return Response({"error": "Booking not found."}, status=status.HTTP_404_NOT_FOUND)
+
+    # The passenger and the conductor of the bus may see the ticket
+    is_owner = booking.user_id == user.id
+    is_conductor = booking.bus_trip and booking.bus_trip.bus.owner_id == user.id
+    if not (is_owner or is_conductor):
+        return Response({"error": "Booking not found."}, status=status.HTTP_404_NOT_FOUND)
+
+    qr_code_data = generate_secure_qr_data(booking)
+    etag = f'"{qr_image_digest(qr_code_data, image_format)}"'
+
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = HttpResponse(
+            render_qr_image(qr_code_data, image_format),
+            content_type=QR_IMAGE_FORMATS[image_format])
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
 @api_view(['GET', 'PATCH'])
 @permission_classes([IsAuthenticated])
 def update_customer_id(request):
@@ -0,0 +1,298 @@
+# busstops/autocomplete.py
+import bisect
+import heapq
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from booking.models import Booking, CANCELED_BOOKING_STATUSES
+from .models import BoardingPoint
+
+# Booking counts only drift slowly, a full rebuild picks them up this often (in seconds)
+AUTOCOMPLETE_REBUILD_INTERVAL = getattr(settings, 'AUTOCOMPLETE_REBUILD_INTERVAL', 60 * 60)
+# Edits older than this are no longer replayed, workers that missed them rebuild
+AUTOCOMPLETE_CHANGE_TTL = 24 * 60 * 60
+
+AUTOCOMPLETE_VERSION_KEY = "boarding_point_autocomplete_version"
+
+# Typo-tolerant lookups remembered per index (keystrokes repeat across users)
+AUTOCOMPLETE_FUZZY_CACHE_SIZE = 10000
+
+# Name matches rank above city matches, which rank above province matches
+FIELD_WEIGHTS = {"name": 3, "city": 2, "province": 1}
+
+
+def autocomplete_change_key(version):
+    return f"boarding_point_autocomplete_change_{version}"
+
+
+def normalize(text):
+    return re.sub(r"[^0-9a-z]+", " ", (text or "").lower()).split()
+
+
+def trigrams(token):
+    padded = f"  {token}"
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+def allowed_typos(term):
+    # No typo tolerance for short terms, they already match many names
+    if len(term) < 4:
+        return 0
+    return 1 if len(term) < 8 else 2
+
+
+def prefix_edit_distance(term, token, limit):
+    """
+    Edit distance between term and the closest prefix of token, or limit + 1
+    once it's over the limit.
+    """
+    previous = list(range(len(token) + 1))
+    for row, term_char in enumerate(term, 1):
+        current = [row]
+        for column, token_char in enumerate(token, 1):
+            current.append(min(previous[column] + 1, current[column - 1] + 1,
+                               previous[column - 1] + (term_char != token_char)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous)
+
+
+class AutocompleteIndex:
+    """
+    Sorted token list for prefix lookups plus a trigram index of the tokens for
+    typo tolerance, over boarding point names, cities and provinces.
+    Points can be added and removed one at a time.
+    """
+
+    def __init__(self, popularity=None):
+        self.popularity = popularity or {}
+        self.entries = {}  # id -> {"id", "name", "city", "province"}
+        self.token_fields = defaultdict(dict)  # token -> {id: best field weight}
+        self.tokens = []  # sorted tokens
+        self.trigram_tokens = defaultdict(set)
+        self._fuzzy_cache = {}
+
+    def copy(self):
+        index = AutocompleteIndex(self.popularity)
+        index.entries = dict(self.entries)
+        index.token_fields = defaultdict(dict, {
+            token: dict(fields) for token, fields in self.token_fields.items()})
+        index.tokens = list(self.tokens)
+        index.trigram_tokens = defaultdict(set, {
+            trigram: set(tokens) for trigram, tokens in self.trigram_tokens.items()})
+        return index
+
+    def add(self, boarding_point):
+        self._fuzzy_cache.clear()
+        self.remove(boarding_point["id"])
+        self.entries[boarding_point["id"]] = boarding_point
+
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in normalize(boarding_point[field]):
+                fields = self.token_fields[token]
+                if not fields:
+                    bisect.insort(self.tokens, token)
+                    for trigram in trigrams(token):
+                        self.trigram_tokens[trigram].add(token)
+                fields[boarding_point["id"]] = max(
+                    weight, fields.get(boarding_point["id"], 0))
+
+    def remove(self, boarding_point_id):
+        boarding_point = self.entries.pop(boarding_point_id, None)
+        if boarding_point is None:
+            return
+        self._fuzzy_cache.clear()
+
+        for field in FIELD_WEIGHTS:
+            for token in normalize(boarding_point[field]):
+                fields = self.token_fields.get(token)
+                if fields is None or fields.pop(boarding_point_id, None) is None or fields:
+                    continue
+                del self.token_fields[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+                for trigram in trigrams(token):
+                    self.trigram_tokens[trigram].discard(token)
+
+    def _prefix_tokens(self, term):
+        start = bisect.bisect_left(self.tokens, term)
+        end = bisect.bisect_left(self.tokens, term + "\x7f")
+        return self.tokens[start:end]
+
+    def _fuzzy_tokens(self, term, typos):
+        matches = self._fuzzy_cache.get(term)
+        if matches is None:
+            if len(self._fuzzy_cache) >= AUTOCOMPLETE_FUZZY_CACHE_SIZE:
+                self._fuzzy_cache.clear()
+            matches = self._fuzzy_cache[term] = self._find_fuzzy_tokens(term, typos)
+        return matches
+
+    def _find_fuzzy_tokens(self, term, typos):
+        # Tokens sharing enough trigrams with the term to be within reach
+        shared = Counter()
+        for trigram in trigrams(term):
+            shared.update(self.trigram_tokens.get(trigram, ()))
+        needed = len(trigrams(term)) - 3 * typos
+
+        # Only the first len(term) + typos characters can match, and many
+        # tokens share them: compare each distinct head once
+        head_length = len(term) + typos
+        distances = {}
+        matches = []
+        for token, count in shared.items():
+            if count < needed:
+                continue
+            head = token[:head_length]
+            if head not in distances:
+                distances[head] = prefix_edit_distance(term, head, typos)
+            if distances[head] <= typos:
+                matches.append(token)
+        return matches
+
+    def _term_scores(self, term):
+        # {id: score} of the points matching one query term, exact prefixes first
+        scores = {}
+        for token in self._prefix_tokens(term):
+            for boarding_point_id, weight in self.token_fields[token].items():
+                score = weight * 2 + (token == term)
+                scores[boarding_point_id] = max(score, scores.get(boarding_point_id, 0))
+
+        typos = allowed_typos(term)
+        if typos and len(scores) < 10:
+            for token in self._fuzzy_tokens(term, typos):
+                for boarding_point_id, weight in self.token_fields[token].items():
+                    scores.setdefault(boarding_point_id, weight)
+        return scores
+
+    def search(self, query, limit=10):
+        """
+        Boarding points matching every word of the query (the last one may be
+        incomplete), best text match first, then most booked.
+        """
+        terms = normalize(query)
+        if not terms:
+            return []
+
+        scores = None
+        for term in terms:
+            term_scores = self._term_scores(term)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {boarding_point_id: score + term_scores[boarding_point_id]
+                          for boarding_point_id, score in scores.items()
+                          if boarding_point_id in term_scores}
+            if not scores:
+                return []
+
+        ranked = heapq.nsmallest(limit, scores, key=lambda boarding_point_id: (
+            -scores[boarding_point_id],
+            -self.popularity.get(boarding_point_id, 0),
+            self.entries[boarding_point_id]["name"]))
+        return [self.entries[boarding_point_id] for boarding_point_id in ranked]
+
+
+def get_boarding_point_popularity():
+    """
+    Number of active bookings starting or ending at each boarding point.
+    """
+    popularity = Counter()
+    bookings = Booking.objects.exclude(
+        booking_status__in=CANCELED_BOOKING_STATUSES).order_by()
+    for field in ('start_point_id', 'end_point_id'):
+        popularity.update(dict(bookings.values(field).annotate(
+            count=Count('id')).values_list(field, 'count')))
+    return popularity
+
+
+def build_autocomplete_index():
+    index = AutocompleteIndex(get_boarding_point_popularity())
+    for boarding_point in BoardingPoint.objects.values('id', 'name', 'city', 'province'):
+        index.add(boarding_point)
+    return index
+
+
+# --- Per-process index ------------------------------------------------------
+# Every edit bumps the version in the shared cache and records the changed
+# point under that version, so workers replay the edits they missed instead
+# of rebuilding.
+
+_autocomplete = {"version": None, "index": None, "built_at": None}
+_autocomplete_lock = threading.Lock()
+
+
+def record_boarding_point_change(boarding_point_id):
+    try:
+        version = cache.incr(AUTOCOMPLETE_VERSION_KEY)
+    except ValueError:
+        # Unknown version: workers can't replay, they'll rebuild
+        cache.set(AUTOCOMPLETE_VERSION_KEY, time.time_ns(), timeout=None)
+        return
+    cache.set(autocomplete_change_key(version), boarding_point_id,
+              timeout=AUTOCOMPLETE_CHANGE_TTL)
+
+
+def _current_version():
+    version = cache.get(AUTOCOMPLETE_VERSION_KEY)
+    if version is None:
+        cache.add(AUTOCOMPLETE_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(AUTOCOMPLETE_VERSION_KEY)
+    return version
+
+
+def _replay_changes(index, from_version, to_version):
+    # The updated copy of the index, None when some change is gone (expired,
+    # or the version was reset). Requests being served keep the old index.
+    if not 0 < to_version - from_version <= 1000:
+        return None
+
+    versions = range(from_version + 1, to_version + 1)
+    changes = cache.get_many([autocomplete_change_key(version) for version in versions])
+    if len(changes) != len(versions):
+        return None
+
+    changed_ids = set(changes.values())
+    boarding_points = {
+        boarding_point["id"]: boarding_point
+        for boarding_point in BoardingPoint.objects.filter(id__in=changed_ids).values(
+            'id', 'name', 'city', 'province')
+    }
+    index = index.copy()
+    for boarding_point_id in changed_ids:
+        if boarding_point_id in boarding_points:
+            index.add(boarding_points[boarding_point_id])
+        else:
+            index.remove(boarding_point_id)
+    return index
+
+
+def get_autocomplete_index():
+    version = _current_version()
+    built_at = _autocomplete["built_at"]
+    fresh = built_at is not None and time.monotonic() - built_at < AUTOCOMPLETE_REBUILD_INTERVAL
+    if fresh and _autocomplete["version"] == version:
+        return _autocomplete["index"]
+
+    with _autocomplete_lock:
+        built_at = _autocomplete["built_at"]
+        fresh = built_at is not None and time.monotonic() - built_at < AUTOCOMPLETE_REBUILD_INTERVAL
+        if fresh and _autocomplete["version"] != version:
+            index = _replay_changes(_autocomplete["index"], _autocomplete["version"], version)
+            if index is None:
+                fresh = False
+            else:
+                _autocomplete["index"] = index
+        if not fresh:
+            _autocomplete["index"] = build_autocomplete_index()
+            _autocomplete["built_at"] = time.monotonic()
+        _autocomplete["version"] = version
+
+    return _autocomplete["index"]
+
+
+def autocomplete_boarding_points(query, limit=10):
+    return get_autocomplete_index().search(query, limit)
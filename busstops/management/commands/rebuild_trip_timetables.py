@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils.timezone import now
+from booking.models import BusTrip
+from busstops.search_cache import bump_route_version
+from busstops.utils import refresh_route_timetables
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the timetables of the upcoming and ongoing trips, "
+            "e.g. after a change to the busy time rules.")
+
+    def handle(self, *args, **options):
+        route_ids = set(BusTrip.objects.filter(
+            Q(end_time__isnull=True) | Q(end_time__gte=now())
+        ).values_list('route_id', flat=True))
+
+        for route_id in route_ids:
+            refresh_route_timetables(route_id)
+            # Cached searches carry the old arrival times
+            bump_route_version(route_id)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt the trip timetables of {len(route_ids)} routes."))
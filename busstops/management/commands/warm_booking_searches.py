@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from busstops.search_cache import decay_search_popularity
+from busstops.warmup import (
+    warm_popular_searches, SEARCH_WARMUP_PAIRS, SEARCH_WARMUP_REFRESH_INTERVAL,
+    SEARCH_POPULARITY_DECAY_INTERVAL)
+
+
+class Command(BaseCommand):
+    help = "Precompute the booking search results of the most searched boarding point pairs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=SEARCH_WARMUP_PAIRS,
+                            help="Number of most searched pairs to warm.")
+        parser.add_argument('--refresh', action='store_true',
+                            help="Recompute results that are still cached too.")
+        parser.add_argument('--loop', type=int, metavar='SECONDS',
+                            help="Keep running, checking for invalidated results every SECONDS.")
+
+    def handle(self, *args, **options):
+        if not options['loop']:
+            warmed = warm_popular_searches(options['limit'], options['refresh'])
+            self.stdout.write(self.style.SUCCESS(f"Warmed {warmed} booking searches."))
+            return
+
+        last_refresh = last_decay = time.monotonic()
+        while True:
+            current_time = time.monotonic()
+            refresh = current_time - last_refresh >= SEARCH_WARMUP_REFRESH_INTERVAL
+            if refresh:
+                last_refresh = current_time
+            if current_time - last_decay >= SEARCH_POPULARITY_DECAY_INTERVAL:
+                decay_search_popularity()
+                last_decay = current_time
+
+            warmed = warm_popular_searches(options['limit'], refresh)
+            if warmed:
+                self.stdout.write(f"Warmed {warmed} booking searches.")
+            time.sleep(options['loop'])
@@ -0,0 +1,49 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def populate_route_stop_positions(apps, schema_editor):
+    Section = apps.get_model('busstops', 'Section')
+    RouteStopPosition = apps.get_model('busstops', 'RouteStopPosition')
+    through = Section.section_boarding_points.through
+
+    positions = through.objects.values(
+        'section__bus_route_id', 'boardingpoint_id'
+    ).annotate(position=Min('section__position'))
+
+    RouteStopPosition.objects.bulk_create([
+        RouteStopPosition(
+            bus_route_id=row['section__bus_route_id'],
+            boarding_point_id=row['boardingpoint_id'],
+            position=row['position'],
+        )
+        for row in positions
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('busstops', '0003_alter_buses_seat_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteStopPosition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField()),
+                ('boarding_point', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='route_positions', to='busstops.boardingpoint')),
+                ('bus_route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stop_positions', to='busstops.busroute')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bus_route', 'position'], name='busstops_ro_bus_rou_1a6249_idx')],
+                'unique_together': {('boarding_point', 'bus_route')},
+            },
+        ),
+        migrations.RunPython(populate_route_stop_positions,
+                             migrations.RunPython.noop),
+    ]
@@ -169,6 +169,28 @@ class Section(models.Model):
         return f"{self.name} (Route: {self.bus_route.name})"
 
 
+class RouteStopPosition(models.Model):
+    """
+    Lookup table of (boarding point, route) -> position of the first section
+    on that route that serves the boarding point.
+    Kept in sync with Section changes by busstops/signals.py.
+    """
+    bus_route = models.ForeignKey(
+        BusRoute, on_delete=models.CASCADE, related_name='stop_positions')
+    boarding_point = models.ForeignKey(
+        BoardingPoint, on_delete=models.CASCADE, related_name='route_positions')
+    position = models.PositiveSmallIntegerField()
+
+    class Meta:
+        unique_together = ('boarding_point', 'bus_route')
+        indexes = [
+            models.Index(fields=['bus_route', 'position']),
+        ]
+
+    def __str__(self):
+        return f"{self.boarding_point.name} @ {self.position} (Route: {self.bus_route.name})"
+
+
 class Buses(models.Model):
     SEAT_TYPES = [
 	(0, '0-seater'),
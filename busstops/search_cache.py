@@ -0,0 +1,269 @@
+import hashlib
+import logging
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from .utils import get_matched_route_ids
+
+logger = logging.getLogger(__name__)
+
+ROUTE_MATCH_VERSION_KEY = "route_match_version"
+# Routes serving a pair only change with the stop-position index (cleared then)
+ROUTE_MATCH_TTL = 24 * 60 * 60
+
+# A rebuild holding the lock longer than this (in seconds) is presumed dead
+BOOKING_SEARCH_LOCK_TIMEOUT = getattr(settings, 'BOOKING_SEARCH_LOCK_TIMEOUT', 30)
+# Requests with no previous results wait this long (in seconds) for the rebuild
+BOOKING_SEARCH_LOCK_WAIT = getattr(settings, 'BOOKING_SEARCH_LOCK_WAIT', 10)
+# Previous results served while a rebuild is running (in seconds)
+BOOKING_SEARCH_STALE_TTL = getattr(settings, 'BOOKING_SEARCH_STALE_TTL', 60 * 60)
+
+SEARCH_POPULARITY_KEY = "booking_search_popularity"
+# Pairs kept in the counters, the least searched are dropped beyond this
+SEARCH_POPULARITY_MAX_PAIRS = getattr(settings, 'SEARCH_POPULARITY_MAX_PAIRS', 5000)
+
+
+def route_version_key(route_id):
+    return f"route_version_{route_id}"
+
+
+def _initial_route_version():
+    # Time based so a version that was evicted from the cache never comes back
+    # with a value that older search results were stored under.
+    return int(time.time() * 1000)
+
+
+def get_route_versions(route_ids):
+    """
+    Current cache version of each route, keyed by route ID.
+    """
+    keys = {route_version_key(route_id): route_id for route_id in route_ids}
+    stored = cache.get_many(keys.keys())
+
+    versions = {}
+    for key, route_id in keys.items():
+        if key not in stored:
+            cache.add(key, _initial_route_version(), timeout=None)
+            stored[key] = cache.get(key)
+        versions[route_id] = stored[key]
+
+    return versions
+
+
+def bump_route_version(route_id):
+    """
+    Invalidate every cached search that includes this route with a single INCR.
+    """
+    key = route_version_key(route_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # No version stored yet: any fresh version is already an invalidation
+        cache.add(key, _initial_route_version(), timeout=None)
+
+
+def _route_match_version():
+    version = cache.get(ROUTE_MATCH_VERSION_KEY)
+    if version is None:
+        cache.add(ROUTE_MATCH_VERSION_KEY, _initial_route_version(), timeout=None)
+        version = cache.get(ROUTE_MATCH_VERSION_KEY)
+    return version
+
+
+def clear_matched_routes():
+    """
+    Forget the cached routes of every (start_point, end_point) pair, after the
+    stop-position index or the boarding points of a route changed.
+    """
+    try:
+        cache.incr(ROUTE_MATCH_VERSION_KEY)
+    except ValueError:
+        cache.add(ROUTE_MATCH_VERSION_KEY, _initial_route_version(), timeout=None)
+
+
+def get_cached_matched_route_ids(start_point_id, end_point_id):
+    """
+    Sorted IDs of the routes serving the pair (see get_matched_route_ids),
+    cached so that booking searches served from the cache make no query.
+    """
+    key = f"matched_routes_{_route_match_version()}_{start_point_id}_{end_point_id}"
+    route_ids = cache.get(key)
+    if route_ids is None:
+        route_ids = sorted(set(
+            get_matched_route_ids(start_point_id, end_point_id).values_list(
+                'bus_route_id', flat=True)
+        ))
+        cache.set(key, route_ids, timeout=ROUTE_MATCH_TTL)
+    return route_ids
+
+
+def booking_search_cache_key(start_point_id, end_point_id):
+    """
+    Cache key for a booking search, namespaced by the versions of all routes
+    that serve the (start_point, end_point) pair.
+    """
+    route_ids = get_cached_matched_route_ids(start_point_id, end_point_id)
+    versions = get_route_versions(route_ids)
+
+    namespace = ",".join(
+        f"{route_id}:{versions[route_id]}" for route_id in route_ids)
+    digest = hashlib.md5(namespace.encode()).hexdigest()
+
+    return f"booking_search_{start_point_id}_{end_point_id}_{digest}"
+
+
+# --- Single-flight rebuilds -------------------------------------------------
+# When a search is invalidated, one worker rebuilds it while the others serve
+# the previous results (stale-while-revalidate). Only requests for a pair that
+# was never computed wait for the rebuild.
+
+def booking_search_stale_key(start_point_id, end_point_id):
+    return f"booking_search_stale_{int(start_point_id)}_{int(end_point_id)}"
+
+
+def _acquire_rebuild_lock(cache_key):
+    # Token of the acquired lock, None if another worker holds it
+    token = uuid.uuid4().hex
+    if cache.add(f"{cache_key}_lock", token, timeout=BOOKING_SEARCH_LOCK_TIMEOUT):
+        return token
+    return None
+
+
+def _release_rebuild_lock(cache_key, token):
+    # Don't release a lock that expired and was taken over by another worker
+    if cache.get(f"{cache_key}_lock") == token:
+        cache.delete(f"{cache_key}_lock")
+
+
+def store_booking_search(cache_key, start_point_id, end_point_id, data):
+    cache.set(cache_key, data)
+    cache.set(booking_search_stale_key(start_point_id, end_point_id), data,
+              timeout=BOOKING_SEARCH_STALE_TTL)
+
+
+def rebuild_booking_search(cache_key, start_point_id, end_point_id, compute):
+    """
+    Compute and store the results if no other worker is rebuilding them.
+
+    Returns:
+        The results, None when another worker holds the rebuild lock.
+    """
+    token = _acquire_rebuild_lock(cache_key)
+    if token is None:
+        return None
+
+    try:
+        data = compute()
+        store_booking_search(cache_key, start_point_id, end_point_id, data)
+        return data
+    finally:
+        _release_rebuild_lock(cache_key, token)
+
+
+def get_or_rebuild_booking_search(cache_key, start_point_id, end_point_id, compute):
+    """
+    Results of a booking search whose cache_key missed, with at most one
+    worker running compute() per key.
+
+    Returns:
+        tuple: (results, True if computed by this call)
+    """
+    data = rebuild_booking_search(cache_key, start_point_id, end_point_id, compute)
+    if data is not None:
+        return data, True
+
+    stale_data = cache.get(booking_search_stale_key(start_point_id, end_point_id))
+    if stale_data is not None:
+        return stale_data, False
+
+    deadline = time.monotonic() + BOOKING_SEARCH_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        data = cache.get(cache_key)
+        if data is not None:
+            return data, False
+        if cache.get(f"{cache_key}_lock") is None:
+            # The rebuild failed or gave up, try it here
+            break
+
+    data = compute()
+    store_booking_search(cache_key, start_point_id, end_point_id, data)
+    return data, True
+
+
+# --- Search popularity ------------------------------------------------------
+# Decaying hit counters of (start_point, end_point) pairs: a Redis sorted set
+# when the cache is Redis (atomic ZINCRBY), otherwise a dict in the cache
+# (read-modify-write, approximate under concurrent searches).
+
+def uses_redis_counters():
+    return settings.CACHES['default']['BACKEND'].startswith('django_redis')
+
+
+def _pair_member(start_point_id, end_point_id):
+    return f"{int(start_point_id)}:{int(end_point_id)}"
+
+
+def record_booking_search(start_point_id, end_point_id):
+    """
+    Count a search of the pair. Never raises: counting must not fail a search.
+    """
+    try:
+        member = _pair_member(start_point_id, end_point_id)
+        if uses_redis_counters():
+            from django_redis import get_redis_connection
+
+            get_redis_connection('default').zincrby(SEARCH_POPULARITY_KEY, 1, member)
+            return
+
+        counters = cache.get(SEARCH_POPULARITY_KEY) or {}
+        counters[member] = counters.get(member, 0) + 1
+        if len(counters) > SEARCH_POPULARITY_MAX_PAIRS * 2:
+            counters = dict(sorted(counters.items(), key=lambda item: -item[1])[
+                :SEARCH_POPULARITY_MAX_PAIRS])
+        cache.set(SEARCH_POPULARITY_KEY, counters, timeout=None)
+    except Exception:
+        logger.exception("Could not count the booking search %s -> %s",
+                         start_point_id, end_point_id)
+
+
+def get_popular_searches(limit=100):
+    """
+    The most searched pairs as [(start_point_id, end_point_id, score), ...].
+    """
+    if uses_redis_counters():
+        from django_redis import get_redis_connection
+
+        rows = get_redis_connection('default').zrevrange(
+            SEARCH_POPULARITY_KEY, 0, limit - 1, withscores=True)
+        rows = [(member.decode(), score) for member, score in rows]
+    else:
+        counters = cache.get(SEARCH_POPULARITY_KEY) or {}
+        rows = sorted(counters.items(), key=lambda item: -item[1])[:limit]
+
+    pairs = []
+    for member, score in rows:
+        start_point_id, end_point_id = member.split(':')
+        pairs.append((int(start_point_id), int(end_point_id), score))
+    return pairs
+
+
+def decay_search_popularity(factor=0.5, min_score=0.5):
+    """
+    Scale every counter down so popularity follows recent demand, and drop
+    pairs nobody searches anymore.
+    """
+    if uses_redis_counters():
+        from django_redis import get_redis_connection
+
+        connection = get_redis_connection('default')
+        connection.zunionstore(SEARCH_POPULARITY_KEY, {SEARCH_POPULARITY_KEY: factor})
+        connection.zremrangebyscore(SEARCH_POPULARITY_KEY, '-inf', f"({min_score}")
+        connection.zremrangebyrank(SEARCH_POPULARITY_KEY, 0, -SEARCH_POPULARITY_MAX_PAIRS - 1)
+        return
+
+    counters = cache.get(SEARCH_POPULARITY_KEY) or {}
+    counters = {member: score * factor for member, score in counters.items()
+                if score * factor >= min_score}
+    cache.set(SEARCH_POPULARITY_KEY, counters, timeout=None)
@@ -0,0 +1,106 @@
+# busstops/seat_map.py
+import base64
+from booking.models import Booking, CANCELED_BOOKING_STATUSES
+
+SEAT_MAP_ENCODINGS = ('bitmap', 'rle')
+
+
+def build_seat_map(bus_trip, include_points=False, holder_id=None):
+    """
+    Seat map of a trip from the seat availability engine (see
+    get_seat_availability), plus one query for the points of booked seats.
+
+    Args:
+        bus_trip (BusTrip): The trip.
+        include_points (bool): Also load the start and end point names of booked seats.
+        holder_id (int): Seats held by this user are reported as available.
+
+    Returns:
+        dict: {
+            "seats": [(seat_id, seat_number), ...],  # ordered by seat number
+            "booked": {seat_id: (start_point_name, end_point_name) or None},
+            "held": {seat_id, ...},
+        }
+    """
+    from .utils import get_seat_availability
+
+    availability = get_seat_availability(
+        [bus_trip], holder_id=holder_id)[bus_trip.id]
+
+    booked = dict.fromkeys(availability["booked_seat_ids"])
+    if include_points and booked:
+        booked.update(
+            (seat_id, (start_point, end_point))
+            for seat_id, start_point, end_point in Booking.objects.filter(
+                bus_trip_id=bus_trip.id
+            ).exclude(
+                booking_status__in=CANCELED_BOOKING_STATUSES
+            ).values_list('seat_id', 'start_point__name', 'end_point__name')
+        )
+
+    return {"seats": availability["seats"], "booked": booked, "held": availability["held_seat_ids"]}
+
+
+def seat_availability_bits(seat_map):
+    """
+    1 for every available seat, 0 for booked or held ones, in seat number order.
+    """
+    unavailable = seat_map["booked"].keys() | seat_map["held"]
+    return [0 if seat_id in unavailable else 1 for seat_id, _ in seat_map["seats"]]
+
+
+def encode_bitmap(bits):
+    """
+    Pack bits into bytes (first seat in the most significant bit) as base64.
+    """
+    packed = bytearray((len(bits) + 7) // 8)
+    for index, bit in enumerate(bits):
+        if bit:
+            packed[index // 8] |= 0x80 >> (index % 8)
+    return base64.b64encode(bytes(packed)).decode()
+
+
+def encode_rle(bits):
+    """
+    Run lengths alternating available / unavailable, starting with available
+    (the first run is 0 when the first seat is taken).
+    """
+    runs = []
+    current, length = 1, 0
+    for bit in bits:
+        if bit == current:
+            length += 1
+        else:
+            runs.append(length)
+            current, length = bit, 1
+    runs.append(length)
+    return runs
+
+
+def encode_id_ranges(seat_ids):
+    """
+    Seat IDs as [first_id, count] ranges; a bus's seats are usually one range.
+    """
+    ranges = []
+    for seat_id in seat_ids:
+        if ranges and ranges[-1][0] + ranges[-1][1] == seat_id:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([seat_id, 1])
+    return ranges
+
+
+def encode_seat_map(seat_map, encoding):
+    """
+    Compact availability payload: the seat IDs in seat number order as ranges,
+    plus availability as a base64 bitmap or a run-length array.
+    """
+    bits = seat_availability_bits(seat_map)
+
+    return {
+        "encoding": encoding,
+        "seat_count": len(bits),
+        "seat_id_ranges": encode_id_ranges(
+            [seat_id for seat_id, _ in seat_map["seats"]]),
+        "availability": encode_bitmap(bits) if encoding == 'bitmap' else encode_rle(bits),
+    }
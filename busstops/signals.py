@@ -1,22 +1,98 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
-from django.core.cache import cache
-from booking.models import BusTrip
+from booking.models import BusTrip, Booking
+from .models import Section, RouteStopPosition, BoardingPoint, BusRoute
+from .utils import rebuild_route_stop_positions, refresh_route_timetables
+from .search_cache import bump_route_version, clear_matched_routes
+from .spatial import bump_boarding_point_index_version
+from .autocomplete import record_boarding_point_change
 
 
 @receiver(post_save, sender=BusTrip)
-def clear_bus_trip_cache(sender, instance, created, **kwargs):
-    if created:  # Only trigger if a new BusTrip is created
-        # Get all boarding points for the route associated with the BusTrip
-        boarding_points = instance.route.route_boarding_points.all()
-
-        # Loop through all combinations of boarding points to find the cache keys
-        for i, start_point in enumerate(boarding_points):
-            # Ensure start_point comes before end_point
-            for end_point in boarding_points[i + 1:]:
-                # Generate the cache key format: booking_search_{start_point_id}_{end_point_id}
-                cache_key = f"booking_search_{start_point.id}_{end_point.id}"
-
-                # Delete the cache for this particular start and end point combination
-                cache.delete(cache_key)
-                print(f"Cache for {cache_key} has been cleared.")
+@receiver(post_delete, sender=BusTrip)
+def clear_bus_trip_cache(sender, instance, **kwargs):
+    """
+    New, rescheduled, canceled or deleted trips change the search results of their route.
+    """
+    bump_route_version(instance.route_id)
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def clear_booking_search_cache(sender, instance, **kwargs):
+    """
+    Bookings and cancellations change the available seat counts of cached searches.
+    """
+    if not instance.bus_trip_id:
+        return
+    try:
+        bump_route_version(instance.bus_trip.route_id)
+    except BusTrip.DoesNotExist:
+        # Deleted along with its trip, which bumps the route itself
+        pass
+
+
+@receiver(post_save, sender=Section)
+@receiver(post_delete, sender=Section)
+def refresh_route_stop_positions(sender, instance, **kwargs):
+    """
+    Keep the stop-position index and trip timetables in sync when a section
+    is added, moved, retimed or removed.
+    """
+    rebuild_route_stop_positions(instance.bus_route_id)
+    refresh_route_timetables(instance.bus_route_id)
+    bump_route_version(instance.bus_route_id)
+
+
+@receiver(m2m_changed, sender=Section.section_boarding_points.through)
+def refresh_route_stop_positions_for_boarding_points(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep the stop-position index in sync when boarding points are attached to
+    or detached from sections (from either side of the relation).
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        # instance is a Section
+        rebuild_route_stop_positions(instance.bus_route_id)
+        bump_route_version(instance.bus_route_id)
+    elif action == 'post_clear':
+        # instance is a BoardingPoint that no longer belongs to any section
+        stale_positions = RouteStopPosition.objects.filter(
+            boarding_point=instance)
+        for route_id in stale_positions.values_list('bus_route_id', flat=True):
+            bump_route_version(route_id)
+        stale_positions.delete()
+        clear_matched_routes()
+    else:
+        # instance is a BoardingPoint, pk_set holds the affected sections
+        route_ids = Section.objects.filter(
+            pk__in=pk_set).values_list('bus_route_id', flat=True).distinct()
+        for route_id in route_ids:
+            rebuild_route_stop_positions(route_id)
+            bump_route_version(route_id)
+
+
+@receiver(m2m_changed, sender=BusRoute.route_boarding_points.through)
+def clear_route_boarding_points_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Route matching also requires both points in the route's boarding points.
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    clear_matched_routes()
+    if not reverse:
+        bump_route_version(instance.id)
+
+
+@receiver(post_save, sender=BoardingPoint)
+@receiver(post_delete, sender=BoardingPoint)
+def refresh_boarding_point_index(sender, instance, **kwargs):
+    """
+    Make every worker rebuild its spatial index of boarding points and
+    update its autocomplete index.
+    """
+    bump_boarding_point_index_version()
+    record_boarding_point_change(instance.id)
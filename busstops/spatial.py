@@ -0,0 +1,201 @@
+# busstops/spatial.py
+import math
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from .models import BoardingPoint
+
+# Side of a grid cell in degrees (0.05° is about 5.5 km in Sri Lanka)
+SPATIAL_GRID_CELL_DEGREES = getattr(settings, 'SPATIAL_GRID_CELL_DEGREES', 0.05)
+
+EARTH_RADIUS_METERS = 6371000
+METERS_PER_DEGREE = 111320
+
+BOARDING_POINT_INDEX_VERSION_KEY = "boarding_point_index_version"
+
+
+def haversine_distance(latitude_1, longitude_1, latitude_2, longitude_2):
+    """
+    Great-circle distance between two points in meters.
+    """
+    phi_1, phi_2 = math.radians(latitude_1), math.radians(latitude_2)
+    delta_phi = math.radians(latitude_2 - latitude_1)
+    delta_lambda = math.radians(longitude_2 - longitude_1)
+
+    a = (math.sin(delta_phi / 2) ** 2
+         + math.cos(phi_1) * math.cos(phi_2) * math.sin(delta_lambda / 2) ** 2)
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+class GridIndex:
+    """
+    Fixed-size latitude/longitude grid of (latitude, longitude, item) entries.
+    Lookups only scan the cells around the query, so they cost the same
+    whatever the number of indexed points.
+    """
+
+    def __init__(self, entries=(), cell_degrees=SPATIAL_GRID_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.cells = defaultdict(list)
+        for latitude, longitude, item in entries:
+            self.cells[self._cell(latitude, longitude)].append((latitude, longitude, item))
+
+        rows = [row for row, _ in self.cells] or [0]
+        columns = [column for _, column in self.cells] or [0]
+        self._bounds = (min(rows), min(columns), max(rows), max(columns))
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.cells.values())
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def _ring(self, row, column, radius):
+        # Cells of the ring, clipped to the occupied area
+        min_row, min_column, max_row, max_column = self._bounds
+        if radius == 0:
+            yield row, column
+            return
+
+        first_column, last_column = max(column - radius, min_column), min(column + radius, max_column)
+        for ring_row in (row - radius, row + radius):
+            if min_row <= ring_row <= max_row:
+                for ring_column in range(first_column, last_column + 1):
+                    yield ring_row, ring_column
+
+        first_row, last_row = max(row - radius + 1, min_row), min(row + radius - 1, max_row)
+        for ring_column in (column - radius, column + radius):
+            if min_column <= ring_column <= max_column:
+                for ring_row in range(first_row, last_row + 1):
+                    yield ring_row, ring_column
+
+    def nearest(self, latitude, longitude, count=5, max_distance=None):
+        """
+        The count nearest entries as [(distance_m, item), ...], closest first.
+        Only rings overlapping the occupied area are walked, so queries far
+        from every entry cost no more than a scan of that area.
+        """
+        row, column = self._cell(latitude, longitude)
+        # Distance covered by each ring in the worst direction
+        ring_meters = self.cell_degrees * METERS_PER_DEGREE * min(
+            1.0, math.cos(math.radians(min(89.0, abs(latitude) + self.cell_degrees))))
+        min_row, min_column, max_row, max_column = self._bounds
+        first_radius = max(0, min_row - row, row - max_row, min_column - column, column - max_column)
+        last_radius = max(abs(row - min_row), abs(row - max_row),
+                          abs(column - min_column), abs(column - max_column))
+
+        found = []
+        for radius in range(first_radius, last_radius + 1):
+            for cell in self._ring(row, column, radius):
+                for entry_latitude, entry_longitude, item in self.cells.get(cell, ()):
+                    distance = haversine_distance(
+                        latitude, longitude, entry_latitude, entry_longitude)
+                    if max_distance is None or distance <= max_distance:
+                        found.append((distance, item))
+
+            # Anything in the next rings is at least this far away
+            searched = radius * ring_meters
+            found.sort(key=lambda entry: entry[0])
+            if len(found) >= count and found[count - 1][0] <= searched:
+                break
+            if max_distance is not None and searched >= max_distance:
+                break
+
+        return found[:count]
+
+    def within_bbox(self, south, west, north, east, limit=None):
+        """
+        Items inside the bounding box, in no particular order.
+        """
+        min_row, min_column = self._cell(south, west)
+        max_row, max_column = self._cell(north, east)
+
+        items = []
+        # Walk whichever is smaller: the cells of the box or the occupied cells
+        if (max_row - min_row + 1) * (max_column - min_column + 1) <= len(self.cells):
+            cells = ((row, column) for row in range(min_row, max_row + 1)
+                     for column in range(min_column, max_column + 1))
+        else:
+            cells = (cell for cell in self.cells
+                     if min_row <= cell[0] <= max_row and min_column <= cell[1] <= max_column)
+
+        for cell in cells:
+            for latitude, longitude, item in self.cells.get(cell, ()):
+                if south <= latitude <= north and west <= longitude <= east:
+                    items.append(item)
+                    if limit is not None and len(items) >= limit:
+                        return items
+        return items
+
+
+def parse_bbox(value):
+    """
+    (south, west, north, east) of a "south,west,north,east" string, None if invalid.
+    """
+    try:
+        south, west, north, east = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        return None
+
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        return None
+    return south, west, north, east
+
+
+# --- Boarding point index -------------------------------------------------
+# Each worker process keeps its own index and rebuilds it when the version in
+# the shared cache changes (bumped by the BoardingPoint signals).
+
+_boarding_point_index = {"version": None, "index": None}
+_boarding_point_index_lock = threading.Lock()
+
+
+def bump_boarding_point_index_version():
+    cache.set(BOARDING_POINT_INDEX_VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def _boarding_point_index_version():
+    version = cache.get(BOARDING_POINT_INDEX_VERSION_KEY)
+    if version is None:
+        cache.add(BOARDING_POINT_INDEX_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(BOARDING_POINT_INDEX_VERSION_KEY)
+    return version
+
+
+def get_boarding_point_index():
+    """
+    Grid index of all boarding points, items are
+    {"id", "name", "city", "province", "latitude", "longitude"} dicts.
+    """
+    version = _boarding_point_index_version()
+    if _boarding_point_index["version"] == version:
+        return _boarding_point_index["index"]
+
+    with _boarding_point_index_lock:
+        if _boarding_point_index["version"] != version:
+            boarding_points = BoardingPoint.objects.values(
+                'id', 'name', 'city', 'province', 'latitude', 'longitude')
+            _boarding_point_index["index"] = GridIndex(
+                (boarding_point['latitude'], boarding_point['longitude'], boarding_point)
+                for boarding_point in boarding_points)
+            _boarding_point_index["version"] = version
+
+    return _boarding_point_index["index"]
+
+
+def nearest_boarding_points(latitude, longitude, count=5, max_distance=None):
+    """
+    The count boarding points nearest to a position, closest first, each with
+    its distance_m.
+    """
+    return [
+        {**boarding_point, "distance_m": round(distance)}
+        for distance, boarding_point in get_boarding_point_index().nearest(
+            latitude, longitude, count, max_distance)
+    ]
+
+
+def boarding_points_in_bbox(south, west, north, east, limit=None):
+    return get_boarding_point_index().within_bbox(south, west, north, east, limit)
@@ -1 +1,767 @@
-from django.test import TestCase
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
+from zoneinfo import ZoneInfo
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import localtime, now
+from rest_framework.test import APITestCase
+from booking.models import Booking, BusTrip
+from booking.seat_holds import hold_seats
+from members.models import User
+from . import autocomplete
+from .autocomplete import AutocompleteIndex, autocomplete_boarding_points
+from .models import (
+    BoardingPoint, BusFareLuxury, BusFareSemiLuxury, BusRoute, Buses, RouteStopPosition, Seat,
+    Section)
+from .search_cache import (
+    booking_search_cache_key, booking_search_stale_key, decay_search_popularity,
+    get_or_rebuild_booking_search, get_popular_searches, record_booking_search,
+    rebuild_booking_search)
+from .seat_map import build_seat_map, encode_seat_map
+from .spatial import GridIndex, haversine_distance, parse_bbox
+from .warmup import warm_booking_search, warm_popular_searches
+from .utils import (
+    build_booking_search_results, calculate_luxury_bus_fare, calculate_semi_luxury_bus_fare,
+    get_available_seats_for_instant_booking, get_booking_information, get_matched_route_ids,
+    is_global_busy_time, rebuild_route_stop_positions, segment_mask)
+
+
+class BookingSearchCacheKeyTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.boarding_points = [
+            BoardingPoint.objects.create(name=f"Stop {i}") for i in range(4)]
+        cls.route = BusRoute.objects.create(name="Colombo - Kandy")
+        cls.route.route_boarding_points.set(cls.boarding_points)
+        cls.sections = []
+        for position in range(1, 3):
+            section = Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(minutes=30), distance=10)
+            section.section_boarding_points.set(
+                cls.boarding_points[2 * position - 2:2 * position])
+            cls.sections.append(section)
+        cls.bus = Buses.objects.create(
+            bus_name="Express", bus_number="NB-1234", seat_count=40)
+
+    def setUp(self):
+        cache.clear()
+        self.start_id = self.boarding_points[0].id
+        self.end_id = self.boarding_points[3].id
+
+    def test_cached_key_makes_no_query(self):
+        key = booking_search_cache_key(self.start_id, self.end_id)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(booking_search_cache_key(self.start_id, self.end_id), key)
+        self.assertEqual(len(queries), 0)
+
+    def test_key_changes_when_a_trip_is_deleted(self):
+        bus_trip = BusTrip.objects.create(
+            bus=self.bus, route=self.route, start_time=now() + timedelta(days=1))
+        key = booking_search_cache_key(self.start_id, self.end_id)
+        bus_trip.delete()
+        self.assertNotEqual(booking_search_cache_key(self.start_id, self.end_id), key)
+
+    def test_key_follows_stop_position_rebuilds(self):
+        other_route = BusRoute.objects.create(name="Colombo - Kandy (Express)")
+        other_route.route_boarding_points.set(self.boarding_points)
+        key = booking_search_cache_key(self.start_id, self.end_id)
+
+        # The new route only serves the pair once both stops have a position
+        with self.captureOnCommitCallbacks(execute=True):
+            for position, boarding_point in enumerate(
+                    (self.boarding_points[0], self.boarding_points[3]), 1):
+                section = Section.objects.create(
+                    bus_route=other_route, name=f"Express {position}", position=position,
+                    time=timedelta(minutes=45), distance=20)
+                section.section_boarding_points.set([boarding_point])
+        self.assertNotEqual(booking_search_cache_key(self.start_id, self.end_id), key)
+
+    def test_key_follows_route_boarding_point_changes(self):
+        key = booking_search_cache_key(self.start_id, self.end_id)
+        self.route.route_boarding_points.remove(self.boarding_points[3])
+        self.assertNotEqual(booking_search_cache_key(self.start_id, self.end_id), key)
+
+
+    def search(self, start_point, end_point):
+        return self.client.get(reverse('booking_search'), {
+            "start_point": start_point, "end_point": end_point}, HTTP_HOST='passenger.lk')
+
+    def test_search_rejects_ids_that_are_not_numbers(self):
+        with mock.patch('busstops.views.booking_search_cache_key') as cache_key:
+            self.assertEqual(self.search("1 OR 1=1", self.end_id).status_code, 400)
+            self.assertEqual(self.search(self.start_id, "").status_code, 400)
+        cache_key.assert_not_called()
+        self.assertEqual(self.search(self.start_id, self.end_id + 1000).status_code, 404)
+
+    def test_first_search_is_not_delayed(self):
+        BusTrip.objects.create(
+            bus=self.bus, route=self.route, start_time=now() + timedelta(days=1))
+        with mock.patch('time.sleep') as sleep:
+            response = self.search(self.start_id, self.end_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+        sleep.assert_not_called()
+
+        # Padded IDs are served the cached results
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.search(f"0{self.start_id}", self.end_id).json(), response.json())
+        self.assertEqual(len(queries), 0)
+
+class SeatMapTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000100")
+        cls.start_point = BoardingPoint.objects.create(name="Start")
+        cls.end_point = BoardingPoint.objects.create(name="End")
+        cls.route = BusRoute.objects.create(name="Colombo - Trincomalee")
+        for position in range(1, 4):
+            Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(hours=1), distance=50)
+        BusFareLuxury.objects.create(fare_number=3, fare_price=2400)
+        cls.bus = Buses.objects.create(
+            bus_name="Eastern", bus_number="EP-1", seat_count=32, bus_type='LUXURY')
+        cls.seat_ids = list(Seat.objects.filter(bus=cls.bus).order_by(
+            'seat_number').values_list('id', flat=True))
+        cls.bus_trip = BusTrip.objects.create(
+            bus=cls.bus, route=cls.route, start_time=now() + timedelta(days=1))
+        for seat_id in cls.seat_ids[:2]:
+            Booking.objects.create(
+                user=cls.user, bus_trip=cls.bus_trip, seat_id=seat_id,
+                start_point=cls.start_point, end_point=cls.end_point)
+
+    def setUp(self):
+        cache.clear()
+        hold_seats(self.bus_trip.id, self.seat_ids[2:3], self.user.id)
+
+    def test_seat_map_marks_booked_and_held_seats(self):
+        seat_map = build_seat_map(self.bus_trip)
+        self.assertEqual(set(seat_map["booked"]), set(self.seat_ids[:2]))
+        self.assertEqual(seat_map["held"], {self.seat_ids[2]})
+        self.assertEqual(encode_seat_map(seat_map, 'rle')["availability"], [0, 3, 29])
+
+        # The holder's own seats stay available to them
+        self.assertEqual(build_seat_map(self.bus_trip, holder_id=self.user.id)["held"], set())
+
+    def test_seat_map_with_points(self):
+        seat_map = build_seat_map(self.bus_trip, include_points=True)
+        self.assertEqual(seat_map["booked"][self.seat_ids[0]], ("Start", "End"))
+
+    def test_booking_information_query_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            seat_details = get_booking_information(self.bus_trip.id)
+        self.assertEqual(seat_details["fee_per_seat"], {"fare_number": 3, "fare_price": 2400})
+        self.assertEqual(
+            [seat_details["seat_availability"][seat_id] for seat_id in self.seat_ids[:4]],
+            ["Not-Available"] * 3 + ["Available"])
+        self.assertLessEqual(len(queries), 5)
+
+
+class BookingSearchFareTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.start_point = BoardingPoint.objects.create(name="Start")
+        cls.end_point = BoardingPoint.objects.create(name="End")
+        cls.routes = []
+        for name, section_count in (("Colombo - Jaffna", 3), ("Colombo - Vavuniya", 2)):
+            route = BusRoute.objects.create(name=name)
+            route.route_boarding_points.set([cls.start_point, cls.end_point])
+            for position in range(1, section_count + 1):
+                section = Section.objects.create(
+                    bus_route=route, name=f"{name} {position}", position=position,
+                    time=timedelta(hours=1), distance=40)
+                if position in (1, section_count):
+                    section.section_boarding_points.set(
+                        [cls.start_point if position == 1 else cls.end_point])
+            cls.routes.append(route)
+        BusFareLuxury.objects.create(fare_number=3, fare_price=3000)
+        BusFareLuxury.objects.create(fare_number=2, fare_price=2000)
+        # No semi-luxury fare for the two-section route
+        BusFareSemiLuxury.objects.create(fare_number=3, fare_price=2500)
+        cls.buses = [
+            Buses.objects.create(
+                bus_name=bus_type, bus_number=f"NP-{index}", seat_count=32, bus_type=bus_type)
+            for index, bus_type in enumerate(('LUXURY', 'SEMI_LUXURY', 'NORMAL'))]
+
+    def setUp(self):
+        cache.clear()
+
+    def add_trips(self, days):
+        for route in self.routes:
+            for bus in self.buses:
+                BusTrip.objects.create(
+                    bus=bus, route=route, start_time=now() + timedelta(days=days))
+
+    def search(self):
+        return build_booking_search_results(self.start_point, self.end_point)["trips"]
+
+    def test_fares_match_the_per_trip_calculation(self):
+        self.add_trips(1)
+        trips = self.search()
+        self.assertEqual(len(trips), 6)
+        for trip in trips:
+            bus_trip = BusTrip.objects.select_related('bus').get(id=trip["bus_trip_id"])
+            expected = {
+                'LUXURY': calculate_luxury_bus_fare,
+                'SEMI_LUXURY': calculate_semi_luxury_bus_fare,
+            }.get(bus_trip.bus.bus_type, lambda _: {"fare_price": 0})(bus_trip.id)
+            self.assertEqual(trip["fare_price"], expected)
+
+        self.assertIn(
+            {"error": "No fare price found for fare number 2."},
+            [trip["fare_price"] for trip in trips])
+
+    def test_fare_queries_do_not_grow_with_the_trips(self):
+        self.add_trips(1)
+        with CaptureQueriesContext(connection) as queries:
+            self.search()
+        query_count = len(queries)
+
+        self.add_trips(2)
+        self.add_trips(3)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self.search()), 18)
+        self.assertEqual(len(queries), query_count)
+
+
+class GridIndexTests(TestCase):
+
+    def setUp(self):
+        # A 20 x 20 grid of points around Colombo, about 1.1 km apart
+        self.points = [(6.8 + row * 0.01, 79.8 + column * 0.01, (row, column))
+                       for row in range(20) for column in range(20)]
+        self.index = GridIndex(self.points)
+
+    def brute_force_nearest(self, latitude, longitude, count):
+        return sorted(
+            (haversine_distance(latitude, longitude, point_latitude, point_longitude), item)
+            for point_latitude, point_longitude, item in self.points)[:count]
+
+    def test_nearest_matches_a_full_scan(self):
+        for latitude, longitude in ((6.9, 79.9), (6.805, 79.995), (7.5, 80.5)):
+            self.assertEqual(self.index.nearest(latitude, longitude, count=7),
+                             self.brute_force_nearest(latitude, longitude, 7))
+
+    def test_nearest_respects_max_distance(self):
+        found = self.index.nearest(6.9, 79.9, count=50, max_distance=1500)
+        self.assertTrue(found)
+        self.assertTrue(all(distance <= 1500 for distance, _ in found))
+        self.assertEqual(self.index.nearest(7.5, 80.5, max_distance=1500), [])
+
+    def test_far_queries_stay_fast(self):
+        started = time.monotonic()
+        for latitude, longitude in ((0, 0), (89.9, 0), (-89.9, 179.9), (89.9, -179.9)):
+            self.assertEqual(self.index.nearest(latitude, longitude, count=3),
+                             self.brute_force_nearest(latitude, longitude, 3))
+            self.assertEqual(self.index.nearest(
+                latitude, longitude, max_distance=50000), [])
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_empty_index(self):
+        self.assertEqual(GridIndex().nearest(6.9, 79.9), [])
+        self.assertEqual(GridIndex().within_bbox(6, 79, 7, 80), [])
+
+    def test_within_bbox(self):
+        self.assertEqual(
+            sorted(self.index.within_bbox(6.845, 79.845, 6.875, 79.865)),
+            [(row, column) for row in range(5, 8) for column in range(5, 7)])
+        self.assertEqual(len(self.index.within_bbox(-90, -180, 90, 180, limit=10)), 10)
+
+    def test_parse_bbox(self):
+        self.assertEqual(parse_bbox("6.8,79.8,7,80"), (6.8, 79.8, 7.0, 80.0))
+        for value in (None, "", "6.8,79.8,7", "7,79.8,6.8,80", "6.8,79.8,91,80", "a,b,c,d"):
+            self.assertIsNone(parse_bbox(value))
+
+
+class NearestBoardingPointsViewTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.fort = BoardingPoint.objects.create(
+            name="Fort", latitude=6.9344, longitude=79.8428)
+        cls.pettah = BoardingPoint.objects.create(
+            name="Pettah", latitude=6.9366, longitude=79.8500)
+        cls.kandy = BoardingPoint.objects.create(
+            name="Kandy", latitude=7.2906, longitude=80.6337)
+
+    def setUp(self):
+        cache.clear()
+
+    def get_nearest(self, **params):
+        return self.client.get(reverse('nearest_boarding_points'), params,
+                               HTTP_HOST='passenger.lk')
+
+    def test_nearest_boarding_points(self):
+        response = self.get_nearest(latitude=6.935, longitude=79.845, limit=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([boarding_point["name"] for boarding_point in response.data["boarding_points"]],
+                         ["Fort", "Pettah"])
+
+    def test_search_distance_is_capped(self):
+        response = self.get_nearest(latitude=0, longitude=0, max_distance=10 ** 9)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["boarding_points"], [])
+
+        # Kandy is about 95 km from Fort, out of the default reach
+        response = self.get_nearest(latitude=6.9344, longitude=79.8428, limit=5)
+        self.assertEqual([boarding_point["name"] for boarding_point in response.data["boarding_points"]],
+                         ["Fort", "Pettah"])
+
+    def test_invalid_parameters(self):
+        for params in ({"latitude": 6.9}, {"latitude": 91, "longitude": 79.8},
+                       {"latitude": 6.9, "longitude": 79.8, "max_distance": "nan"},
+                       {"latitude": 6.9, "longitude": 79.8, "max_distance": -1}):
+            self.assertEqual(self.get_nearest(**params).status_code, 400)
+
+
+class AutocompleteIndexTests(TestCase):
+
+    def setUp(self):
+        self.index = AutocompleteIndex(popularity={2: 10, 3: 5})
+        for boarding_point in (
+                {"id": 1, "name": "Kandy Clock Tower", "city": "Kandy", "province": "Central"},
+                {"id": 2, "name": "Peradeniya", "city": "Kandy", "province": "Central"},
+                {"id": 3, "name": "Katugastota", "city": "Kandy", "province": "Central"},
+                {"id": 4, "name": "Colombo Fort", "city": "Colombo", "province": "Western"},
+                {"id": 5, "name": "Kandana", "city": "Gampaha", "province": "Western"}):
+            self.index.add(boarding_point)
+
+    def search_ids(self, query, limit=10):
+        return [boarding_point["id"] for boarding_point in self.index.search(query, limit)]
+
+    def test_name_matches_rank_above_city_matches(self):
+        # Then the most booked first, then by name
+        self.assertEqual(self.search_ids("kand"), [5, 1, 2, 3])
+        self.assertEqual(self.search_ids("kand", limit=2), [5, 1])
+        # Typo matches ("kanda" of Kandana) come last
+        self.assertEqual(self.search_ids("kandy"), [1, 2, 3, 5])
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.search_ids("fort col"), [4])
+        self.assertEqual(self.search_ids("colombo kandy"), [])
+        self.assertEqual(self.search_ids("  "), [])
+
+    def test_typos(self):
+        self.assertEqual(self.search_ids("colmbo"), [4])
+        self.assertEqual(self.search_ids("peradenya"), [2])
+        # Short terms must match exactly
+        self.assertEqual(self.search_ids("fot"), [])
+
+    def test_add_and_remove(self):
+        self.index.remove(4)
+        self.assertEqual(self.search_ids("colombo"), [])
+        self.index.add({"id": 4, "name": "Fort Railway Station", "city": "Colombo",
+                        "province": "Western"})
+        self.assertEqual(self.search_ids("railway"), [4])
+
+        # Renaming drops the old tokens
+        self.index.add({"id": 4, "name": "Pettah", "city": "Colombo", "province": "Western"})
+        self.assertEqual(self.search_ids("railway"), [])
+        self.assertEqual(self.search_ids("pettah"), [4])
+
+
+class AutocompleteTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000300")
+        cls.galle = BoardingPoint.objects.create(name="Galle Bus Stand", city="Galle")
+        cls.gampaha = BoardingPoint.objects.create(name="Gampaha", city="Gampaha")
+        cls.galkissa = BoardingPoint.objects.create(name="Galkissa", city="Colombo")
+        route = BusRoute.objects.create(name="Galle - Colombo")
+        bus = Buses.objects.create(bus_name="Southern", bus_number="SP-1", seat_count=40)
+        bus_trip = BusTrip.objects.create(
+            bus=bus, route=route, start_time=now() + timedelta(days=1))
+        Booking.objects.create(
+            user=cls.user, bus_trip=bus_trip, seat=Seat.objects.filter(bus=bus).first(),
+            start_point=cls.galkissa, end_point=cls.galle)
+
+    def setUp(self):
+        cache.clear()
+        autocomplete._autocomplete.update(version=None, index=None, built_at=None)
+
+    def test_booked_points_rank_first(self):
+        self.assertEqual([boarding_point["name"] for boarding_point in autocomplete_boarding_points("gal")],
+                         ["Galkissa", "Galle Bus Stand"])
+
+    def test_edits_are_replayed_without_a_rebuild(self):
+        autocomplete_boarding_points("gal")
+        with mock.patch.object(autocomplete, 'build_autocomplete_index',
+                               wraps=autocomplete.build_autocomplete_index) as build:
+            galle_fort = BoardingPoint.objects.create(name="Galle Fort", city="Galle")
+            self.gampaha.delete()
+            self.assertIn(galle_fort.id, [
+                boarding_point["id"] for boarding_point in autocomplete_boarding_points("galle")])
+            self.assertEqual(autocomplete_boarding_points("gampaha"), [])
+        build.assert_not_called()
+
+    def test_missing_changes_trigger_a_rebuild(self):
+        autocomplete_boarding_points("gal")
+        BoardingPoint.objects.create(name="Galle Fort", city="Galle")
+        cache.delete(autocomplete.autocomplete_change_key(cache.get(autocomplete.AUTOCOMPLETE_VERSION_KEY)))
+        with mock.patch.object(autocomplete, 'build_autocomplete_index',
+                               wraps=autocomplete.build_autocomplete_index) as build:
+            self.assertEqual(len(autocomplete_boarding_points("galle")), 2)
+        build.assert_called_once()
+
+    def test_suggestions_view(self):
+        response = self.client.get(reverse('get_suggestions'), {"term": "gamp"},
+                                   HTTP_HOST='passenger.lk')
+        self.assertEqual([boarding_point["id"] for boarding_point in response.json()],
+                         [self.gampaha.id])
+        response = self.client.get(reverse('get_suggestions'), HTTP_HOST='passenger.lk')
+        self.assertEqual(response.json(), [])
+
+
+class SearchWarmupTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.boarding_points = [
+            BoardingPoint.objects.create(name=f"Stop {i}") for i in range(4)]
+        cls.route = BusRoute.objects.create(name="Colombo - Matara")
+        cls.route.route_boarding_points.set(cls.boarding_points)
+        for position in range(1, 3):
+            section = Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(minutes=30), distance=10)
+            section.section_boarding_points.set(
+                cls.boarding_points[2 * position - 2:2 * position])
+        cls.bus = Buses.objects.create(
+            bus_name="Southern Express", bus_number="SP-2", seat_count=40)
+        cls.bus_trip = BusTrip.objects.create(
+            bus=cls.bus, route=cls.route, start_time=now() + timedelta(days=1))
+
+    def setUp(self):
+        cache.clear()
+        self.start_id = self.boarding_points[0].id
+        self.end_id = self.boarding_points[3].id
+
+    def test_popularity_counters(self):
+        for _ in range(3):
+            record_booking_search(self.start_id, self.end_id)
+        record_booking_search(str(self.end_id), str(self.start_id))
+        self.assertEqual(get_popular_searches(), [
+            (self.start_id, self.end_id, 3), (self.end_id, self.start_id, 1)])
+        self.assertEqual(get_popular_searches(limit=1), [(self.start_id, self.end_id, 3)])
+
+        # Pairs nobody searches anymore are dropped
+        decay_search_popularity()
+        self.assertEqual(get_popular_searches(), [
+            (self.start_id, self.end_id, 1.5), (self.end_id, self.start_id, 0.5)])
+        decay_search_popularity()
+        self.assertEqual(get_popular_searches(), [(self.start_id, self.end_id, 0.75)])
+
+    def test_record_never_raises(self):
+        with self.assertLogs('busstops.search_cache', 'ERROR'):
+            record_booking_search("not-an-id", self.end_id)
+        self.assertEqual(get_popular_searches(), [])
+
+    def test_warm_booking_search(self):
+        self.assertTrue(warm_booking_search(self.start_id, self.end_id))
+        cached = cache.get(booking_search_cache_key(self.start_id, self.end_id))
+        self.assertEqual([trip["bus_trip_id"] for trip in cached["trips"]], [self.bus_trip.id])
+
+        # Cached results are left alone unless refreshed
+        self.assertFalse(warm_booking_search(self.start_id, self.end_id))
+        self.assertTrue(warm_booking_search(self.start_id, self.end_id, refresh=True))
+        self.assertFalse(warm_booking_search(self.start_id, 0))
+
+    def test_warm_popular_searches(self):
+        record_booking_search(self.start_id, self.end_id)
+        record_booking_search(self.boarding_points[1].id, self.end_id)
+        with mock.patch('busstops.warmup.build_booking_search_results',
+                        side_effect=[RuntimeError, {"trips": [], "free_seat_ids": {}}]):
+            with self.assertLogs('busstops.warmup', 'ERROR'):
+                self.assertEqual(warm_popular_searches(), 1)
+
+        # Only invalidated results are recomputed
+        self.assertEqual(warm_popular_searches(), 1)
+        self.assertEqual(warm_popular_searches(), 0)
+        self.bus_trip.save()
+        self.assertEqual(warm_popular_searches(), 2)
+
+    def test_warm_booking_searches_command(self):
+        record_booking_search(self.start_id, self.end_id)
+        stdout = StringIO()
+        call_command('warm_booking_searches', stdout=stdout)
+        self.assertIn("Warmed 1 booking searches.", stdout.getvalue())
+        self.assertIsNotNone(cache.get(booking_search_cache_key(self.start_id, self.end_id)))
+
+
+class BookingSearchRebuildTests(TestCase):
+
+    cache_key = "booking_search_1_2_test"
+    lock_key = "booking_search_1_2_test_lock"
+
+    def setUp(self):
+        cache.clear()
+        self.compute = mock.Mock(return_value={"trips": [], "free_seat_ids": {}})
+
+    def get_or_rebuild(self):
+        return get_or_rebuild_booking_search(self.cache_key, 1, 2, self.compute)
+
+    def test_rebuild_stores_fresh_and_stale_results(self):
+        self.assertEqual(self.get_or_rebuild(), (self.compute.return_value, True))
+        self.assertEqual(cache.get(self.cache_key), self.compute.return_value)
+        self.assertEqual(cache.get(booking_search_stale_key(1, 2)), self.compute.return_value)
+        self.assertIsNone(cache.get(self.lock_key))
+
+    def test_failed_rebuild_releases_the_lock(self):
+        self.compute.side_effect = RuntimeError
+        with self.assertRaises(RuntimeError):
+            rebuild_booking_search(self.cache_key, 1, 2, self.compute)
+        self.assertIsNone(cache.get(self.lock_key))
+
+    def test_expired_lock_taken_over_is_kept(self):
+        def take_over():
+            cache.set(self.lock_key, "other worker")
+            return {"trips": []}
+
+        rebuild_booking_search(self.cache_key, 1, 2, take_over)
+        self.assertEqual(cache.get(self.lock_key), "other worker")
+
+    def test_stale_results_served_during_a_rebuild(self):
+        cache.set(booking_search_stale_key(1, 2), {"trips": ["stale"]})
+        cache.set(self.lock_key, "other worker")
+        self.assertEqual(self.get_or_rebuild(), ({"trips": ["stale"]}, False))
+        self.compute.assert_not_called()
+
+    def test_first_search_waits_for_the_rebuild(self):
+        cache.set(self.lock_key, "other worker")
+        with mock.patch('busstops.search_cache.time.sleep',
+                        side_effect=lambda _: cache.set(self.cache_key, {"trips": ["rebuilt"]})):
+            self.assertEqual(self.get_or_rebuild(), ({"trips": ["rebuilt"]}, False))
+        self.compute.assert_not_called()
+
+    def test_first_search_computes_when_the_rebuild_gives_up(self):
+        cache.set(self.lock_key, "other worker")
+        with mock.patch('busstops.search_cache.time.sleep',
+                        side_effect=lambda _: cache.delete(self.lock_key)):
+            self.assertEqual(self.get_or_rebuild(), (self.compute.return_value, True))
+
+        # Or when the wait runs out
+        cache.clear()
+        cache.set(self.lock_key, "other worker")
+        with mock.patch('busstops.search_cache.BOOKING_SEARCH_LOCK_WAIT', 0):
+            self.assertEqual(self.get_or_rebuild(), (self.compute.return_value, True))
+        self.assertEqual(self.compute.call_count, 2)
+
+
+class SeatOccupancyTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000600")
+        cls.other_user = User.objects.create(phone_number="0770000601")
+        # One stop per section: A(1) B(2) C(3) D(4)
+        cls.stops = [BoardingPoint.objects.create(name=name) for name in "ABCD"]
+        cls.route = BusRoute.objects.create(name="Colombo - Badulla")
+        cls.route.route_boarding_points.set(cls.stops)
+        for position, stop in enumerate(cls.stops, 1):
+            section = Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(minutes=30), distance=10)
+            section.section_boarding_points.set([stop])
+        cls.bus = Buses.objects.create(bus_name="Uva", bus_number="UP-2", seat_count=32)
+        cls.seat_ids = list(Seat.objects.filter(bus=cls.bus).order_by(
+            'seat_number').values_list('id', flat=True))
+        # Running, so it can be booked instantly
+        cls.bus_trip = BusTrip.objects.create(
+            bus=cls.bus, route=cls.route, start_time=now() - timedelta(minutes=10))
+
+        a, b, c, d = cls.stops
+        for seat_id, start, end, booking_status in (
+                (cls.seat_ids[0], a, b, 'BOOKED'),
+                (cls.seat_ids[1], b, d, 'BOOKED'),
+                (cls.seat_ids[2], a, d, 'BOOKING_CANCELED'),
+                (cls.seat_ids[5], d, b, 'BOOKED')):  # Stored reversed
+            Booking.objects.create(
+                user=cls.user, bus_trip=cls.bus_trip, seat_id=seat_id,
+                start_point=start, end_point=end, booking_status=booking_status)
+
+    def setUp(self):
+        cache.clear()
+        hold_seats(self.bus_trip.id, [self.seat_ids[3]], self.other_user.id)
+        hold_seats(self.bus_trip.id, [self.seat_ids[4]], self.user.id)
+
+    def taken(self, start, end, holder_id=None):
+        available = get_available_seats_for_instant_booking(
+            [self.bus_trip], self.stops[start], self.stops[end], holder_id)[self.bus_trip.id]
+        return {index for index in range(8) if self.seat_ids[index] not in available}
+
+    def test_segment_mask(self):
+        self.assertEqual(segment_mask(1, 3), 0b0110)
+        self.assertEqual(segment_mask(3, 1), 0b0110)
+        self.assertEqual(segment_mask(2, 2), 0)
+
+    def test_overlapping_segments_take_the_seat(self):
+        # B -> C overlaps B -> D and the reversed D -> B, not the adjacent A -> B
+        self.assertEqual(self.taken(1, 2), {1, 3, 4, 5})
+        # A -> B overlaps A -> B only, B -> D starts where it ends
+        self.assertEqual(self.taken(0, 1), {0, 3, 4})
+        self.assertEqual(self.taken(0, 3), {0, 1, 3, 4, 5})
+
+    def test_own_holds_stay_available(self):
+        self.assertEqual(self.taken(1, 2, holder_id=self.user.id), {1, 3, 5})
+        self.assertEqual(self.taken(1, 2, holder_id=self.other_user.id), {1, 4, 5})
+
+    def test_instant_booking_search(self):
+        def available_seats(user):
+            self.client.force_authenticate(user)
+            response = self.client.get(reverse('instant_booking_search'), {
+                "start_point": self.stops[1].id, "end_point": self.stops[2].id,
+            }, HTTP_HOST='passenger.lk')
+            self.assertEqual(response.status_code, 200)
+            return response.json()[0]["available_seats"]
+
+        self.assertEqual(available_seats(self.user), 29)
+        self.assertEqual(available_seats(self.other_user), 29)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(reverse('instant_booking_search'), {
+            "start_point": self.stops[1].id, "end_point": self.stops[2].id,
+        }, HTTP_HOST='passenger.lk').json()[0]["available_seats"], 28)
+
+
+class RouteStopPositionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # Sections: 1 = [A, B], 2 = [B, C], 3 = [D]; B is shared by sections 1 and 2
+        cls.a, cls.b, cls.c, cls.d = [
+            BoardingPoint.objects.create(name=name) for name in "ABCD"]
+        cls.route = BusRoute.objects.create(name="Negombo - Chilaw")
+        cls.route.route_boarding_points.set([cls.a, cls.b, cls.c, cls.d])
+        cls.sections = []
+        for position, stops in enumerate(([cls.a, cls.b], [cls.b, cls.c], [cls.d]), 1):
+            section = Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(minutes=20), distance=8)
+            section.section_boarding_points.set(stops)
+            cls.sections.append(section)
+
+    def positions(self):
+        return dict(RouteStopPosition.objects.filter(
+            bus_route=self.route).values_list('boarding_point_id', 'position'))
+
+    def matches(self, start_point, end_point):
+        return get_matched_route_ids(start_point, end_point).filter(bus_route=self.route).exists()
+
+    def test_shared_stop_takes_its_lowest_section(self):
+        self.assertEqual(self.positions(), {
+            self.a.id: 1, self.b.id: 1, self.c.id: 2, self.d.id: 3})
+
+    def test_rebuild_restores_the_index(self):
+        RouteStopPosition.objects.filter(bus_route=self.route).delete()
+        rebuild_route_stop_positions(self.route.id)
+        self.assertEqual(self.positions(), {
+            self.a.id: 1, self.b.id: 1, self.c.id: 2, self.d.id: 3})
+
+    def test_start_must_come_before_end(self):
+        self.assertTrue(self.matches(self.a, self.c))
+        self.assertTrue(self.matches(self.b, self.d))
+        # Reversed direction
+        self.assertFalse(self.matches(self.c, self.a))
+        self.assertFalse(self.matches(self.d, self.b))
+        # Same section
+        self.assertFalse(self.matches(self.a, self.b))
+
+    def test_both_stops_must_be_route_boarding_points(self):
+        self.route.route_boarding_points.remove(self.d)
+        self.assertFalse(self.matches(self.a, self.d))
+
+    def test_section_save_rebuilds_the_index(self):
+        section = self.sections[2]
+        section.position = 4
+        section.save()
+        self.assertEqual(self.positions()[self.d.id], 4)
+
+    def test_section_delete_rebuilds_the_index(self):
+        self.sections[0].delete()
+        self.assertEqual(self.positions(), {self.b.id: 2, self.c.id: 2, self.d.id: 3})
+        self.assertFalse(self.matches(self.a, self.c))
+
+    def test_section_boarding_point_changes_rebuild_the_index(self):
+        self.sections[0].section_boarding_points.remove(self.b)
+        self.assertEqual(self.positions()[self.b.id], 2)
+
+        self.sections[2].section_boarding_points.add(self.a)
+        self.assertEqual(self.positions()[self.a.id], 1)
+
+        self.sections[1].section_boarding_points.clear()
+        self.assertEqual(self.positions(), {self.a.id: 1, self.d.id: 3})
+
+    def test_boarding_point_side_changes_rebuild_the_index(self):
+        self.c.section.add(self.sections[2])
+        self.assertEqual(self.positions()[self.c.id], 2)
+        self.c.section.remove(self.sections[1])
+        self.assertEqual(self.positions()[self.c.id], 3)
+
+        self.d.section.clear()
+        self.assertNotIn(self.d.id, self.positions())
+        self.assertFalse(self.matches(self.a, self.d))
+
+
+@override_settings(TIME_ZONE='Asia/Colombo')
+class BusyTimeTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.route = BusRoute.objects.create(name="Colombo - Ratnapura")
+        for position in range(1, 3):
+            Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(hours=1), busy_time=timedelta(hours=1, minutes=30), distance=40)
+        cls.bus = Buses.objects.create(
+            bus_name="Sabaragamuwa", bus_number="SG-1", seat_count=40)
+
+    def local_time(self, hour, minute=0):
+        """Tomorrow at the given Colombo time, in UTC as read from the database."""
+        tomorrow = localtime(now()).date() + timedelta(days=1)
+        return datetime(tomorrow.year, tomorrow.month, tomorrow.day, hour, minute,
+                        tzinfo=ZoneInfo('Asia/Colombo')).astimezone(dt_timezone.utc)
+
+    def create_trip(self, start_time):
+        return BusTrip.objects.create(bus=self.bus, route=self.route, start_time=start_time)
+
+    def test_busy_windows_are_in_local_time(self):
+        # 07:30 in Colombo is 02:00 UTC, 22:30 in Colombo is 17:00 UTC
+        self.assertTrue(is_global_busy_time(self.local_time(7, 30)))
+        self.assertTrue(is_global_busy_time(self.local_time(14)))
+        self.assertTrue(is_global_busy_time(self.local_time(18)))
+        self.assertFalse(is_global_busy_time(self.local_time(22, 30)))
+        self.assertFalse(is_global_busy_time(self.local_time(11)))
+
+    def test_trip_crossing_a_busy_window_is_delayed(self):
+        # Reaches the second section at 07:00, the start of the morning rush
+        bus_trip = self.create_trip(self.local_time(6))
+        self.assertEqual(bus_trip.timetable, {"1": 0, "2": 3600})
+        self.assertEqual(bus_trip.end_time - bus_trip.start_time, timedelta(hours=2, minutes=30))
+
+    def test_trip_outside_the_busy_windows_is_not_delayed(self):
+        # 22:30 - 00:30 local, 17:00 - 19:00 UTC
+        bus_trip = self.create_trip(self.local_time(22, 30))
+        self.assertEqual(bus_trip.timetable, {"1": 0, "2": 3600})
+        self.assertEqual(bus_trip.end_time - bus_trip.start_time, timedelta(hours=2))
+
+    def test_rebuild_trip_timetables(self):
+        bus_trip = self.create_trip(self.local_time(6))
+        # Built while busy windows were compared in UTC
+        BusTrip.objects.filter(id=bus_trip.id).update(
+            end_time=bus_trip.start_time + timedelta(hours=2))
+
+        out = StringIO()
+        call_command('rebuild_trip_timetables', stdout=out)
+        self.assertIn("1 routes", out.getvalue())
+        bus_trip.refresh_from_db()
+        self.assertEqual(bus_trip.end_time - bus_trip.start_time, timedelta(hours=2, minutes=30))
@@ -1,155 +1,281 @@
+from collections import defaultdict
 from datetime import timedelta, time
-from django.utils.timezone import now
-from booking.models import BusTrip, Booking
-from .models import BusRoute
+from django.db import transaction
+from django.db.models import F, Max, Min, Q
+from django.utils.timezone import now, localtime, is_naive
+from booking.models import BusTrip, Booking, CANCELED_BOOKING_STATUSES
+from booking.seat_holds import get_seat_holds
+from .models import Seat, Section, RouteStopPosition
+from .seat_map import build_seat_map, encode_seat_map, seat_availability_bits
 from .models import BusFareLuxury, BusFareSemiLuxury
 
 
-def bus_booking_search(start_point, end_point):
-
-    both_start_and_end_included_routes = BusRoute.objects.filter(
-        route_boarding_points=start_point).filter(route_boarding_points=end_point)
+def rebuild_route_stop_positions(route_id):
+    """
+    Recompute the RouteStopPosition rows of a route from its sections.
+    Each boarding point is mapped to the lowest section position that serves it.
+    """
+    from .search_cache import clear_matched_routes
+
+    through = Section.section_boarding_points.through
+    positions = through.objects.filter(
+        section__bus_route_id=route_id
+    ).values('boardingpoint_id').annotate(position=Min('section__position'))
+
+    with transaction.atomic():
+        RouteStopPosition.objects.filter(bus_route_id=route_id).delete()
+        RouteStopPosition.objects.bulk_create([
+            RouteStopPosition(
+                bus_route_id=route_id,
+                boarding_point_id=row['boardingpoint_id'],
+                position=row['position'],
+            )
+            for row in positions
+        ])
+        transaction.on_commit(clear_matched_routes)
+
+
+def get_matched_route_ids(start_point, end_point):
+    """
+    Routes that serve both boarding points with the start section placed
+    before the end section, resolved as a single join on RouteStopPosition.
+    Returns a values queryset usable as a subquery.
+    """
+    return RouteStopPosition.objects.filter(
+        boarding_point=end_point,
+        bus_route__stop_positions__boarding_point=start_point,
+        position__gt=F('bus_route__stop_positions__position'),
+        bus_route__route_boarding_points=start_point,
+    ).filter(
+        bus_route__route_boarding_points=end_point
+    ).values('bus_route_id')
 
-    matched_routes = []
-    for route in both_start_and_end_included_routes:
-        sections = route.sections.all()
 
-        start_section = sections.filter(
-            section_boarding_points=start_point).first()
-        end_section = sections.filter(
-            section_boarding_points=end_point).first()
+def bus_booking_search(start_point, end_point):
 
-        if start_section and end_section:
-            # Ensure the position of the start section is less than the end section
-            if start_section.position < end_section.position:
-                matched_routes.append(route)
+    matched_routes = get_matched_route_ids(start_point, end_point)
 
     current_time = now()
 
-    soon_or_started_trips = BusTrip.objects.filter(
-        start_time__lte=current_time + timedelta(minutes=30)
+    # Trips starting within the next 30 minutes (or already started) are not bookable
+    bookable_trips_for_user = BusTrip.objects.filter(
+        start_time__gt=current_time + timedelta(minutes=30),
+        route_id__in=matched_routes
     )
 
-    bookable_trips = BusTrip.objects.exclude(
-        id__in=soon_or_started_trips.values_list('id', flat=True)
-    )
-
-    bookable_trips_for_user = bookable_trips.filter(route__in=matched_routes)
-
     return bookable_trips_for_user
 
 
 def bus_instant_booking_search(start_point, end_point):
 
-    both_start_and_end_included_routes = BusRoute.objects.filter(
-        route_boarding_points=start_point).filter(route_boarding_points=end_point)
+    matched_routes = get_matched_route_ids(start_point, end_point)
 
-    matched_routes = []
-    for route in both_start_and_end_included_routes:
-        sections = route.sections.all()
+    current_time = now()
 
-        start_section = sections.filter(
-            section_boarding_points=start_point).first()
-        end_section = sections.filter(
-            section_boarding_points=end_point).first()
+    # Only trips that have already started can be instantly booked
+    bookable_trips_for_user = BusTrip.objects.filter(
+        start_time__lt=current_time,
+        route_id__in=matched_routes
+    )
 
-        if start_section and end_section:
-            # Ensure the position of the start section is less than the end section
-            if start_section.position < end_section.position:
-                matched_routes.append(route)
+    return bookable_trips_for_user
 
-    current_time = now()
 
-    started_trips = BusTrip.objects.filter(
-        start_time__gte=current_time)
+def get_seats_by_bus(bus_ids):
+    """
+    All seats of the given buses as (seat_id, seat_number) pairs ordered by
+    seat number, keyed by bus ID.
+    """
+    seats_by_bus = defaultdict(list)
+    seat_rows = Seat.objects.filter(
+        bus_id__in=bus_ids
+    ).order_by('seat_number').values_list('bus_id', 'id', 'seat_number')
+    for bus_id, seat_id, seat_number in seat_rows:
+        seats_by_bus[bus_id].append((seat_id, seat_number))
+
+    return seats_by_bus
+
 
-    bookable_trips = BusTrip.objects.exclude(
-        id__in=started_trips.values_list('id', flat=True)
+def segment_mask(start_pos, end_pos):
+    """
+    Bitmask of the section positions a journey occupies: every position from
+    start_pos up to, but not including, end_pos. Reversed positions cover the
+    same span, so they can never hide a taken seat.
+    """
+    start_pos, end_pos = sorted((start_pos, end_pos))
+    return ((1 << end_pos) - 1) ^ ((1 << start_pos) - 1)
+
+
+def get_seat_occupancy(trips, holder_id=None):
+    """
+    Build a per-seat occupancy bitmap over the section positions of each trip.
+    Uses three queries for the whole batch: seats, active bookings and the
+    stop positions of the trips' routes. Seats held during checkout by
+    another user than holder_id are marked as taken for the whole route.
+
+    Returns a dictionary keyed by trip ID:
+        {
+            "seats": [(seat_id, seat_number), ...],
+            "occupancy": {seat_id: bitmask, ...},  # only seats with bookings
+            "positions": {boarding_point_id: position, ...}
+        }
+    """
+    trips = list(trips)
+    if not trips:
+        return {}
+
+    seats_by_bus = get_seats_by_bus({trip.bus_id for trip in trips})
+
+    positions_by_route = defaultdict(dict)
+    position_rows = RouteStopPosition.objects.filter(
+        bus_route_id__in={trip.route_id for trip in trips}
+    ).values_list('bus_route_id', 'boarding_point_id', 'position')
+    for route_id, boarding_point_id, position in position_rows:
+        positions_by_route[route_id][boarding_point_id] = position
+
+    bookings_by_trip = defaultdict(list)
+    booking_rows = Booking.objects.filter(
+        bus_trip_id__in=[trip.id for trip in trips]
+    ).exclude(
+        booking_status__in=CANCELED_BOOKING_STATUSES
+    ).values_list('bus_trip_id', 'seat_id', 'start_point_id', 'end_point_id')
+    for trip_id, seat_id, start_point_id, end_point_id in booking_rows:
+        bookings_by_trip[trip_id].append(
+            (seat_id, start_point_id, end_point_id))
+
+    held_seats = get_seat_holds(
+        (trip.id, seat_id)
+        for trip in trips
+        for seat_id, _ in seats_by_bus.get(trip.bus_id, [])
     )
 
-    bookable_trips_for_user = bookable_trips.filter(route__in=matched_routes)
+    occupancy_by_trip = {}
+    for trip in trips:
+        positions = positions_by_route.get(trip.route_id, {})
+        occupancy = defaultdict(int)
+
+        # Seats held during checkout are taken for the whole route
+        for seat_id, _ in seats_by_bus.get(trip.bus_id, []):
+            if held_seats.get((trip.id, seat_id), holder_id) != holder_id:
+                occupancy[seat_id] = ~0
+
+        for seat_id, start_point_id, end_point_id in bookings_by_trip.get(trip.id, []):
+            start_pos = positions.get(start_point_id)
+            end_pos = positions.get(end_point_id)
+            if start_pos is None or end_pos is None:
+                # Boarding point no longer on the route: treat the seat as taken end to end
+                occupancy[seat_id] = ~0
+            else:
+                occupancy[seat_id] |= segment_mask(start_pos, end_pos)
 
-    return bookable_trips_for_user
+        occupancy_by_trip[trip.id] = {
+            "seats": seats_by_bus.get(trip.bus_id, []),
+            "occupancy": dict(occupancy),
+            "positions": positions,
+        }
 
+    return occupancy_by_trip
 
-def get_available_seats_for_instant_booking(bookable_trips_for_user, start_point, end_point):
+
+def get_available_seats_for_instant_booking(bookable_trips_for_user, start_point, end_point, holder_id=None):
+    """
+    Returns the seat IDs of every trip that are free for the whole journey
+    from start_point to end_point, keyed by trip ID.
+    A seat is free when its occupancy bitmap does not overlap the journey's bitmap.
+    Seats held by holder_id stay free for them.
+    """
+    occupancy_by_trip = get_seat_occupancy(bookable_trips_for_user, holder_id)
 
     available_seats = {}
- # checking the trip one by one in a for loop
-    for trip in bookable_trips_for_user:
-        # get all the seats of the current checking trip
-        all_seats = trip.bus.seats.all()
-        # get all the bookings of the current checking trip
-        bookings = Booking.objects.filter(bus_trip=trip)
-
-        # get all the sections of the current checking trip
-        sections = trip.route.sections.all()
-
-        # get the user's start section of the current checking trip
-        user_start_section = sections.filter(
-            section_boarding_points=start_point).first()
-
-        # get the user's end section of the current checking trip
-        user_end_section = sections.filter(
-            section_boarding_points=end_point).first()
-
-        # get the user's inputed start and end section's position numbers
-        user_start_pos = user_start_section.position
-        user_end_pos = user_end_section.position
-
-        # Step 4: Check availability for each seat
-        trip_available_seats = []
-
-        # run a for loop to check all the seats in the current trip
-        for seat in all_seats:
-            # Check if the seat is unbooked
-            seat_bookings = bookings.filter(seat=seat)
-            if not seat_bookings.exists():
-                trip_available_seats.append(seat)
-                continue
-
-            is_available = True
-            for booking in seat_bookings:
-                # Get section positions for this booking
-                booking_start_section = sections.filter(
-                    section_boarding_points=booking.start_point).first()
-                booking_end_section = sections.filter(
-                    section_boarding_points=booking.end_point).first()
-
-                booking_start_pos = booking_start_section.position
-                booking_end_pos = booking_end_section.position
-
-                if not (user_end_pos <= booking_start_pos or user_start_pos >= booking_end_pos):
-                    is_available = False
-                    break
-
-            if is_available:
-                trip_available_seats.append(seat)
-
-        available_seats[trip.id] = trip_available_seats
+    for trip_id, trip_occupancy in occupancy_by_trip.items():
+        positions = trip_occupancy["positions"]
+        journey_mask = segment_mask(
+            positions.get(start_point.id, 0), positions.get(end_point.id, 0))
+        occupancy = trip_occupancy["occupancy"]
+
+        available_seats[trip_id] = [
+            seat_id for seat_id, _ in trip_occupancy["seats"]
+            if not occupancy.get(seat_id, 0) & journey_mask
+        ]
 
     return available_seats
 
 
-def get_available_seats_for_booking(bookable_trips_for_user):
-
-    available_seat_count = {}
+def get_seat_availability(trips, holder_id=None, include_holds=True):
+    """
+    Seat availability engine: computes free seats for a batch of trips with two
+    aggregate queries (seats grouped by bus, active bookings grouped by trip)
+    and one cache round-trip for seat holds.
+    Seats held by another user count as unavailable; holds of holder_id do not.
+    Without include_holds only bookings are taken into account (for results
+    that outlive the holds, see apply_seat_holds).
+
+    Returns a dictionary keyed by trip ID:
+        {
+            "seats": [(seat_id, seat_number), ...],  # ordered by seat number
+            "booked_seat_ids": {seat_id, ...},
+            "held_seat_ids": {seat_id, ...},
+            "available_seat_ids": [seat_id, ...],
+            "available_count": int
+        }
+    """
+    trips = list(trips)
+    if not trips:
+        return {}
+
+    seats_by_bus = get_seats_by_bus({trip.bus_id for trip in trips})
+
+    booked_by_trip = defaultdict(set)
+    booking_rows = Booking.objects.filter(
+        bus_trip_id__in=[trip.id for trip in trips]
+    ).exclude(
+        booking_status__in=CANCELED_BOOKING_STATUSES
+    ).values_list('bus_trip_id', 'seat_id')
+    for trip_id, seat_id in booking_rows:
+        booked_by_trip[trip_id].add(seat_id)
+
+    held_by_trip = defaultdict(set)
+    seat_holds = get_seat_holds(
+        (trip.id, seat_id)
+        for trip in trips
+        for seat_id, _ in seats_by_bus.get(trip.bus_id, [])
+        if seat_id not in booked_by_trip.get(trip.id, ())
+    ) if include_holds else {}
+    for (trip_id, seat_id), user_id in seat_holds.items():
+        if user_id != holder_id:
+            held_by_trip[trip_id].add(seat_id)
+
+    availability = {}
+    for trip in trips:
+        seats = seats_by_bus.get(trip.bus_id, [])
+        booked_seat_ids = booked_by_trip.get(trip.id, set())
+        held_seat_ids = held_by_trip.get(trip.id, set())
+        available_seat_ids = [
+            seat_id for seat_id, _ in seats
+            if seat_id not in booked_seat_ids and seat_id not in held_seat_ids
+        ]
+        availability[trip.id] = {
+            "seats": seats,
+            "booked_seat_ids": booked_seat_ids,
+            "held_seat_ids": held_seat_ids,
+            "available_seat_ids": available_seat_ids,
+            "available_count": len(available_seat_ids),
+        }
 
-    for trip in bookable_trips_for_user:
-        # Get all seats of the bus associated with this trip
-        all_seats = trip.bus.seats.all()
+    return availability
 
-        # Get all bookings for this specific trip
-        bookings = Booking.objects.filter(bus_trip=trip)
 
-        # Calculate available seats
-        available_seats = [
-            seat for seat in all_seats if not bookings.filter(seat=seat).exists()
-        ]
-        # Store the available seat count for the current trip
-        available_seat_count[trip.id] = available_seats
+def get_available_seats_for_booking(bookable_trips_for_user, include_holds=True):
+    """
+    Returns the available seat IDs of every trip, keyed by trip ID.
+    """
+    availability = get_seat_availability(
+        bookable_trips_for_user, include_holds=include_holds)
 
-    return available_seat_count
+    return {
+        trip_id: trip_availability["available_seat_ids"]
+        for trip_id, trip_availability in availability.items()
+    }
 
 
 # ✅ Define Global Busy Time Ranges
@@ -164,6 +290,9 @@ def is_global_busy_time(estimated_time):
     """
     Checks if the estimated time falls within any of the global busy time ranges.
     """
+    # Busy time ranges are in local time, compare against the local clock
+    if not is_naive(estimated_time):
+        estimated_time = localtime(estimated_time)
     current_time = estimated_time.time()
     for busy_start, busy_end in BUSY_TIME_RANGES:
         if busy_start <= current_time <= busy_end:
@@ -210,6 +339,132 @@ def calculate_rough_arrival_time(bus_trip_start_time, sections, target_section):
 '''
 
 
+def build_trip_timetable(bus_trip_start_time, sections):
+    """
+    Materialize the arrival offsets of a trip: for each section position, the
+    seconds from the trip start until the bus reaches that section, applying
+    the same busy time adjustments as calculate_rough_arrival_time.
+
+    Args:
+        bus_trip_start_time (datetime): Start time of the trip.
+        sections (iterable): Route sections ordered by position.
+
+    Returns:
+        tuple: ({"<position>": offset_seconds, ...}, total trip duration)
+    """
+    elapsed_time = timedelta()
+    timetable = {}
+
+    for section in sections:
+        timetable[str(section.position)] = elapsed_time.total_seconds()
+
+        if section.time:
+            estimated_time_at_section = bus_trip_start_time + elapsed_time
+
+            if is_global_busy_time(estimated_time_at_section) and section.busy_time:
+                elapsed_time += section.busy_time
+            else:
+                elapsed_time += section.time
+
+    return timetable, elapsed_time
+
+
+def ensure_trip_timetable(bus_trip):
+    """
+    Fill in the timetable of trips saved before timetables were materialized.
+    """
+    if bus_trip.end_time is None:
+        bus_trip.refresh_timetable()
+        BusTrip.objects.filter(id=bus_trip.id).update(
+            timetable=bus_trip.timetable, end_time=bus_trip.end_time)
+
+
+def ensure_trip_timetables(bus_trips):
+    """
+    Batch version of ensure_trip_timetable: all legacy trips share one sections
+    query per call and are saved with a single bulk update.
+    """
+    legacy_trips = [bus_trip for bus_trip in bus_trips if bus_trip.end_time is None]
+    if not legacy_trips:
+        return
+
+    sections_by_route = get_sections_by_route(
+        {bus_trip.route_id for bus_trip in legacy_trips})
+    for bus_trip in legacy_trips:
+        bus_trip.timetable, duration = build_trip_timetable(
+            bus_trip.start_time, sections_by_route[bus_trip.route_id])
+        bus_trip.end_time = bus_trip.start_time + duration
+
+    BusTrip.objects.bulk_update(legacy_trips, ['timetable', 'end_time'])
+
+
+def get_arrival_time(bus_trip, position):
+    """
+    Approximate arrival time of the trip at the section with the given position,
+    read from the materialized timetable.
+    """
+    ensure_trip_timetable(bus_trip)
+
+    offset = bus_trip.timetable.get(str(position))
+    if offset is None:
+        return bus_trip.end_time
+
+    return bus_trip.start_time + timedelta(seconds=offset)
+
+
+def get_stop_positions(route_ids, boarding_point_ids):
+    """
+    Section positions of boarding points on routes, keyed by (route_id, boarding_point_id).
+    """
+    rows = RouteStopPosition.objects.filter(
+        bus_route_id__in=route_ids, boarding_point_id__in=boarding_point_ids
+    ).values_list('bus_route_id', 'boarding_point_id', 'position')
+
+    return {(route_id, boarding_point_id): position for route_id, boarding_point_id, position in rows}
+
+
+def get_stop_arrival_time(bus_trip, boarding_point_id):
+    """
+    Approximate arrival time of the trip at a boarding point.
+    """
+    position = get_stop_positions(
+        [bus_trip.route_id], [boarding_point_id]).get((bus_trip.route_id, boarding_point_id))
+
+    return get_arrival_time(bus_trip, position)
+
+
+def get_sections_by_route(route_ids):
+    """
+    Sections of the given routes ordered by position, keyed by route ID.
+    """
+    sections_by_route = defaultdict(list)
+    for section in Section.objects.filter(bus_route_id__in=route_ids).order_by('position'):
+        sections_by_route[section.bus_route_id].append(section)
+
+    return sections_by_route
+
+
+def refresh_route_timetables(route_id):
+    """
+    Rebuild the timetables of the upcoming and ongoing trips of a route
+    after its sections have changed.
+    """
+    sections = list(Section.objects.filter(
+        bus_route_id=route_id).order_by('position'))
+
+    trips = list(BusTrip.objects.filter(route_id=route_id).filter(
+        Q(end_time__isnull=True) | Q(end_time__gte=now())))
+
+    for trip in trips:
+        trip.timetable, duration = build_trip_timetable(
+            trip.start_time, sections)
+        trip.end_time = trip.start_time + duration
+
+    BusTrip.objects.bulk_update(trips, ['timetable', 'end_time'])
+    # Let synced apps pick up the new arrival times
+    Booking.objects.filter(bus_trip__in=trips).update(updated_at=now())
+
+
 def calculate_total_distance(sections, start_section, end_section):
     """
     Calculate the total distance between the start and end sections.
@@ -240,32 +495,44 @@ def calculate_luxury_bus_fare(bus_trip_id):
     try:
         # Fetch the bus trip and its route
         bus_trip = BusTrip.objects.get(id=bus_trip_id)
-        route = bus_trip.route
+    except BusTrip.DoesNotExist:
+        return {"error": "Bus trip not found."}
 
-        # Get the max position from sections in the route
-        max_section = route.sections.order_by('-position').first()
+    return get_luxury_route_fare(bus_trip.route_id)
 
-        if not max_section:
-            return {"error": "No sections found for this route."}
 
-        fare_number = max_section.position  # Since start is always 0
+def get_luxury_route_fare(route_id):
+    """
+    Luxury fare of a whole route in two queries, for callers that already
+    have the trip (see calculate_luxury_bus_fare).
+    """
+    # Get the max position from sections in the route
+    fare_number = Section.objects.filter(
+        bus_route_id=route_id).aggregate(max_position=Max('position'))['max_position']
 
-        # Get fare price based on fare number
-        try:
-            fare = BusFareLuxury.objects.get(fare_number=fare_number)
-            return {"fare_number": fare_number, "fare_price": fare.fare_price}
-        except BusFareLuxury.DoesNotExist:
-            return {"error": f"No fare price found for fare number {fare_number}."}
+    if fare_number is None:
+        return {"error": "No sections found for this route."}
 
-    except BusTrip.DoesNotExist:
-        return {"error": "Bus trip not found."}
+    # Get fare price based on fare number (start is always 0)
+    try:
+        fare = BusFareLuxury.objects.get(fare_number=fare_number)
+        return {"fare_number": fare_number, "fare_price": fare.fare_price}
+    except BusFareLuxury.DoesNotExist:
+        return {"error": f"No fare price found for fare number {fare_number}."}
 
 
 def calculate_semi_luxury_bus_fare(bus_trip_id):
     """Calculate fare for a semi-luxury bus trip."""
     bus_trip = BusTrip.objects.get(id=bus_trip_id)
-    route = bus_trip.route
-    max_section = route.sections.order_by('-position').first()
+    return get_semi_luxury_route_fare(bus_trip.route_id)
+
+
+def get_semi_luxury_route_fare(route_id):
+    """
+    Semi-luxury fare of a whole route, the counterpart of get_luxury_route_fare.
+    """
+    max_section = Section.objects.filter(
+        bus_route_id=route_id).order_by('-position').first()
 
     if not max_section:
         return {"error": "No sections found for this route."}
@@ -279,46 +546,175 @@ def calculate_semi_luxury_bus_fare(bus_trip_id):
         return {"error": f"No fare price found for fare number {fare_number}."}
 
 
-def get_booking_information(bus_trip_id):
+# Fare table of each bus type
+FARE_MODELS = {'LUXURY': BusFareLuxury, 'SEMI_LUXURY': BusFareSemiLuxury}
+
+
+def get_route_fares(route_ids, sections_by_route, bus_types):
+    """
+    Fares of whole routes for the given bus types, one query per fare table.
+    Same results as get_luxury_route_fare / get_semi_luxury_route_fare,
+    keyed by (bus_type, route_id).
+    """
+    fare_numbers = {}
+    for route_id in route_ids:
+        sections = sections_by_route.get(route_id)
+        fare_numbers[route_id] = sections[-1].position if sections else None
+
+    route_fares = {}
+    for bus_type in bus_types:
+        fare_prices = dict(FARE_MODELS[bus_type].objects.filter(
+            fare_number__in={number for number in fare_numbers.values() if number is not None}
+        ).values_list('fare_number', 'fare_price'))
+
+        for route_id, fare_number in fare_numbers.items():
+            if fare_number is None:
+                fare_info = {"error": "No sections found for this route."}
+            elif fare_number in fare_prices:
+                fare_info = {"fare_number": fare_number, "fare_price": fare_prices[fare_number]}
+            else:
+                fare_info = {"error": f"No fare price found for fare number {fare_number}."}
+            route_fares[(bus_type, route_id)] = fare_info
+
+    return route_fares
+
+
+def build_booking_search_results(start_point, end_point):
+    """
+    Bookable trips between two boarding points with their available seat
+    counts, fares and arrival times, as cached by booking_search.
+    Seat holds expire on their own and are not included: the counts only
+    reflect bookings until apply_seat_holds is called on the results.
+
+    Returns:
+        dict: {"trips": [...], "free_seat_ids": {trip_id: [seat_id, ...]}}
+    """
+    # Step 3: Get the list of BusTrips
+    bookable_trips = list(
+        bus_booking_search(start_point, end_point).select_related('bus'))
+
+    # Step 4: Get available seats for all BusTrips in one batch
+    available_seats = get_available_seats_for_booking(
+        bookable_trips, include_holds=False)
+
+    route_ids = {trip.route_id for trip in bookable_trips}
+    stop_positions = get_stop_positions(
+        route_ids, [start_point.id, end_point.id])
+    sections_by_route = get_sections_by_route(route_ids)
+    route_fares = get_route_fares(
+        route_ids, sections_by_route,
+        {trip.bus.bus_type for trip in bookable_trips} & FARE_MODELS.keys())
+
+    # Step 5: Prepare the response data
+    trips_data = []
+    for trip in bookable_trips:
+        bus = trip.bus
+        route_sections = sections_by_route[trip.route_id]
+        sections_by_position = {
+            section.position: section for section in route_sections}
+
+        start_position = stop_positions.get((trip.route_id, start_point.id))
+        end_position = stop_positions.get((trip.route_id, end_point.id))
+        start_section = sections_by_position.get(start_position)
+        end_section = sections_by_position.get(end_position)
+
+        is_start_time_ok = trip.start_time - timedelta(minutes=30)
+
+        fare_info = route_fares.get(
+            (bus.bus_type, trip.route_id), {"fare_price": 0})
+
+        start_arrival_time = get_arrival_time(trip, start_position)
+        end_arrival_time = get_arrival_time(trip, end_position)
+
+        total_distance = calculate_total_distance(
+            route_sections, start_section, end_section)
+
+        trips_data.append({
+            "bus_trip_id": trip.id,
+            "bus_trip_name": trip.name,
+            "available_seats": len(available_seats.get(trip.id, [])),
+            "fare_price": fare_info,
+            "bus_details": {
+                "bus_name": bus.bus_name,
+                "bus_number": bus.bus_number
+            },
+            "start_arrival_time": localtime(start_arrival_time).strftime("%Y-%m-%d %H:%M:%S"),
+            "end_arrival_time": localtime(end_arrival_time).strftime("%Y-%m-%d %H:%M:%S"),
+            # Ensure the distance is JSON serializable
+            "total_distance": float(total_distance),
+            "start_point_name": start_point.name,
+            "end_point_name": end_point.name,
+            "is_start_time_ok": localtime(is_start_time_ok).strftime("%Y-%m-%d %H:%M:%S"),
+        })
+
+    return {"trips": trips_data, "free_seat_ids": available_seats}
+
+
+def apply_seat_holds(search_results, holder_id=None):
+    """
+    Trips of build_booking_search_results with the seats currently held by
+    other users taken out of the available counts, in one cache round-trip.
+    """
+    free_seat_ids = search_results["free_seat_ids"]
+    seat_holds = get_seat_holds(
+        (trip_id, seat_id)
+        for trip_id, seat_ids in free_seat_ids.items()
+        for seat_id in seat_ids
+    )
+
+    held_counts = defaultdict(int)
+    for (trip_id, _), user_id in seat_holds.items():
+        if user_id != holder_id:
+            held_counts[trip_id] += 1
+
+    return [
+        {**trip, "available_seats": trip["available_seats"] - held_counts[trip["bus_trip_id"]]}
+        if held_counts[trip["bus_trip_id"]] else trip
+        for trip in search_results["trips"]
+    ]
+
+
+def get_booking_information(bus_trip_id, encoding=None, holder_id=None):
     """
     Utility function to get seat availability information for a specific bus trip.
-    Returns a dictionary where seat IDs are mapped to "Available" or "Not-Available".
+    Returns a dictionary where seat IDs are mapped to "Available" or "Not-Available",
+    or a compact bitmap / run-length payload when an encoding is given.
+    Seats held by holder_id are shown as available to them.
     """
     try:
         # Fetch the BusTrip instance
-        bus_trip = BusTrip.objects.get(id=bus_trip_id)
+        bus_trip = BusTrip.objects.select_related('bus').get(id=bus_trip_id)
         bus = bus_trip.bus
 
-        # Get all seats of the bus
-        all_seats = bus.seats.all()
-
-        # Fetch bookings for the specific BusTrip
-        bookings = Booking.objects.filter(bus_trip=bus_trip)
+        seat_map = build_seat_map(bus_trip, holder_id=holder_id)
 
         # Calculate fare per seat
-        fee_per_seat = calculate_luxury_bus_fare(bus_trip_id)
-
-        # Create a seat availability dictionary
-        seat_availability = {}
-
-        for seat in all_seats:
-            is_booked = bookings.filter(seat=seat).exists()
-            seat_availability[seat.id] = "Not-Available" if is_booked else "Available"
+        fee_per_seat = get_luxury_route_fare(bus_trip.route_id)
 
-        # Return seat details
-        return {
+        seat_details = {
             "bus_trip_id": bus_trip_id,
             "bus_trip_name": bus_trip.name,
             "fee_per_seat": fee_per_seat,
             "seat_type": f"{bus.seat_count}-seater",
-            "seat_availability": seat_availability  # New format
         }
 
+        if encoding:
+            seat_details["seat_map"] = encode_seat_map(seat_map, encoding)
+        else:
+            # Create a seat availability dictionary (booked and held seats are not available)
+            seat_details["seat_availability"] = {
+                seat_id: "Available" if bit else "Not-Available"
+                for (seat_id, _), bit in zip(seat_map["seats"], seat_availability_bits(seat_map))
+            }
+
+        # Return seat details
+        return seat_details
+
     except BusTrip.DoesNotExist:
         return {"error": "BusTrip not found."}
 
 
-def get_booking_info_with_SPandEP(bus_trip_id):
+def get_booking_info_with_SPandEP(bus_trip_id, encoding=None):
     """
     Retrieve seat availability details for a specific bus trip.
     Includes:
@@ -329,62 +725,61 @@ def get_booking_info_with_SPandEP(bus_trip_id):
 
     Args:
         bus_trip_id (int): The ID of the bus trip.
+        encoding (str): 'bitmap' or 'rle' for a compact seat map, with the start
+            and end points listed for the booked seats only.
 
     Returns:
         dict: A dictionary containing bus trip details with seat booking info.
     """
     try:
         # Fetch the bus trip
-        bus_trip = BusTrip.objects.get(id=bus_trip_id)
+        bus_trip = BusTrip.objects.select_related('bus').get(id=bus_trip_id)
         bus = bus_trip.bus
 
-        # Get all seats for the bus
-        all_seats = bus.seats.all()
+        seat_map = build_seat_map(bus_trip, include_points=True)
+        booked = seat_map["booked"]
 
-        # Fetch all bookings for this bus trip
-        bookings = Booking.objects.filter(bus_trip=bus_trip)
-
-        # Prepare seat availability details
-        seat_availability = {}
-
-        for seat in all_seats:
-            # Check if the seat is booked
-            booking = bookings.filter(seat=seat).first()
-            if booking:
-                seat_availability[seat.id] = {
-                    "seat_number": seat.seat_number,
-                    "availability": "Not Available",
-                    "start_point": booking.start_point.name,  # Retrieve start point name
-                    "end_point": booking.end_point.name  # Retrieve end point name
-                }
-            else:
-                seat_availability[seat.id] = {
-                    "seat_number": seat.seat_number,
-                    "availability": "Available",
-                    "start_point": None,
-                    "end_point": None
-                }
-
-        return {
+        seat_details = {
             "bus_trip_id": bus_trip_id,
             "bus_trip_name": bus_trip.name,
             "seat_type": f"{bus.seat_count}-seater",
-            "seat_availability": seat_availability
         }
 
+        if encoding:
+            seat_details["seat_map"] = encode_seat_map(seat_map, encoding)
+            # [seat_number, start_point, end_point] of every booked seat
+            seat_details["booked_seats"] = [
+                [seat_number, *booked[seat_id]]
+                for seat_id, seat_number in seat_map["seats"] if seat_id in booked
+            ]
+            return seat_details
+
+        # Prepare seat availability details
+        seat_availability = {}
+
+        for seat_id, seat_number in seat_map["seats"]:
+            start_point, end_point = booked.get(seat_id) or (None, None)
+            # Seats held by a passenger who is checking out are not available either
+            is_available = seat_id not in booked and seat_id not in seat_map["held"]
+
+            seat_availability[seat_id] = {
+                "seat_number": seat_number,
+                "availability": "Available" if is_available else "Not Available",
+                "start_point": start_point,
+                "end_point": end_point
+            }
+
+        seat_details["seat_availability"] = seat_availability
+        return seat_details
+
     except BusTrip.DoesNotExist:
         return {"error": "Bus trip not found."}
 
 
 def calculate_bus_trip_end_time(bus_trip):
     """
-    Calculates the end time of a bus trip by summing all section durations.
+    End time of a bus trip, read from its materialized timetable.
     """
-    sections = bus_trip.route.sections.all()
-    total_duration = timedelta()  # Initialize time sum
-
-    for section in sections:
-        if section.time:  # Ensure section has a duration
-            total_duration += section.time
+    ensure_trip_timetable(bus_trip)
 
-    return bus_trip.start_time + total_duration
+    return bus_trip.end_time
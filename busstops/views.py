@@ -1,13 +1,18 @@
-from datetime import timedelta
-import time
+from django.conf import settings
 from django.shortcuts import render
 from django.utils.timezone import localtime
 from django.core.cache import cache
 from django.http import JsonResponse
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from .utils import bus_booking_search, get_available_seats_for_booking, calculate_rough_arrival_time, calculate_total_distance, get_booking_information
-from .utils import bus_instant_booking_search, get_available_seats_for_instant_booking, calculate_luxury_bus_fare, calculate_semi_luxury_bus_fare
+from .utils import calculate_total_distance, get_booking_information
+from .utils import get_arrival_time, get_stop_positions, get_sections_by_route
+from .utils import bus_instant_booking_search, get_available_seats_for_instant_booking
+from .utils import build_booking_search_results, apply_seat_holds
+from .search_cache import booking_search_cache_key, record_booking_search, get_or_rebuild_booking_search
+from .seat_map import SEAT_MAP_ENCODINGS
+from .autocomplete import autocomplete_boarding_points
+from .spatial import nearest_boarding_points, boarding_points_in_bbox, parse_bbox
 from .models import BoardingPoint
 
 
@@ -19,9 +24,8 @@ def get_suggestions(request):
 
     term = request.GET.get('term', '')
     if term:
-        results = BoardingPoint.objects.filter(name__icontains=term)[:10]
-        suggestions = [{"id": bp.id, "name": bp.name,
-                        "city": bp.city, "province": bp.province} for bp in results]
+        # Served from the in-memory index, ranked by match and booking count
+        suggestions = autocomplete_boarding_points(term, limit=10)
         return JsonResponse(suggestions, safe=False)
     return JsonResponse([], safe=False)
 
@@ -36,10 +40,18 @@ def booking_search(request):
     if not start_point_id or not end_point_id:
         return Response({"error": "start_point and end_point are required."}, status=400)
 
-    cache_key = f"booking_search_{start_point_id}_{end_point_id}"
+    # The IDs are part of the cache keys, only accept numbers
+    try:
+        start_point_id = int(start_point_id)
+        end_point_id = int(end_point_id)
+    except ValueError:
+        return Response({"error": "start_point and end_point must be numbers."}, status=400)
+
+    cache_key = booking_search_cache_key(start_point_id, end_point_id)
     cached_data = cache.get(cache_key)
-    if cached_data:
-        return Response(cached_data, status=200)
+    if cached_data is not None:
+        record_booking_search(start_point_id, end_point_id)
+        return Response(apply_seat_holds(cached_data, request.user.id), status=200)
 
     try:
         # Step 2: Fetch start and end BoardingPoint objects
@@ -48,67 +60,17 @@ def booking_search(request):
     except BoardingPoint.DoesNotExist:
         return Response({"error": "Invalid start_point or end_point."}, status=404)
 
-    # Step 3: Get the list of BusTrips
-    bookable_trips = bus_booking_search(start_point, end_point)
-
-    # Step 4: Get available seats for each BusTrip
-    available_seats = get_available_seats_for_booking(
-        bookable_trips)
-
-    # Step 5: Prepare the response data
-    trips_data = []
-    for trip in bookable_trips:
-        bus = trip.bus
-        route_sections = trip.route.sections.order_by('position')
-
-        start_section = route_sections.filter(
-            section_boarding_points=start_point).first()
-        end_section = route_sections.filter(
-            section_boarding_points=end_point).first()
-
-        is_start_time_ok = trip.start_time - timedelta(minutes=30)
-
-        fare_info = {"fare_price": 0}
-
-        if bus.bus_type == 'LUXURY':
-            fare_info = calculate_luxury_bus_fare(trip.id)
-        elif bus.bus_type == 'SEMI_LUXURY':
-            fare_info = calculate_semi_luxury_bus_fare(
-                trip.id)  # Function should be implemented
-
-            # fare_price = fare_info["fare_price"] if fare_info and "fare_price" in fare_info else 0
-
-        start_arrival_time = calculate_rough_arrival_time(
-            trip.start_time, route_sections, start_section)
-        end_arrival_time = calculate_rough_arrival_time(
-            trip.start_time, route_sections, end_section)
-
-        total_distance = calculate_total_distance(
-            route_sections, start_section, end_section)
-
-        trips_data.append({
-            "bus_trip_id": trip.id,
-            "bus_trip_name": trip.name,
-            "available_seats": len(available_seats.get(trip.id, [])),
-            "fare_price": fare_info,
-            "bus_details": {
-                "bus_name": bus.bus_name,
-                "bus_number": bus.bus_number
-            },
-            "start_arrival_time": localtime(start_arrival_time).strftime("%Y-%m-%d %H:%M:%S"),
-            "end_arrival_time": localtime(end_arrival_time).strftime("%Y-%m-%d %H:%M:%S"),
-            # Ensure the distance is JSON serializable
-            "total_distance": float(total_distance),
-            "start_point_name": start_point.name,
-            "end_point_name": end_point.name,
-            "is_start_time_ok": localtime(is_start_time_ok).strftime("%Y-%m-%d %H:%M:%S"),
-        })
+    # Counted for the warm-up of popular searches (see busstops.warmup)
+    record_booking_search(start_point.id, end_point.id)
 
-        cache.set(cache_key, trips_data)
+    # Steps 3-5: Bookable trips with seats, fares and arrival times, rebuilt by
+    # one request at a time while the others get the previous results
+    search_results, _ = get_or_rebuild_booking_search(
+        cache_key, start_point.id, end_point.id,
+        lambda: build_booking_search_results(start_point, end_point))
 
-    # Step 6: Return the data as JSON response
-    time.sleep(1)
-    return Response(trips_data, status=200)
+    # Step 6: Return the data as JSON response, with the current seat holds
+    return Response(apply_seat_holds(search_results, request.user.id), status=200)
 
 
 @api_view(['GET'])
@@ -128,25 +90,31 @@ def instant_booking_search(request):
     except BoardingPoint.DoesNotExist:
         return Response({"error": "Invalid start_point or end_point."}, status=404)
 
-    bookable_trips = bus_instant_booking_search(start_point, end_point)
+    bookable_trips = list(
+        bus_instant_booking_search(start_point, end_point).select_related('bus'))
 
     available_seats = get_available_seats_for_instant_booking(
-        bookable_trips, start_point, end_point)
+        bookable_trips, start_point, end_point, holder_id=request.user.id)
+
+    route_ids = {trip.route_id for trip in bookable_trips}
+    stop_positions = get_stop_positions(
+        route_ids, [start_point.id, end_point.id])
+    sections_by_route = get_sections_by_route(route_ids)
 
     trips_data = []
     for trip in bookable_trips:
         bus = trip.bus
-        route_sections = trip.route.sections.all()
+        route_sections = sections_by_route[trip.route_id]
+        sections_by_position = {
+            section.position: section for section in route_sections}
 
-        start_section = route_sections.filter(
-            section_boarding_points=start_point).first()
-        end_section = route_sections.filter(
-            section_boarding_points=end_point).first()
+        start_position = stop_positions.get((trip.route_id, start_point.id))
+        end_position = stop_positions.get((trip.route_id, end_point.id))
+        start_section = sections_by_position.get(start_position)
+        end_section = sections_by_position.get(end_position)
 
-        start_arrival_time = calculate_rough_arrival_time(
-            trip.start_time, route_sections, start_section)
-        end_arrival_time = calculate_rough_arrival_time(
-            trip.start_time, route_sections, end_section)
+        start_arrival_time = get_arrival_time(trip, start_position)
+        end_arrival_time = get_arrival_time(trip, end_position)
 
         total_distance = calculate_total_distance(
             route_sections, start_section, end_section)
@@ -175,12 +143,74 @@ def fetch_booking_details(request):
     """
     API view to fetch seat details (available, non-available, and seat type)
     for a given bus trip ID.
+    Optional ?encoding=bitmap|rle returns a compact seat map instead.
     """
     bus_trip_id = request.GET.get('bus_trip_id')
-    seat_details = get_booking_information(bus_trip_id)
+    encoding = request.GET.get('encoding')
+
+    if encoding and encoding not in SEAT_MAP_ENCODINGS:
+        return Response({"error": "encoding must be bitmap or rle."}, status=400)
+
+    # Seats the user holds during checkout stay available to them
+    seat_details = get_booking_information(
+        bus_trip_id, encoding, holder_id=request.user.id)
 
     # Check if an error occurred in the utility function
     if "error" in seat_details:
         return JsonResponse(seat_details, status=404)
 
     return Response(seat_details, status=200)
+
+
+# Largest number of boarding points returned by the spatial lookups
+MAX_NEAREST_BOARDING_POINTS = 50
+MAX_BBOX_BOARDING_POINTS = 500
+# Nearest boarding points are searched this far at most (in meters)
+MAX_NEAREST_DISTANCE = getattr(settings, 'MAX_NEAREST_BOARDING_POINT_DISTANCE', 50000)
+
+
+@api_view(['GET'])
+def get_nearest_boarding_points(request):
+    """
+    API to suggest the boarding points nearest to a position:
+    ?latitude=..&longitude=..[&limit=5][&max_distance=<meters>]
+    max_distance defaults to, and is capped at, MAX_NEAREST_DISTANCE.
+    """
+    try:
+        latitude = float(request.GET['latitude'])
+        longitude = float(request.GET['longitude'])
+        limit = int(request.GET.get('limit', 5))
+        max_distance = float(request.GET.get('max_distance') or MAX_NEAREST_DISTANCE)
+    except (KeyError, ValueError):
+        return Response({"error": "latitude and longitude are required, limit and max_distance must be numbers."}, status=400)
+
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return Response({"error": "Invalid latitude or longitude."}, status=400)
+    if not max_distance > 0:
+        return Response({"error": "max_distance must be positive."}, status=400)
+
+    max_distance = min(max_distance, MAX_NEAREST_DISTANCE)
+
+    limit = max(1, min(limit, MAX_NEAREST_BOARDING_POINTS))
+
+    return Response({
+        "boarding_points": nearest_boarding_points(latitude, longitude, limit, max_distance)
+    })
+
+
+@api_view(['GET'])
+def get_boarding_points_in_bbox(request):
+    """
+    API to get the boarding points shown on a map: ?bbox=south,west,north,east
+    """
+    bbox = parse_bbox(request.GET.get('bbox'))
+    if bbox is None:
+        return Response({"error": "bbox must be south,west,north,east in degrees."}, status=400)
+
+    boarding_points = boarding_points_in_bbox(
+        *bbox, limit=MAX_BBOX_BOARDING_POINTS + 1)
+
+    return Response({
+        "boarding_points": boarding_points[:MAX_BBOX_BOARDING_POINTS],
+        "truncated": len(boarding_points) > MAX_BBOX_BOARDING_POINTS
+    })
@@ -0,0 +1,62 @@
+# busstops/warmup.py
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from .models import BoardingPoint
+from .search_cache import booking_search_cache_key, get_popular_searches, rebuild_booking_search
+from .utils import build_booking_search_results
+
+logger = logging.getLogger(__name__)
+
+# Number of most searched (start_point, end_point) pairs kept warm
+SEARCH_WARMUP_PAIRS = getattr(settings, 'SEARCH_WARMUP_PAIRS', 200)
+# Warm results are recomputed this often (in seconds), before the cache expires them
+SEARCH_WARMUP_REFRESH_INTERVAL = getattr(settings, 'SEARCH_WARMUP_REFRESH_INTERVAL', 4 * 60)
+# Search counters are halved this often (in seconds) so they follow recent demand
+SEARCH_POPULARITY_DECAY_INTERVAL = getattr(settings, 'SEARCH_POPULARITY_DECAY_INTERVAL', 60 * 60)
+
+
+def warm_booking_search(start_point_id, end_point_id, refresh=False):
+    """
+    Compute and cache the booking search results of a pair, unless they are
+    cached already (or refresh is set).
+
+    Returns:
+        bool: True if the results were computed.
+    """
+    cache_key = booking_search_cache_key(start_point_id, end_point_id)
+    if not refresh and cache.get(cache_key) is not None:
+        return False
+
+    boarding_points = BoardingPoint.objects.in_bulk([start_point_id, end_point_id])
+    if start_point_id not in boarding_points or end_point_id not in boarding_points:
+        return False
+
+    # Stored under the key read before computing: if a route changed in the
+    # meantime, the results land under the old version and are never served.
+    # Skipped when a request is already rebuilding them.
+    data = rebuild_booking_search(
+        cache_key, start_point_id, end_point_id,
+        lambda: build_booking_search_results(
+            boarding_points[start_point_id], boarding_points[end_point_id]))
+    return data is not None
+
+
+def warm_popular_searches(limit=SEARCH_WARMUP_PAIRS, refresh=False):
+    """
+    Warm the most searched pairs, most popular first. Pairs whose cached
+    results were invalidated (a route version changed) or expired are
+    recomputed; with refresh, all of them are.
+
+    Returns:
+        int: Number of pairs recomputed.
+    """
+    warmed = 0
+    for start_point_id, end_point_id, _ in get_popular_searches(limit):
+        try:
+            warmed += warm_booking_search(start_point_id, end_point_id, refresh)
+        except Exception:
+            # One broken pair must not stop the others from being warmed
+            logger.exception("Could not warm the booking search %s -> %s",
+                             start_point_id, end_point_id)
+    return warmed
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import ConAppVersion
+from .models import ConAppVersion, DailyRevenueRollup
 
 # Customizing the User Admin
 
@@ -8,3 +8,11 @@ from .models import ConAppVersion
 class ConAppVersionAdmin(admin.ModelAdmin):
     list_display = ("version", "update_url", "created_at")
 
+
+
+@admin.register(DailyRevenueRollup)
+class DailyRevenueRollupAdmin(admin.ModelAdmin):
+    list_display = ("date", "bus", "route", "trips_run", "trips_canceled", "seats_sold",
+                    "bookings_canceled", "revenue", "company_3_percent_cut", "company_4_percent_cut")
+    list_filter = ("date", "route")
+    date_hierarchy = "date"
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ConductorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'conductor'
+
+    def ready(self):
+        import conductor.signals
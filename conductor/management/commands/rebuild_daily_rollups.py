@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from conductor.rollups import rebuild_daily_rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily revenue and occupancy roll-ups from the trip and booking history."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Only rebuild days from this date on (YYYY-MM-DD).")
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_date(options['since'])
+            if since is None:
+                raise CommandError("--since must be a date (YYYY-MM-DD).")
+
+        rebuilt = rebuild_daily_rollups(since=since)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {rebuilt} daily roll-ups."))
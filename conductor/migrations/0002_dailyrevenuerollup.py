@@ -0,0 +1,37 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('busstops', '0004_routestopposition'),
+        ('conductor', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRevenueRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('trips_run', models.PositiveIntegerField(default=0)),
+                ('trips_canceled', models.PositiveIntegerField(default=0)),
+                ('seats_sold', models.PositiveIntegerField(default=0)),
+                ('bookings_canceled', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0.0, max_digits=12)),
+                ('unreleased_revenue', models.DecimalField(decimal_places=2, default=0.0, max_digits=12)),
+                ('company_3_percent_cut', models.DecimalField(decimal_places=2, default=0.0, max_digits=12)),
+                ('company_4_percent_cut', models.DecimalField(decimal_places=2, default=0.0, max_digits=12)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('bus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='busstops.buses')),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_rollups', to='busstops.busroute')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bus', 'date'], name='conductor_d_bus_id_ddcf46_idx')],
+                'unique_together': {('bus', 'route', 'date')},
+            },
+        ),
+    ]
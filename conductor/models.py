@@ -1,4 +1,5 @@
 from django.db import models
+from busstops.models import Buses, BusRoute
 
 
 class ConAppVersion(models.Model):
@@ -8,3 +9,36 @@ class ConAppVersion(models.Model):
 
     def __str__(self):
         return f"{self.version}"
+
+
+class DailyRevenueRollup(models.Model):
+    """
+    Per bus, per route, per day totals of trips and bookings, kept up to date
+    from booking events (see conductor.rollups) so reports never scan trips.
+    """
+    bus = models.ForeignKey(
+        Buses, on_delete=models.CASCADE, related_name='daily_rollups')
+    route = models.ForeignKey(
+        BusRoute, on_delete=models.CASCADE, related_name='daily_rollups')
+    date = models.DateField()  # Local start date of the trips
+    trips_run = models.PositiveIntegerField(default=0)
+    trips_canceled = models.PositiveIntegerField(default=0)
+    seats_sold = models.PositiveIntegerField(default=0)
+    bookings_canceled = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(default=0.0, max_digits=12, decimal_places=2)
+    unreleased_revenue = models.DecimalField(
+        default=0.0, max_digits=12, decimal_places=2)
+    company_3_percent_cut = models.DecimalField(
+        default=0.0, max_digits=12, decimal_places=2)
+    company_4_percent_cut = models.DecimalField(
+        default=0.0, max_digits=12, decimal_places=2)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('bus', 'route', 'date')
+        indexes = [
+            models.Index(fields=['bus', 'date']),
+        ]
+
+    def __str__(self):
+        return f"{self.bus} on {self.route} - {self.date}"
@@ -0,0 +1,112 @@
+# conductor/rollups.py
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils.timezone import localtime
+from booking.models import BusTrip, Booking, CANCELED_BOOKING_STATUSES
+from booking.revenue import annotate_trip_revenue
+from .models import DailyRevenueRollup
+
+
+def trip_rollup_bucket(bus_trip):
+    """
+    (bus_id, route_id, local start date) of the roll-up row a trip counts towards.
+    """
+    return bus_trip.bus_id, bus_trip.route_id, localtime(bus_trip.start_time).date()
+
+
+def refresh_daily_rollup(bus_id, route_id, date):
+    """
+    Recompute one roll-up row from the trips of that bus, route and day.
+    Only a handful of trips fall in a bucket, so this stays cheap per event.
+    """
+    bus_trips = BusTrip.objects.filter(
+        bus_id=bus_id, route_id=route_id, start_time__date=date)
+
+    trips = list(annotate_trip_revenue(bus_trips).values(
+        'is_bustrip_canceled', 'is_revenue_released',
+        'total_revenue', 'total_company_3_percent_cut'))
+    if not trips:
+        DailyRevenueRollup.objects.filter(
+            bus_id=bus_id, route_id=route_id, date=date).delete()
+        return None
+
+    sold = ~Q(booking_status__in=CANCELED_BOOKING_STATUSES)
+    bookings = Booking.objects.filter(bus_trip__in=bus_trips).aggregate(
+        seats_sold=Count('id', filter=sold),
+        bookings_canceled=Count(
+            'id', filter=Q(booking_status='BOOKING_CANCELED')),
+        company_4_percent_cut=Sum('company_4_precent_cut', filter=sold)
+    )
+
+    rollup, _ = DailyRevenueRollup.objects.update_or_create(
+        bus_id=bus_id, route_id=route_id, date=date,
+        defaults={
+            "trips_run": sum(not trip['is_bustrip_canceled'] for trip in trips),
+            "trips_canceled": sum(trip['is_bustrip_canceled'] for trip in trips),
+            "seats_sold": bookings['seats_sold'],
+            "bookings_canceled": bookings['bookings_canceled'],
+            "revenue": sum(trip['total_revenue'] for trip in trips),
+            "unreleased_revenue": sum(
+                trip['total_revenue'] for trip in trips if not trip['is_revenue_released']),
+            "company_3_percent_cut": sum(trip['total_company_3_percent_cut'] for trip in trips),
+            "company_4_percent_cut": bookings['company_4_percent_cut'] or 0,
+        }
+    )
+    return rollup
+
+
+def queue_rollup_refresh(*buckets):
+    """
+    Refresh the given roll-up buckets once the current transaction commits.
+    Buckets are collected on the connection: however many bookings, ledger
+    entries and trips of a transaction touch a bucket, it is refreshed once.
+    """
+    connection = transaction.get_connection()
+    pending = getattr(connection, 'pending_rollup_refresh', None)
+    # Still waiting for the commit, unless its transaction (or savepoint) was rolled back
+    if pending is not None and any(
+            func is pending[0] for _, func, _ in connection.run_on_commit):
+        pending[1].update(buckets)
+        return
+
+    pending_buckets = set(buckets)
+
+    def refresh_pending_rollups():
+        connection.pending_rollup_refresh = None
+        for bucket in pending_buckets:
+            refresh_daily_rollup(*bucket)
+
+    connection.pending_rollup_refresh = (refresh_pending_rollups, pending_buckets)
+    transaction.on_commit(refresh_pending_rollups)
+
+
+def queue_trip_rollup_refresh(bus_trip):
+    queue_rollup_refresh(trip_rollup_bucket(bus_trip))
+
+
+def rebuild_daily_rollups(since=None):
+    """
+    Rebuild the roll-ups from the trip and booking history.
+
+    Args:
+        since (date): Only rebuild days from this date on (all days when None).
+
+    Returns:
+        int: Number of roll-up rows written.
+    """
+    bus_trips = BusTrip.objects.all()
+    stale_rollups = DailyRevenueRollup.objects.all()
+    if since is not None:
+        bus_trips = bus_trips.filter(start_time__date__gte=since)
+        stale_rollups = stale_rollups.filter(date__gte=since)
+
+    buckets = bus_trips.annotate(date=TruncDate('start_time')).values_list(
+        'bus_id', 'route_id', 'date').distinct()
+
+    with transaction.atomic():
+        stale_rollups.delete()
+        for bus_id, route_id, date in buckets:
+            refresh_daily_rollup(bus_id, route_id, date)
+
+    return len(buckets)
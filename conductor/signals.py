@@ -0,0 +1,52 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from booking.models import BusTrip, Booking, RevenueLedgerEntry
+from .rollups import trip_rollup_bucket, queue_rollup_refresh, queue_trip_rollup_refresh
+
+
+@receiver(pre_save, sender=BusTrip)
+def remember_bus_trip_rollup_bucket(sender, instance, **kwargs):
+    """
+    Remember which day the trip counted towards, in case it is moved.
+    """
+    previous = BusTrip.objects.filter(pk=instance.pk).only(
+        'bus_id', 'route_id', 'start_time').first() if instance.pk else None
+    instance._previous_rollup_bucket = trip_rollup_bucket(
+        previous) if previous else None
+
+
+@receiver(post_save, sender=BusTrip)
+def refresh_bus_trip_rollup(sender, instance, **kwargs):
+    buckets = [trip_rollup_bucket(instance)]
+    previous_bucket = getattr(instance, '_previous_rollup_bucket', None)
+    if previous_bucket:
+        buckets.append(previous_bucket)
+
+    queue_rollup_refresh(*buckets)
+
+
+@receiver(post_delete, sender=BusTrip)
+def remove_bus_trip_from_rollup(sender, instance, **kwargs):
+    queue_trip_rollup_refresh(instance)
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def refresh_booking_rollup(sender, instance, **kwargs):
+    """
+    Bookings, cancellations and reschedules change the seats sold and revenue of the day.
+    Bulk-created bookings are queued by the view that creates them.
+    """
+    if not instance.bus_trip_id:
+        return
+    try:
+        queue_trip_rollup_refresh(instance.bus_trip)
+    except BusTrip.DoesNotExist:
+        # Deleted along with its trip, which refreshes the day itself
+        pass
+
+
+@receiver(post_save, sender=RevenueLedgerEntry)
+def refresh_revenue_rollup(sender, instance, created, **kwargs):
+    if created:
+        queue_trip_rollup_refresh(instance.bus_trip)
@@ -1,3 +1,306 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.timezone import localdate, localtime, now
+from rest_framework.test import APITestCase
+from booking.models import Booking, BusTrip
+from booking.utils import generate_secure_qr_data, qr_code_data_digest
+from busstops.models import BoardingPoint, BusRoute, Buses, Seat, Section
+from members.models import User
+from .models import DailyRevenueRollup
+from .rollups import queue_trip_rollup_refresh, refresh_daily_rollup, trip_rollup_bucket
 
-# Create your tests here.
+
+class ConductorTestCase(APITestCase):
+    """
+    A conductor's bus on a two-stop route, and a passenger booking on it.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.passenger = User.objects.create(phone_number="0770000400")
+        cls.conductor = User.objects.create(phone_number="0770000401")
+        User.objects.filter(id=cls.conductor.id).update(role=User.Role.BUS_CONDUCTOR)
+        cls.conductor.refresh_from_db()
+
+        cls.boarding_points = [
+            BoardingPoint.objects.create(name=f"Stop {i}") for i in range(2)]
+        cls.route = BusRoute.objects.create(name="Colombo - Ratnapura")
+        cls.route.route_boarding_points.set(cls.boarding_points)
+        for position, boarding_point in enumerate(cls.boarding_points, 1):
+            section = Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(minutes=30), distance=10)
+            section.section_boarding_points.set([boarding_point])
+
+        cls.bus = Buses.objects.create(
+            bus_name="Sabaragamuwa", bus_number="SG-1", seat_count=32, owner=cls.conductor)
+        cls.seats = list(Seat.objects.filter(bus=cls.bus).order_by('seat_number'))
+
+    def setUp(self):
+        cache.clear()
+
+    def create_trip(self, days=1, bus=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return BusTrip.objects.create(
+                bus=bus or self.bus, route=self.route, start_time=now() + timedelta(days=days))
+
+    def book(self, bus_trip, seat, fare_price=1000):
+        self.client.force_authenticate(self.passenger)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('book_seat'), {
+                "trip_id": bus_trip.id, "seat_ids": [seat.id],
+                "start_point_id": self.boarding_points[0].id,
+                "end_point_id": self.boarding_points[1].id, "fare_price": fare_price,
+            }, format='json', HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 201)
+        return Booking.objects.get(id=response.json()["bookings"][0]["booking_id"])
+
+    def get_as_conductor(self, name, params=None, **kwargs):
+        self.client.force_authenticate(self.conductor)
+        return self.client.get(reverse(name, kwargs=kwargs), params, HTTP_HOST='passenger.lk')
+
+
+class RevenueDashboardTests(ConductorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bus_trips = [self.create_trip(days) for days in (1, 3, 5)]
+        self.book(self.bus_trips[0], self.seats[0])
+        self.book(self.bus_trips[0], self.seats[1])
+        self.book(self.bus_trips[2], self.seats[0], fare_price=2000)
+
+    def test_trip_revenue_newest_first(self):
+        response = self.get_as_conductor('revenue')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(trip['bus_trip_revenue'], trip['reserved_seats'])
+             for trip in response.data['bus_trip_revenues']],
+            [(Decimal('1940.00'), 1), (Decimal('0.00'), 0), (Decimal('1940.00'), 2)])
+        self.assertEqual(response.data['total_trips'], 3)
+
+    def test_trip_revenue_pages_and_dates(self):
+        response = self.get_as_conductor('revenue', {"page_size": 2, "page": 2})
+        self.assertEqual((response.data['page'], response.data['total_pages']), (2, 2))
+        self.assertEqual(len(response.data['bus_trip_revenues']), 1)
+
+        start_date = localtime(self.bus_trips[1].start_time).date()
+        response = self.get_as_conductor('revenue', {"from": start_date.isoformat()})
+        self.assertEqual(response.data['total_trips'], 2)
+        response = self.get_as_conductor('revenue', {"to": start_date.isoformat()})
+        self.assertEqual(response.data['total_trips'], 2)
+
+        self.assertEqual(self.get_as_conductor('revenue', {"from": "2025-13-01"}).status_code, 400)
+        self.assertEqual(self.get_as_conductor('revenue', {"to": "yesterday"}).status_code, 400)
+
+    def test_last_trips_query_count_does_not_grow_with_trips(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_as_conductor('get_last_7_bookings_for_home')
+        self.assertEqual([len(trip['bookings']) for trip in response.data['last_7_trips']], [1, 0, 2])
+
+        for days in (7, 8, 9):
+            self.book(self.create_trip(days), self.seats[3])
+        with CaptureQueriesContext(connection) as more_queries:
+            response = self.get_as_conductor('get_last_7_bookings_for_home')
+        self.assertEqual(len(response.data['last_7_trips']), 6)
+        self.assertEqual(len(more_queries), len(queries))
+
+    def test_trip_details_revenue(self):
+        response = self.get_as_conductor('view_bus_trip_details', trip_id=self.bus_trips[0].id)
+        self.assertEqual(response.data['total_revenue'], Decimal('1940.00'))
+        self.assertEqual(len(response.data['booked_seats']), 2)
+
+    def test_passengers_cannot_read_revenue(self):
+        self.client.force_authenticate(self.passenger)
+        response = self.client.get(reverse('revenue'), HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 403)
+
+
+class DailyRollupTests(ConductorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bus_trip = self.create_trip()
+        self.book(self.bus_trip, self.seats[0])
+        self.book(self.bus_trip, self.seats[1], fare_price=2000)
+
+    def get_rollup(self, bus_trip=None):
+        bus_trip = bus_trip or self.bus_trip
+        return DailyRevenueRollup.objects.get(
+            bus=bus_trip.bus, route=bus_trip.route, date=localtime(bus_trip.start_time).date())
+
+    def rollup_values(self):
+        return list(DailyRevenueRollup.objects.order_by('date').values(
+            'date', 'trips_run', 'trips_canceled', 'seats_sold', 'bookings_canceled',
+            'revenue', 'unreleased_revenue', 'company_3_percent_cut', 'company_4_percent_cut'))
+
+    def test_bookings_update_the_rollup(self):
+        rollup = self.get_rollup()
+        self.assertEqual((rollup.trips_run, rollup.trips_canceled, rollup.seats_sold), (1, 0, 2))
+        self.assertEqual(rollup.revenue, Decimal('2910.00'))
+        self.assertEqual(rollup.unreleased_revenue, Decimal('2910.00'))
+        self.assertEqual(rollup.company_3_percent_cut, Decimal('90.00'))
+
+    def test_canceled_trips(self):
+        self.bus_trip.is_bustrip_canceled = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bus_trip.save()
+
+        rollup = self.get_rollup()
+        self.assertEqual((rollup.trips_run, rollup.trips_canceled, rollup.seats_sold), (0, 1, 0))
+        self.assertEqual(rollup.revenue, 0)
+
+    def test_moved_and_deleted_trips(self):
+        old_date = localtime(self.bus_trip.start_time).date()
+        self.bus_trip.start_time += timedelta(days=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bus_trip.save()
+        self.assertFalse(DailyRevenueRollup.objects.filter(date=old_date).exists())
+        self.assertEqual(self.get_rollup().seats_sold, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bus_trip.delete()
+        self.assertFalse(DailyRevenueRollup.objects.exists())
+
+    def test_rebuild_command_matches_the_live_rollups(self):
+        self.create_trip(days=2)
+        expected = self.rollup_values()
+        self.assertEqual(len(expected), 2)
+
+        DailyRevenueRollup.objects.all().delete()
+        stdout = StringIO()
+        call_command('rebuild_daily_rollups', stdout=stdout)
+        self.assertIn("Rebuilt 2 daily roll-ups.", stdout.getvalue())
+        self.assertEqual(self.rollup_values(), expected)
+
+        call_command('rebuild_daily_rollups', since=expected[1]['date'].isoformat(),
+                     stdout=StringIO())
+        self.assertEqual(self.rollup_values(), expected)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_daily_rollups', since="last week")
+
+    def test_each_bucket_is_refreshed_once_per_transaction(self):
+        booking = Booking.objects.get(bus_trip=self.bus_trip, seat=self.seats[0])
+        self.client.force_authenticate(self.passenger)
+        with mock.patch('conductor.rollups.refresh_daily_rollup',
+                        wraps=refresh_daily_rollup) as refresh:
+            # Ledger entry and booking save, in one transaction
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.delete(
+                    reverse('cancel_booking', args=[booking.id]), HTTP_HOST='passenger.lk')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(refresh.call_count, 1)
+
+            # Moving a trip with its bookings refreshes the old and the new day
+            refresh.reset_mock()
+            with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+                self.bus_trip.start_time += timedelta(days=2)
+                self.bus_trip.save()
+                for booking in Booking.objects.filter(bus_trip=self.bus_trip):
+                    booking.save()
+            self.assertEqual(refresh.call_count, 2)
+
+        rollup = self.get_rollup()
+        self.assertEqual((rollup.seats_sold, rollup.bookings_canceled), (1, 1))
+
+    def test_rolled_back_buckets_are_not_refreshed(self):
+        other_trip = self.create_trip(days=3)
+        with mock.patch('conductor.rollups.refresh_daily_rollup',
+                        wraps=refresh_daily_rollup) as refresh:
+            with self.captureOnCommitCallbacks(execute=True):
+                try:
+                    with transaction.atomic():
+                        queue_trip_rollup_refresh(other_trip)
+                        raise IntegrityError
+                except IntegrityError:
+                    pass
+                queue_trip_rollup_refresh(self.bus_trip)
+
+        refresh.assert_called_once_with(*trip_rollup_bucket(self.bus_trip))
+
+    def test_revenue_report_reads_the_rollups(self):
+        today = localdate()
+        start_of_week = today - timedelta(days=today.weekday())
+        trips_this_week = sum(
+            start_of_week <= localtime(bus_trip.start_time).date() <= start_of_week + timedelta(days=6)
+            for bus_trip in BusTrip.objects.filter(bus=self.bus))
+
+        response = self.get_as_conductor('home')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['unreleased_revenue'], Decimal('2910.00'))
+        self.assertEqual(response.data['total_trips_this_week'], trips_this_week)
+        self.assertEqual(len(response.data['last_5_bookings']), 2)
+
+
+class OfflineVerificationTests(ConductorTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        owner = User.objects.create(phone_number="0770000402")
+        cls.other_bus = Buses.objects.create(
+            bus_name="Uva", bus_number="UP-1", seat_count=32, owner=owner)
+
+    def setUp(self):
+        super().setUp()
+        self.bus_trip = self.create_trip()
+        self.bookings = [self.book(self.bus_trip, seat) for seat in self.seats[:3]]
+
+    def scan(self, booking):
+        return {"qr_code_data": generate_secure_qr_data(booking)}
+
+    def upload(self, scans):
+        self.client.force_authenticate(self.conductor)
+        return self.client.post(reverse('qr_scan_bulk'), {"scans": scans},
+                                format='json', HTTP_HOST='passenger.lk')
+
+    def test_manifest_digests_match_the_scans(self):
+        response = self.get_as_conductor('trip_manifest', trip_id=self.bus_trip.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {booking["booking_id"]: booking["qr_code_digest"] for booking in response.data["bookings"]},
+            {booking.id: qr_code_data_digest(self.scan(booking)["qr_code_data"])
+             for booking in self.bookings})
+
+        other_trip = self.create_trip(bus=self.other_bus)
+        response = self.get_as_conductor('trip_manifest', trip_id=other_trip.id)
+        self.assertEqual(response.status_code, 404)
+
+    def test_bulk_upload_reports_conflicts(self):
+        Booking.objects.filter(id=self.bookings[2].id).update(booking_status='BOOKING_CANCELED')
+        other_booking = self.book(self.create_trip(bus=self.other_bus), self.other_bus.seats.first())
+        tampered = self.scan(self.bookings[1])["qr_code_data"][:-2] + "xx"
+
+        response = self.upload([
+            self.scan(self.bookings[0]), self.scan(self.bookings[0]),
+            {"qr_code_data": tampered}, self.scan(self.bookings[2]),
+            self.scan(other_booking), {"qr_code_data": "not a ticket"}, "not a scan"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["verified_booking_ids"], [self.bookings[0].id])
+        self.assertEqual(
+            [conflict["reason"] for conflict in response.data["conflicts"]],
+            ["invalid_format", "invalid_format", "already_verified", "invalid_signature",
+             "canceled", "not_assigned_to_bus"])
+        self.assertEqual(
+            Booking.objects.get(id=self.bookings[0].id).booking_status, "VERIFIED")
+        self.assertNotEqual(
+            Booking.objects.get(id=self.bookings[1].id).booking_status, "VERIFIED")
+
+        # Scans uploaded again are already verified
+        response = self.upload([self.scan(self.bookings[0])])
+        self.assertEqual(response.data["conflicts"][0]["reason"], "already_verified")
+
+    def test_bulk_upload_limits(self):
+        self.assertEqual(self.upload([]).status_code, 400)
+        self.assertEqual(self.upload([self.scan(self.bookings[0])] * 501).status_code, 400)
+
+        self.client.force_authenticate(self.passenger)
+        response = self.client.post(reverse('qr_scan_bulk'), {"scans": [self.scan(self.bookings[0])]},
+                                    format='json', HTTP_HOST='passenger.lk')
+        self.assertEqual(response.status_code, 403)
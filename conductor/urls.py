@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import add_bus_trip, view_bus_trip_details, search_bus_routes, get_revenue_report, get_upcoming_trips, verify_booking, get_bus_trip_revenue, fetch_booking_details_for_conductor, cancel_bus_trip, get_last_7_trips_with_bookings, con_app_check_update
+from .views import add_bus_trip, view_bus_trip_details, search_bus_routes, get_revenue_report, get_upcoming_trips, verify_booking, get_bus_trip_revenue, fetch_booking_details_for_conductor, cancel_bus_trip, get_last_7_trips_with_bookings, con_app_check_update, get_trip_manifest, verify_bookings_bulk
 
 urlpatterns = [
     path('add-bus-trip/', add_bus_trip, name='add_bus_trip'),
@@ -11,6 +11,8 @@ urlpatterns = [
          name='fetch_booking_details_for_conductor'),
     path('upcoming-trips/', get_upcoming_trips, name='upcoming_trips'),
     path('qr_scan/', verify_booking, name='qr_scan'),
+    path('trip-manifest/<int:trip_id>/', get_trip_manifest, name='trip_manifest'),
+    path('qr_scan/bulk/', verify_bookings_bulk, name='qr_scan_bulk'),
     path('revenue/', get_bus_trip_revenue, name='revenue'),
     path('cancel-bus-trip/<int:trip_id>/',
          cancel_bus_trip, name='cancel-bus-trip'),
@@ -1,25 +1,67 @@
 from datetime import timedelta
-import hmac
-import hashlib
-import base64
 from django.utils.timezone import now
 from django.conf import settings
-from django.utils.timezone import localtime
-from django.db import models
+from django.utils.timezone import localtime, localdate
+from django.db import models, transaction
 from django.http import JsonResponse
-from django.db.models import Sum
+from django.core.paginator import Paginator
+from django.db.models import Count, Prefetch, Q, Sum
+from django.utils.dateparse import parse_date
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
 from busstops.models import BusRoute
 from busstops.utils import calculate_bus_trip_end_time, get_booking_info_with_SPandEP
-from booking.models import BusTrip, Booking
+from busstops.seat_map import SEAT_MAP_ENCODINGS
+from booking.models import BusTrip, Booking, CANCELED_BOOKING_STATUSES
+from booking.utils import generate_secure_qr_data, parse_qr_code_data, is_valid_qr_code_data, qr_code_data_digest
+from booking.revenue import annotate_trip_revenue, get_trip_revenue
 from members.models import User
-from .models import ConAppVersion
+from .models import ConAppVersion, DailyRevenueRollup
 
 SECRET_QR_KEY = settings.SECRET_KEY
 
+# Largest batch of offline scans accepted in one upload
+MAX_BULK_SCANS = 500
+
+TRIP_HISTORY_PAGE_SIZE = 20
+TRIP_HISTORY_MAX_PAGE_SIZE = 100
+
+
+def filter_trips_by_date(bus_trips, request):
+    """
+    Limit trips to the ?from= / ?to= start dates (inclusive, YYYY-MM-DD).
+    Returns None when a date cannot be parsed.
+    """
+    for param, lookup in (('from', 'start_time__date__gte'), ('to', 'start_time__date__lte')):
+        value = request.GET.get(param)
+        if not value:
+            continue
+        try:
+            date = parse_date(value)
+        except ValueError:
+            date = None
+        if date is None:
+            return None
+        bus_trips = bus_trips.filter(**{lookup: date})
+
+    return bus_trips
+
+
+def paginate_trips(bus_trips, request):
+    """
+    Page of trips for ?page= and ?page_size=, out of range pages give the last page.
+    """
+    try:
+        page_size = min(int(request.GET.get('page_size', TRIP_HISTORY_PAGE_SIZE)),
+                        TRIP_HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        page_size = TRIP_HISTORY_PAGE_SIZE
+
+    paginator = Paginator(bus_trips, max(page_size, 1))
+    return paginator.get_page(request.GET.get('page'))
+
 
 @api_view(['POST'])
 # @permission_classes([IsAuthenticated])
@@ -79,8 +121,10 @@ def view_bus_trip_details(request, trip_id):
 
     try:
         # Get the bus trip assigned to this conductor's bus
-        bus_trip = BusTrip.objects.get(id=trip_id, bus=bus)
-        bookings = Booking.objects.filter(bus_trip=bus_trip)
+        bus_trip = BusTrip.objects.select_related(
+            'bus', 'route').get(id=trip_id, bus=bus)
+        bookings = Booking.objects.filter(bus_trip=bus_trip).select_related(
+            'seat', 'start_point', 'end_point')
 
         # 🚍 Get booked seat details
         seat_data = [{
@@ -98,7 +142,7 @@ def view_bus_trip_details(request, trip_id):
             "bus_name": bus_trip.bus.bus_name,
             "route_name": bus_trip.route.name,
             "start_time": localtime(bus_trip.start_time).strftime("%Y-%m-%d %H:%M:%S"),
-            "total_revenue": bus_trip.revenue,
+            "total_revenue": get_trip_revenue(bus_trip),
             "is_revenue_released": bus_trip.is_revenue_released,  # ✅ New field
             "booked_seats": seat_data
         }, status=status.HTTP_200_OK)
@@ -146,25 +190,24 @@ def get_revenue_report(request):
     if not bus:
         return Response({"error": "Bus conductor is not assigned a bus."}, status=status.HTTP_400_BAD_REQUEST)
 
-    # 2. Calculate the revenue for trips where revenue is not released.
-    unreleased_revenue = BusTrip.objects.filter(
-        bus=bus, is_revenue_released=False
-    ).aggregate(total_revenue=Sum('revenue'))['total_revenue'] or 0.0
-
-    # 3. Total trips for the current week (starting from Monday)
-    start_of_week = now() - timedelta(days=now().weekday()
-                                      )  # Start of this week (Monday)
-    # End of this week (Sunday)
-    end_of_week = start_of_week + timedelta(days=7)
+    # 2. Unreleased revenue and this week's trips, read from the daily roll-ups
+    today = localdate()
+    start_of_week = today - timedelta(days=today.weekday())  # Monday
+    end_of_week = start_of_week + timedelta(days=6)  # Sunday
 
-    total_trips_this_week = BusTrip.objects.filter(
-        bus=bus, 
-        start_time__range=[start_of_week, end_of_week],
-        is_bustrip_canceled=False
-    ).count()
+    rollups = DailyRevenueRollup.objects.filter(bus=bus).aggregate(
+        unreleased_revenue=Sum('unreleased_revenue'),
+        total_trips_this_week=Sum('trips_run', filter=Q(
+            date__range=[start_of_week, end_of_week]))
+    )
+    unreleased_revenue = rollups['unreleased_revenue'] or 0
+    total_trips_this_week = rollups['total_trips_this_week'] or 0
 
     last_5_bookings = Booking.objects.filter(
-        bus_trip__bus=bus).order_by('-booked_at')[:5]
+        bus_trip__bus=bus
+    ).select_related(
+        'bus_trip', 'seat', 'start_point', 'end_point'
+    ).order_by('-booked_at')[:5]
 
     booking_data = [{
         "bus_trip_name": booking.bus_trip.name,
@@ -266,16 +309,8 @@ def verify_booking(request):
         if booking.booking_status == "VERIFIED":
             return Response({"error": "This booking has already been verified."}, status=status.HTTP_400_BAD_REQUEST)
 
-        # 🔒 Secure validation: Recalculate signature
-        expected_payload = f"{booking.id}|{booking.user.id}|{booking.bus_trip.id}"
-        expected_signature = hmac.new(
-            SECRET_QR_KEY.encode(), expected_payload.encode(), hashlib.sha256
-        ).digest()
-        expected_signature = base64.urlsafe_b64encode(
-            expected_signature).decode()
-
-        # ✅ Compare received and expected signatures
-        if not hmac.compare_digest(expected_signature, received_signature):
+        # 🔒 Secure validation: Compare received and expected signatures
+        if not is_valid_qr_code_data(booking, qr_code_data):
             return Response({"error": "QR Code is tampered or invalid."}, status=status.HTTP_400_BAD_REQUEST)
 
         # ✅ Verify the booking
@@ -285,7 +320,7 @@ def verify_booking(request):
         return Response({
             "message": "Booking verified successfully!",
             "bus_trip_id": bus_trip.id,
-            "new_revenue": bus_trip.revenue
+            "new_revenue": get_trip_revenue(bus_trip)
         }, status=status.HTTP_200_OK)
 
     except Booking.DoesNotExist:
@@ -295,12 +330,129 @@ def verify_booking(request):
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_trip_manifest(request, trip_id):
+    """
+    Download the bookings of a trip so the conductor app or machine can verify
+    QR codes offline. Each booking carries the SHA-256 of its expected QR code
+    data: a scan is valid when the digest of the scanned data matches.
+    Scans are uploaded later through verify_bookings_bulk.
+    """
+    user = request.user
+
+    if user.role != User.Role.BUS_CONDUCTOR:
+        return Response({"error": "Only bus conductors can download trip manifests."}, status=status.HTTP_403_FORBIDDEN)
+
+    bus = getattr(user, 'bus', None)
+    if not bus:
+        return Response({"error": "No bus assigned to this conductor."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        bus_trip = BusTrip.objects.get(id=trip_id, bus=bus)
+    except BusTrip.DoesNotExist:
+        return Response({"error": "Bus trip not found or not assigned to this conductor."}, status=status.HTTP_404_NOT_FOUND)
+
+    bookings = Booking.objects.filter(bus_trip=bus_trip).select_related(
+        'seat', 'start_point', 'end_point').order_by('seat__seat_number')
+
+    return Response({
+        "bus_trip_id": bus_trip.id,
+        "bus_trip_name": bus_trip.name,
+        "start_time": localtime(bus_trip.start_time).strftime("%Y-%m-%d %H:%M:%S"),
+        "is_bustrip_canceled": bus_trip.is_bustrip_canceled,
+        "generated_at": localtime(now()).strftime("%Y-%m-%d %H:%M:%S"),
+        "digest_algorithm": "sha256",
+        "bookings": [{
+            "booking_id": booking.id,
+            "seat_number": booking.seat.seat_number,
+            "start_point": booking.start_point.name,
+            "end_point": booking.end_point.name,
+            "booking_status": booking.booking_status,
+            "qr_code_digest": qr_code_data_digest(generate_secure_qr_data(booking))
+        } for booking in bookings]
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def verify_bookings_bulk(request):
+    """
+    Upload QR scans made offline: {"scans": [{"qr_code_data": "..."}, ...]}.
+    All valid scans are marked VERIFIED in one transaction; every scan that
+    could not be applied (double scans, canceled or tampered tickets, other
+    buses) is reported back in conflicts with the reason.
+    """
+    user = request.user
+
+    if user.role != User.Role.BUS_CONDUCTOR:
+        return Response({"error": "Only bus conductors can verify tickets."}, status=status.HTTP_403_FORBIDDEN)
+
+    bus = getattr(user, 'bus', None)
+    if not bus:
+        return Response({"error": "No bus assigned to this conductor."}, status=status.HTTP_400_BAD_REQUEST)
+
+    scans = request.data.get("scans")
+    if not isinstance(scans, list) or not scans:
+        return Response({"error": "A list of scans is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    if len(scans) > MAX_BULK_SCANS:
+        return Response({"error": f"At most {MAX_BULK_SCANS} scans can be uploaded at once."}, status=status.HTTP_400_BAD_REQUEST)
+
+    conflicts = []
+    parsed_scans = []
+    for scan in scans:
+        qr_code_data = scan.get("qr_code_data") if isinstance(scan, dict) else None
+        parsed = parse_qr_code_data(qr_code_data) if qr_code_data else None
+        if parsed is None:
+            conflicts.append({"qr_code_data": qr_code_data, "reason": "invalid_format"})
+        else:
+            parsed_scans.append((qr_code_data, parsed))
+
+    verified_ids = []
+    with transaction.atomic():
+        # 🔒 Lock the scanned bookings so concurrent uploads cannot verify twice
+        bookings = Booking.objects.select_for_update().select_related('bus_trip').in_bulk(
+            {booking_id for _, (booking_id, _, _, _) in parsed_scans})
+
+        for qr_code_data, (booking_id, user_id, bus_trip_id, _) in parsed_scans:
+            booking = bookings.get(booking_id)
+
+            if booking is None or booking.user_id != user_id or booking.bus_trip_id != bus_trip_id:
+                reason = "not_found"
+            elif not is_valid_qr_code_data(booking, qr_code_data):
+                reason = "invalid_signature"
+            elif booking.bus_trip.bus_id != bus.id:
+                reason = "not_assigned_to_bus"
+            elif booking.booking_status in CANCELED_BOOKING_STATUSES:
+                reason = "canceled"
+            elif booking.booking_status == "VERIFIED" or booking_id in verified_ids:
+                reason = "already_verified"
+            else:
+                verified_ids.append(booking_id)
+                continue
+
+            conflicts.append({"qr_code_data": qr_code_data,
+                             "booking_id": booking_id, "reason": reason})
+
+        # ✅ Apply all verifications at once
+        Booking.objects.filter(id__in=verified_ids).update(
+            booking_status="VERIFIED", updated_at=now())
+
+    return Response({
+        "message": f"{len(verified_ids)} bookings verified.",
+        "verified_booking_ids": verified_ids,
+        "conflicts": conflicts
+    }, status=status.HTTP_200_OK)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_bus_trip_revenue(request):
     """
-    Fetch revenue details for each bus trip of the logged-in bus conductor.
+    Fetch revenue details for each bus trip of the logged-in bus conductor, newest first.
     Includes trip name, start time, total revenue, number of reserved seats, and if the revenue is released.
+    Query params: from / to (YYYY-MM-DD, trip start date), page, page_size.
     """
     user = request.user
 
@@ -314,27 +466,33 @@ def get_bus_trip_revenue(request):
     if not bus:
         return Response({"error": "Bus conductor is not assigned to a bus."}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Fetch all bus trips for this conductor's bus
-    bus_trips = BusTrip.objects.filter(bus=bus).values(
-        'id', 'name', 'start_time', 'is_revenue_released', 'revenue'
-    )
+    bus_trips = filter_trips_by_date(BusTrip.objects.filter(bus=bus), request)
+    if bus_trips is None:
+        return Response({"error": "from and to must be dates (YYYY-MM-DD)."}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Prepare the response data
-    trip_data = []
-    for trip in bus_trips:
-        # Count the number of reserved seats
-        reserved_seats = Booking.objects.filter(bus_trip_id=trip['id']).count()
+    # Reserved seats are counted in the same query as the trips
+    bus_trips = annotate_trip_revenue(bus_trips).annotate(
+        reserved_seats=Count('seat')
+    ).values(
+        'id', 'name', 'start_time', 'is_revenue_released', 'total_revenue', 'reserved_seats'
+    ).order_by('-start_time', '-id')
 
-        trip_data.append({
-            'bus_trip_name': trip['name'],
-            'bus_trip_start_time': localtime(trip['start_time']).strftime("%Y-%m-%d %H:%M:%S"),
-            'bus_trip_revenue': trip['revenue'],
-            'reserved_seats': reserved_seats,
-            'is_revenue_released': trip['is_revenue_released']
-        })
+    page = paginate_trips(bus_trips, request)
+
+    # Prepare the response data
+    trip_data = [{
+        'bus_trip_name': trip['name'],
+        'bus_trip_start_time': localtime(trip['start_time']).strftime("%Y-%m-%d %H:%M:%S"),
+        'bus_trip_revenue': trip['total_revenue'],
+        'reserved_seats': trip['reserved_seats'],
+        'is_revenue_released': trip['is_revenue_released']
+    } for trip in page]
 
     return Response({
-        'bus_trip_revenues': trip_data
+        'bus_trip_revenues': trip_data,
+        'page': page.number,
+        'total_pages': page.paginator.num_pages,
+        'total_trips': page.paginator.count
     }, status=status.HTTP_200_OK)
 
 
@@ -344,9 +502,15 @@ def fetch_booking_details_for_conductor(request):
     """
     API view to fetch seat details (available, non-available, and seat type)
     for a given bus trip ID.
+    Optional ?encoding=bitmap|rle returns a compact seat map instead.
     """
     bus_trip_id = request.GET.get('bus_trip_id')
-    seat_details = get_booking_info_with_SPandEP(bus_trip_id)
+    encoding = request.GET.get('encoding')
+
+    if encoding and encoding not in SEAT_MAP_ENCODINGS:
+        return Response({"error": "encoding must be bitmap or rle."}, status=status.HTTP_400_BAD_REQUEST)
+
+    seat_details = get_booking_info_with_SPandEP(bus_trip_id, encoding)
 
     # Check if an error occurred in the utility function
     if "error" in seat_details:
@@ -364,8 +528,7 @@ def cancel_bus_trip(request, trip_id):
     try:
         bus_trip = BusTrip.objects.get(id=trip_id)
         bus_trip.is_bustrip_canceled = True
-        bus_trip.revenue = 0.0
-        bus_trip.save()  # Automatically updates related bookings
+        bus_trip.save()  # Automatically voids the revenue and updates related bookings
 
         return Response({"message": "Bus trip canceled, and all bookings updated."}, status=status.HTTP_200_OK)
 
@@ -378,6 +541,7 @@ def cancel_bus_trip(request, trip_id):
 def get_last_7_trips_with_bookings(request):
     """
     API to fetch the last 7 bus trips for the logged-in bus conductor.
+    Optional from / to (YYYY-MM-DD) limit the trips to a date range.
     Includes all bookings for each trip with:
     - Seat Number
     - Start Point
@@ -394,14 +558,20 @@ def get_last_7_trips_with_bookings(request):
     if not bus:
         return Response({"error": "Bus conductor is not assigned to a bus."}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Fetch last 7 bus trips
-    last_7_trips = BusTrip.objects.filter(bus=bus).order_by('-start_time')[:7]
+    bus_trips = filter_trips_by_date(BusTrip.objects.filter(bus=bus), request)
+    if bus_trips is None:
+        return Response({"error": "from and to must be dates (YYYY-MM-DD)."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Fetch last 7 bus trips, with all their bookings in one extra query
+    last_7_trips = bus_trips.prefetch_related(
+        Prefetch('seat', queryset=Booking.objects.select_related(
+            'seat', 'start_point', 'end_point').order_by('-booked_at'), to_attr='trip_bookings')
+    ).order_by('-start_time')[:7]
 
     # Prepare trip data
     trip_data = []
     for trip in last_7_trips:
-        # Fetch all bookings for this trip
-        bookings = Booking.objects.filter(bus_trip=trip).order_by('-booked_at')
+        bookings = trip.trip_bookings
 
         # Format booking details
         booking_data = [{
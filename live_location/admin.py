@@ -1,7 +1,14 @@
 from django.contrib import admin
-from .models import LiveLocation
+from .models import LiveLocation, LocationHistoryBucket
 
 
 @admin.register(LiveLocation)
 class LiveLocationAdmin(admin.ModelAdmin):
     list_display = ('bus', 'latitude', 'longitude', 'last_updated')
+
+
+@admin.register(LocationHistoryBucket)
+class LocationHistoryBucketAdmin(admin.ModelAdmin):
+    list_display = ('bus', 'bus_trip', 'bucket_start', 'point_count', 'resolution')
+    list_filter = ('resolution',)
+    exclude = ('encoded_points',)
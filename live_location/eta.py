@@ -0,0 +1,220 @@
+# live_location/eta.py
+import math
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+from busstops.models import RouteStopPosition
+from busstops.utils import ensure_trip_timetable
+from .history import LOCATION_HISTORY_TRIP_OVERRUN
+from .store import get_cached_live_location, haversine_distance
+
+# Route geometry only changes with sections or boarding points (cleared by signals)
+ROUTE_GEOMETRY_TTL = getattr(settings, 'ROUTE_GEOMETRY_TTL', 60 * 60)
+# Live ETAs of a trip are reused until the bus pings again, at most this long (in seconds)
+TRIP_ETA_TTL = getattr(settings, 'TRIP_ETA_TTL', 60)
+# Positions older than this (in seconds) are not used, the timetable is
+TRIP_ETA_MAX_POSITION_AGE = getattr(settings, 'TRIP_ETA_MAX_POSITION_AGE', 5 * 60)
+# A bus further than this from its route (in meters) is not snapped onto it
+TRIP_ETA_MAX_OFF_ROUTE = getattr(settings, 'TRIP_ETA_MAX_OFF_ROUTE', 2000)
+
+METERS_PER_DEGREE = 111320
+
+
+def route_geometry_key(route_id):
+    return f"route_geometry_{route_id}"
+
+
+def trip_eta_key(bus_trip_id):
+    return f"trip_eta_{bus_trip_id}"
+
+
+def clear_route_geometry(*route_ids):
+    cache.delete_many([route_geometry_key(route_id) for route_id in route_ids])
+
+
+def build_route_geometry(route_id):
+    """
+    Ordered stops of a route: by section position, and within a section from
+    the nearest to the previous stop onwards (sections don't order their points).
+    The route starts at the stop of the first section furthest from the next
+    section (from the other stops for single-section routes).
+
+    Returns:
+        list: [(boarding_point_id, position, latitude, longitude, distance_m), ...]
+              where distance_m is the distance along the route from the first stop.
+    """
+    rows = RouteStopPosition.objects.filter(bus_route_id=route_id).order_by(
+        'position', 'boarding_point_id').values_list(
+        'boarding_point_id', 'position', 'boarding_point__latitude', 'boarding_point__longitude')
+
+    sections = {}
+    for row in rows:
+        sections.setdefault(row[1], []).append(row)
+
+    positions = sorted(sections)
+    if positions and len(sections[positions[0]]) > 1:
+        anchor_rows = sections[positions[1]] if len(positions) > 1 else sections[positions[0]]
+        anchor_latitude = sum(row[2] for row in anchor_rows) / len(anchor_rows)
+        anchor_longitude = sum(row[3] for row in anchor_rows) / len(anchor_rows)
+        sections[positions[0]].sort(key=lambda row: -haversine_distance(
+            anchor_latitude, anchor_longitude, row[2], row[3]))
+
+    stops = []
+    for position in positions:
+        remaining = sections[position]
+        while remaining:
+            if stops:
+                _, _, latitude, longitude, _ = stops[-1]
+                remaining.sort(key=lambda row: haversine_distance(
+                    latitude, longitude, row[2], row[3]))
+            boarding_point_id, _, latitude, longitude = remaining.pop(0)
+
+            distance = 0.0
+            if stops:
+                previous = stops[-1]
+                distance = previous[4] + haversine_distance(
+                    previous[2], previous[3], latitude, longitude)
+            stops.append((boarding_point_id, position, latitude, longitude, distance))
+
+    return stops
+
+
+def get_route_geometry(route_id):
+    geometry = cache.get(route_geometry_key(route_id))
+    if geometry is None:
+        geometry = build_route_geometry(route_id)
+        cache.set(route_geometry_key(route_id), geometry, timeout=ROUTE_GEOMETRY_TTL)
+    return geometry
+
+
+def project_onto_route(stops, latitude, longitude):
+    """
+    Snap a position onto the polyline through the stops.
+
+    Returns:
+        tuple: (distance along the route in meters, distance off the route in meters)
+    """
+    if len(stops) == 1:
+        return 0.0, haversine_distance(stops[0][2], stops[0][3], latitude, longitude)
+
+    # Local equirectangular plane around the position, accurate at route scale
+    x_scale = METERS_PER_DEGREE * math.cos(math.radians(latitude))
+
+    best = None
+    for start, end in zip(stops, stops[1:]):
+        ax, ay = (start[3] - longitude) * x_scale, (start[2] - latitude) * METERS_PER_DEGREE
+        bx, by = (end[3] - longitude) * x_scale, (end[2] - latitude) * METERS_PER_DEGREE
+        dx, dy = bx - ax, by - ay
+        length_squared = dx * dx + dy * dy
+
+        fraction = 0.0
+        if length_squared:
+            fraction = min(1.0, max(0.0, -(ax * dx + ay * dy) / length_squared))
+        off_route = math.hypot(ax + fraction * dx, ay + fraction * dy)
+
+        if best is None or off_route < best[1]:
+            best = (start[4] + fraction * (end[4] - start[4]), off_route)
+
+    return best
+
+
+def _scheduled_offset_at(stops, offsets, distance):
+    # Seconds from the trip start until the bus is scheduled to be at that
+    # distance along the route, interpolated between the stops around it
+    for start, end in zip(stops, stops[1:]):
+        if distance <= end[4]:
+            span = end[4] - start[4]
+            fraction = (distance - start[4]) / span if span else 1.0
+            return offsets[start[0]] + fraction * (offsets[end[0]] - offsets[start[0]])
+    return offsets[stops[-1][0]]
+
+
+def compute_trip_etas(bus_trip, position, current_time=None):
+    """
+    Live ETAs of a trip from the latest position of its bus, None when the
+    position can't be used (bus off the route, route without stops).
+
+    Returns:
+        dict: {
+            "position_updated": datetime of the ping used,
+            "progress_m": distance covered along the route,
+            "route_length_m": length of the route,
+            "delay_seconds": how late the bus runs against the timetable,
+            "stops": {boarding_point_id: arrival datetime, or None once passed},
+        }
+    """
+    current_time = current_time or now()
+    stops = get_route_geometry(bus_trip.route_id)
+    if not stops:
+        return None
+
+    progress, off_route = project_onto_route(
+        stops, position["latitude"], position["longitude"])
+    if off_route > TRIP_ETA_MAX_OFF_ROUTE:
+        return None
+
+    ensure_trip_timetable(bus_trip)
+    offsets = {
+        boarding_point_id: bus_trip.timetable.get(
+            str(stop_position), (bus_trip.end_time - bus_trip.start_time).total_seconds())
+        for boarding_point_id, stop_position, _, _, _ in stops
+    }
+    progress_offset = _scheduled_offset_at(stops, offsets, progress)
+    elapsed = (current_time - bus_trip.start_time).total_seconds()
+
+    return {
+        "position_updated": position["last_updated"],
+        "progress_m": round(progress),
+        "route_length_m": round(stops[-1][4]),
+        "delay_seconds": round(elapsed - progress_offset),
+        "stops": {
+            boarding_point_id: None if distance < progress else current_time + timedelta(
+                seconds=max(0.0, offsets[boarding_point_id] - progress_offset))
+            for boarding_point_id, _, _, _, distance in stops
+        },
+    }
+
+
+def get_trip_etas(bus_trip):
+    """
+    Live ETAs of a running trip (see compute_trip_etas), computed at most once
+    per ping of its bus. None when the trip isn't running or the bus has no
+    recent position, callers then fall back to the timetable.
+    """
+    current_time = now()
+    ensure_trip_timetable(bus_trip)
+    if not bus_trip.start_time <= current_time <= bus_trip.end_time + LOCATION_HISTORY_TRIP_OVERRUN:
+        return None
+
+    position = get_cached_live_location(bus_trip.bus_id)
+    if position is None or (current_time - position["last_updated"]).total_seconds() > TRIP_ETA_MAX_POSITION_AGE:
+        return None
+
+    etas = cache.get(trip_eta_key(bus_trip.id))
+    if etas is None or etas["position_updated"] != position["last_updated"]:
+        etas = compute_trip_etas(bus_trip, position, current_time)
+        if etas is None:
+            return None
+        cache.set(trip_eta_key(bus_trip.id), etas, timeout=TRIP_ETA_TTL)
+
+    return etas
+
+
+def get_live_stop_eta(bus_trip, boarding_point_id, scheduled_time):
+    """
+    ETA of a trip at a boarding point for API responses.
+
+    Returns:
+        dict: {"eta": datetime or None once passed, "source": "live" or "schedule",
+               "delay_minutes": int or None}
+    """
+    etas = get_trip_etas(bus_trip)
+    if etas is None or boarding_point_id not in etas["stops"]:
+        return {"eta": scheduled_time, "source": "schedule", "delay_minutes": None}
+
+    return {
+        "eta": etas["stops"][boarding_point_id],
+        "source": "live",
+        "delay_minutes": round(etas["delay_seconds"] / 60),
+    }
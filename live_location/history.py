@@ -0,0 +1,240 @@
+# live_location/history.py
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+from booking.models import BusTrip
+from busstops.models import Buses
+from .models import LocationHistoryBucket
+
+# Length of one history bucket (in seconds)
+LOCATION_HISTORY_BUCKET_SECONDS = getattr(
+    settings, 'LOCATION_HISTORY_BUCKET_SECONDS', 10 * 60)
+# Buckets older than this many days keep one point per LOCATION_HISTORY_DOWNSAMPLE_RESOLUTION seconds
+LOCATION_HISTORY_DOWNSAMPLE_AFTER_DAYS = getattr(
+    settings, 'LOCATION_HISTORY_DOWNSAMPLE_AFTER_DAYS', 7)
+LOCATION_HISTORY_DOWNSAMPLE_RESOLUTION = getattr(
+    settings, 'LOCATION_HISTORY_DOWNSAMPLE_RESOLUTION', 30)
+# Points up to this long after a trip's scheduled end still belong to it (late running)
+LOCATION_HISTORY_TRIP_OVERRUN = timedelta(seconds=getattr(
+    settings, 'LOCATION_HISTORY_TRIP_OVERRUN', 60 * 60))
+# Buckets older than this many days are deleted
+LOCATION_HISTORY_RETENTION_DAYS = getattr(
+    settings, 'LOCATION_HISTORY_RETENTION_DAYS', 180)
+
+# Coordinates are stored as integers of 1e-5 degrees (about 1 m)
+COORDINATE_SCALE = 100000
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+# --- Encoding ------------------------------------------------------------
+# Each point is three zigzag varints: seconds since the previous point (the
+# first one since bucket_start), then the latitude and longitude deltas.
+# A bus moving along a road takes 3-6 bytes per point.
+
+def _write_varint(buffer, value):
+    value = (value << 1) ^ (value >> 63)  # zigzag: small negatives stay small
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varints(data):
+    value, shift = 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        yield (value >> 1) ^ -(value & 1)
+        value, shift = 0, 0
+
+
+def encode_points(bucket_start, points):
+    """
+    Delta-encode ordered (timestamp, latitude, longitude) points of a bucket.
+    """
+    buffer = bytearray()
+    previous_offset, previous_latitude, previous_longitude = 0, 0, 0
+
+    for timestamp, latitude, longitude in points:
+        offset = int((timestamp - bucket_start).total_seconds())
+        latitude = round(latitude * COORDINATE_SCALE)
+        longitude = round(longitude * COORDINATE_SCALE)
+
+        _write_varint(buffer, offset - previous_offset)
+        _write_varint(buffer, latitude - previous_latitude)
+        _write_varint(buffer, longitude - previous_longitude)
+        previous_offset, previous_latitude, previous_longitude = offset, latitude, longitude
+
+    return bytes(buffer)
+
+
+def decode_points(bucket_start, data):
+    """
+    Ordered (timestamp, latitude, longitude) points of an encoded bucket.
+    """
+    values = list(_read_varints(bytes(data)))
+    points = []
+    offset, latitude, longitude = 0, 0, 0
+
+    for index in range(0, len(values), 3):
+        offset += values[index]
+        latitude += values[index + 1]
+        longitude += values[index + 2]
+        points.append((bucket_start + timedelta(seconds=offset),
+                       latitude / COORDINATE_SCALE, longitude / COORDINATE_SCALE))
+
+    return points
+
+
+def encode_polyline(coordinates):
+    """
+    Google encoded polyline (precision 5) of (latitude, longitude) pairs,
+    which map SDKs draw directly.
+    """
+    result = []
+    previous_latitude, previous_longitude = 0, 0
+
+    for latitude, longitude in coordinates:
+        latitude = round(latitude * COORDINATE_SCALE)
+        longitude = round(longitude * COORDINATE_SCALE)
+        for delta in (latitude - previous_latitude, longitude - previous_longitude):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                result.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            result.append(chr(value + 63))
+        previous_latitude, previous_longitude = latitude, longitude
+
+    return "".join(result)
+
+
+# --- Storage -------------------------------------------------------------
+
+def bucket_start_for(timestamp):
+    seconds = int((timestamp - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % LOCATION_HISTORY_BUCKET_SECONDS)
+
+
+def downsample(points, resolution):
+    """
+    Keep the first point of every resolution-second slot.
+    """
+    if resolution <= 1:
+        return list(points)
+
+    kept, last_slot = [], None
+    for point in points:
+        slot = int((point[0] - EPOCH).total_seconds()) // resolution
+        if slot != last_slot:
+            kept.append(point)
+            last_slot = slot
+    return kept
+
+
+def _trip_for(bus_trips, timestamp):
+    # The latest trip that has started, as long as it is not long over
+    trip_id = None
+    for bus_trip in bus_trips:
+        if bus_trip.start_time > timestamp:
+            break
+        if bus_trip.end_time is None or timestamp <= bus_trip.end_time + LOCATION_HISTORY_TRIP_OVERRUN:
+            trip_id = bus_trip.id
+    return trip_id
+
+
+def record_location_trace(bus, points):
+    """
+    Merge ordered (timestamp, latitude, longitude) points into the history
+    buckets of the bus, attributing each point to the trip running at the time.
+    One read and one write per touched bucket, whatever the number of points.
+    """
+    if not points:
+        return
+
+    # Offsets are stored in whole seconds
+    points = [(timestamp.replace(microsecond=0), latitude, longitude)
+              for timestamp, latitude, longitude in points]
+
+    # Trips of the bus that overlap the trace, allowing for late arrivals
+    bus_trips = list(BusTrip.objects.filter(
+        bus=bus, is_bustrip_canceled=False,
+        start_time__lte=points[-1][0]
+    ).filter(
+        Q(end_time__isnull=True) | Q(end_time__gte=points[0][0] - LOCATION_HISTORY_TRIP_OVERRUN)
+    ).order_by('start_time'))
+
+    grouped = {}
+    for point in points:
+        key = (_trip_for(bus_trips, point[0]), bucket_start_for(point[0]))
+        grouped.setdefault(key, []).append(point)
+
+    with transaction.atomic():
+        # Serializes the traces of a bus: the unique constraint doesn't stop
+        # two workers from creating the same bucket when bus_trip is NULL
+        Buses.objects.select_for_update().filter(id=bus.id).exists()
+
+        for (bus_trip_id, bucket_start), new_points in grouped.items():
+            bucket = LocationHistoryBucket.objects.filter(
+                bus=bus, bus_trip_id=bus_trip_id, bucket_start=bucket_start).order_by('id').first()
+            if bucket is None:
+                bucket = LocationHistoryBucket(
+                    bus=bus, bus_trip_id=bus_trip_id, bucket_start=bucket_start)
+
+            merged = {point[0]: point for point in decode_points(
+                bucket_start, bucket.encoded_points)}
+            merged.update((point[0], point) for point in new_points)
+            merged_points = downsample(
+                [merged[timestamp] for timestamp in sorted(merged)], bucket.resolution)
+
+            bucket.encoded_points = encode_points(bucket_start, merged_points)
+            bucket.point_count = len(merged_points)
+            bucket.save()
+
+
+def get_trip_trace(bus_trip_id, resolution=0):
+    """
+    Ordered (timestamp, latitude, longitude) points recorded for a trip,
+    downsampled to one point per resolution seconds.
+    """
+    points = []
+    buckets = LocationHistoryBucket.objects.filter(
+        bus_trip_id=bus_trip_id).order_by('bucket_start').values_list('bucket_start', 'encoded_points')
+    for bucket_start, encoded_points in buckets:
+        points.extend(decode_points(bucket_start, encoded_points))
+
+    return downsample(points, resolution)
+
+
+def compact_location_history(downsample_after_days=LOCATION_HISTORY_DOWNSAMPLE_AFTER_DAYS,
+                             resolution=LOCATION_HISTORY_DOWNSAMPLE_RESOLUTION,
+                             retention_days=LOCATION_HISTORY_RETENTION_DAYS):
+    """
+    Apply the retention and downsampling policies.
+
+    Returns:
+        tuple: (buckets deleted, buckets downsampled)
+    """
+    current_time = now()
+
+    deleted, _ = LocationHistoryBucket.objects.filter(
+        bucket_start__lt=current_time - timedelta(days=retention_days)).delete()
+
+    downsampled = 0
+    stale_buckets = LocationHistoryBucket.objects.filter(
+        bucket_start__lt=current_time - timedelta(days=downsample_after_days),
+        resolution__lt=resolution
+    )
+    for bucket in stale_buckets.iterator():
+        points = downsample(decode_points(
+            bucket.bucket_start, bucket.encoded_points), resolution)
+        LocationHistoryBucket.objects.filter(id=bucket.id).update(
+            encoded_points=encode_points(bucket.bucket_start, points),
+            point_count=len(points), resolution=resolution)
+        downsampled += 1
+
+    return deleted, downsampled
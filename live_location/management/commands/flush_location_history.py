@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from live_location.store import flush_history_buffers
+
+
+class Command(BaseCommand):
+    help = "Record the buffered GPS pings of the buses in their location history."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=int, metavar='SECONDS',
+                            help="Keep running, flushing every SECONDS.")
+
+    def handle(self, *args, **options):
+        while True:
+            flushed = flush_history_buffers()
+            if not options['loop']:
+                self.stdout.write(self.style.SUCCESS(
+                    f"Flushed the location history of {flushed} buses."))
+                return
+
+            if flushed:
+                self.stdout.write(f"Flushed the location history of {flushed} buses.")
+            time.sleep(options['loop'])
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from live_location.history import (
+    compact_location_history, LOCATION_HISTORY_DOWNSAMPLE_AFTER_DAYS,
+    LOCATION_HISTORY_DOWNSAMPLE_RESOLUTION, LOCATION_HISTORY_RETENTION_DAYS)
+
+
+class Command(BaseCommand):
+    help = "Downsample old location history buckets and delete expired ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--downsample-after-days', type=int,
+                            default=LOCATION_HISTORY_DOWNSAMPLE_AFTER_DAYS)
+        parser.add_argument('--resolution', type=int,
+                            default=LOCATION_HISTORY_DOWNSAMPLE_RESOLUTION,
+                            help="Seconds between kept points in downsampled buckets.")
+        parser.add_argument('--retention-days', type=int,
+                            default=LOCATION_HISTORY_RETENTION_DAYS)
+
+    def handle(self, *args, **options):
+        deleted, downsampled = compact_location_history(
+            downsample_after_days=options['downsample_after_days'],
+            resolution=options['resolution'],
+            retention_days=options['retention_days'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted} and downsampled {downsampled} location history buckets."))
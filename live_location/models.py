@@ -1,5 +1,6 @@
 from django.db import models
 from busstops.models import Buses
+from booking.models import BusTrip
 from django.utils.timezone import now
 
 
@@ -13,3 +14,30 @@ class LiveLocation(models.Model):
 
     def __str__(self):
         return f"Live Location of {self.bus.bus_name} - ({self.latitude}, {self.longitude})"
+
+
+class LocationHistoryBucket(models.Model):
+    """
+    GPS trace of a bus over one fixed time bucket, stored as a single
+    delta-encoded array instead of one row per ping (see live_location.history).
+    """
+    bus = models.ForeignKey(
+        Buses, on_delete=models.CASCADE, related_name='location_history')
+    bus_trip = models.ForeignKey(
+        BusTrip, on_delete=models.CASCADE, null=True, blank=True, related_name='location_history')
+    bucket_start = models.DateTimeField()
+    point_count = models.PositiveIntegerField(default=0)
+    # Seconds between kept points once downsampled, 0 while it holds every ping
+    resolution = models.PositiveIntegerField(default=0)
+    encoded_points = models.BinaryField(default=b'')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('bus', 'bus_trip', 'bucket_start')
+        indexes = [
+            models.Index(fields=['bus_trip', 'bucket_start']),
+            models.Index(fields=['bucket_start']),
+        ]
+
+    def __str__(self):
+        return f"{self.bus.bus_name} - {self.bucket_start} ({self.point_count} points)"
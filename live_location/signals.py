@@ -1,7 +1,13 @@
-from django.db.models.signals import post_save
-from django.dispatch import receiver
-from busstops.models import Buses
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver, Signal
+from busstops.models import Buses, BoardingPoint, Section, RouteStopPosition
 from .models import LiveLocation
+from .history import record_location_trace
+from .eta import clear_route_geometry
+
+# Sent with bus and points (ordered, de-duplicated (timestamp, latitude, longitude)
+# tuples) for every GPS trace uploaded in bulk, for history storage.
+location_trace_received = Signal()
 
 
 @receiver(post_save, sender=Buses)
@@ -12,3 +18,34 @@ def create_live_location(sender, instance, created, **kwargs):
     if created:
         LiveLocation.objects.create(
             bus=instance, latitude=0.0, longitude=0.0)  # Default values
+
+
+@receiver(location_trace_received)
+def store_location_trace(sender, bus, points, **kwargs):
+    """
+    Keep uploaded GPS traces in the location history.
+    """
+    record_location_trace(bus, points)
+
+
+@receiver(post_save, sender=Section)
+@receiver(post_delete, sender=Section)
+@receiver(m2m_changed, sender=Section.section_boarding_points.through)
+def clear_section_route_geometry(sender, instance, **kwargs):
+    """
+    Re-order the stops used for live ETAs when a route's sections change.
+    """
+    if isinstance(instance, Section):
+        clear_route_geometry(instance.bus_route_id)
+    else:
+        clear_route_geometry(*RouteStopPosition.objects.filter(
+            boarding_point=instance).values_list('bus_route_id', flat=True))
+
+
+@receiver(post_save, sender=BoardingPoint)
+def clear_boarding_point_route_geometry(sender, instance, **kwargs):
+    """
+    Moved boarding points change the geometry of every route serving them.
+    """
+    clear_route_geometry(*RouteStopPosition.objects.filter(
+        boarding_point=instance).values_list('bus_route_id', flat=True))
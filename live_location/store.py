@@ -0,0 +1,252 @@
+# live_location/store.py
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+from busstops.models import Buses
+from busstops.spatial import GridIndex, haversine_distance
+from .models import LiveLocation
+from .history import record_location_trace
+from .stream import publish_live_location
+
+# How long a position is kept after the last ping (in seconds)
+LIVE_LOCATION_TTL = getattr(settings, 'LIVE_LOCATION_TTL', 30 * 60)
+# The database row is written back this often per bus (in seconds)...
+LIVE_LOCATION_WRITE_BACK_INTERVAL = getattr(
+    settings, 'LIVE_LOCATION_WRITE_BACK_INTERVAL', 60)
+# ...or once the bus has moved this far since the last write (in meters),
+LIVE_LOCATION_WRITE_BACK_DISTANCE = getattr(
+    settings, 'LIVE_LOCATION_WRITE_BACK_DISTANCE', 250)
+# but never more often than this (in seconds)
+LIVE_LOCATION_WRITE_BACK_MIN_INTERVAL = getattr(
+    settings, 'LIVE_LOCATION_WRITE_BACK_MIN_INTERVAL', 20)
+# Map queries share a per-process snapshot of the live positions this long (in seconds)
+LIVE_BUS_INDEX_TTL = getattr(settings, 'LIVE_BUS_INDEX_TTL', 5)
+
+
+def live_location_key(bus_id):
+    return f"live_location_{bus_id}"
+
+
+def write_back_lock_key(bus_id):
+    return f"live_location_write_back_{bus_id}"
+
+
+def history_buffer_key(bus_id):
+    return f"live_location_history_buffer_{bus_id}"
+
+
+def uses_redis_buffers():
+    """
+    Buffer pings in Redis lists when the cache is Redis (atomic RPUSH), so
+    concurrent pings of a bus are all kept; otherwise in a cached list.
+    """
+    return settings.CACHES['default']['BACKEND'].startswith('django_redis')
+
+
+def buffer_history_point(bus_id, timestamp, latitude, longitude):
+    key = history_buffer_key(bus_id)
+    if uses_redis_buffers():
+        from django_redis import get_redis_connection
+
+        redis_key = cache.make_key(key)
+        pipeline = get_redis_connection('default').pipeline()
+        pipeline.rpush(redis_key, json.dumps([timestamp.timestamp(), latitude, longitude]))
+        pipeline.expire(redis_key, LIVE_LOCATION_TTL)
+        pipeline.execute()
+        return
+
+    # Read-modify-write: concurrent pings can drop a point (local development)
+    history_buffer = cache.get(key) or []
+    history_buffer.append((timestamp, latitude, longitude))
+    cache.set(key, history_buffer, timeout=LIVE_LOCATION_TTL)
+
+
+def drain_history_buffers(bus_ids):
+    """
+    Take the buffered (timestamp, latitude, longitude) points of buses, in
+    ping order, in one round-trip. Points buffered meanwhile stay for the next drain.
+
+    Returns:
+        dict: {bus_id: [(timestamp, latitude, longitude), ...]} for buses with points.
+    """
+    keys = {history_buffer_key(bus_id): bus_id for bus_id in bus_ids}
+    if not keys:
+        return {}
+
+    if uses_redis_buffers():
+        from django_redis import get_redis_connection
+
+        pipeline = get_redis_connection('default').pipeline(transaction=True)
+        for key in keys:
+            redis_key = cache.make_key(key)
+            pipeline.lrange(redis_key, 0, -1)
+            pipeline.delete(redis_key)
+        results = pipeline.execute()
+        return {
+            bus_id: sorted(
+                (datetime.fromtimestamp(timestamp, tz=timezone.utc), latitude, longitude)
+                for timestamp, latitude, longitude in map(json.loads, entries))
+            for bus_id, entries in zip(keys.values(), results[::2]) if entries
+        }
+
+    history_buffers = cache.get_many(keys)
+    cache.delete_many(history_buffers)
+    return {keys[key]: sorted(history_buffer)
+            for key, history_buffer in history_buffers.items() if history_buffer}
+
+
+def drain_history_buffer(bus_id):
+    return drain_history_buffers([bus_id]).get(bus_id, [])
+
+
+def _needs_write_back(position, previous):
+    if previous is None or previous.get("persisted_at") is None:
+        due = True
+    else:
+        elapsed = (position["last_updated"] - previous["persisted_at"]).total_seconds()
+        moved = haversine_distance(
+            previous["persisted_latitude"], previous["persisted_longitude"],
+            position["latitude"], position["longitude"])
+        due = elapsed >= LIVE_LOCATION_WRITE_BACK_INTERVAL or (
+            moved >= LIVE_LOCATION_WRITE_BACK_DISTANCE
+            and elapsed >= LIVE_LOCATION_WRITE_BACK_MIN_INTERVAL)
+
+    # cache.add succeeds for one ping per minimum interval, racing pings don't all write
+    return due and cache.add(write_back_lock_key(position["bus_id"]), True,
+                             timeout=LIVE_LOCATION_WRITE_BACK_MIN_INTERVAL)
+
+
+def set_live_location(bus, latitude, longitude, updated_at=None):
+    """
+    Store the latest position of a bus in the cache. The database row is only
+    written back when the last write is older than the write-back interval, or
+    the bus has moved further than the write-back distance and the last write
+    is older than the minimum interval. The ping is buffered for the location
+    history, which flush_history_buffers records off the request path.
+
+    Returns:
+        dict: The stored position.
+    """
+    previous = cache.get(live_location_key(bus.id))
+    position = {
+        "bus_id": bus.id,
+        "bus_name": bus.bus_name,
+        "latitude": latitude,
+        "longitude": longitude,
+        "last_updated": updated_at or now(),
+        "persisted_at": previous.get("persisted_at") if previous else None,
+        "persisted_latitude": previous.get("persisted_latitude") if previous else None,
+        "persisted_longitude": previous.get("persisted_longitude") if previous else None,
+    }
+
+    # Pings are buffered and reach the location history with the next flush
+    buffer_history_point(bus.id, position["last_updated"], latitude, longitude)
+
+    if _needs_write_back(position, previous):
+        LiveLocation.objects.update_or_create(
+            bus=bus,
+            defaults={"latitude": latitude, "longitude": longitude}
+        )
+        position.update(persisted_at=position["last_updated"],
+                        persisted_latitude=latitude, persisted_longitude=longitude)
+
+    cache.set(live_location_key(bus.id), position, timeout=LIVE_LOCATION_TTL)
+    publish_live_location(bus.id, live_location_payload(position))
+    return position
+
+
+def flush_history_buffers():
+    """
+    Record the buffered pings of every bus in the location history. Run in a
+    loop by the flush_location_history command, more often than
+    LIVE_LOCATION_TTL so buffers don't expire.
+
+    Returns:
+        int: Number of buses whose pings were recorded.
+    """
+    buses = Buses.objects.in_bulk()
+    history_buffers = drain_history_buffers(buses)
+
+    for bus_id, points in history_buffers.items():
+        record_location_trace(buses[bus_id], points)
+    return len(history_buffers)
+
+
+def live_location_payload(position):
+    """
+    Public representation of a position, as returned by the API and the stream.
+    """
+    return {
+        "bus_id": position["bus_id"],
+        "bus_name": position["bus_name"],
+        "latitude": position["latitude"],
+        "longitude": position["longitude"],
+        "last_updated": position["last_updated"].strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+
+def get_cached_live_location(bus_id):
+    """
+    Position from the latest ping within LIVE_LOCATION_TTL, None otherwise.
+    """
+    return cache.get(live_location_key(bus_id))
+
+
+def _position_from_row(live_location):
+    return {
+        "bus_id": live_location.bus_id,
+        "bus_name": live_location.bus.bus_name,
+        "latitude": live_location.latitude,
+        "longitude": live_location.longitude,
+        "last_updated": live_location.last_updated,
+    }
+
+
+def get_live_location(bus_id):
+    """
+    Latest position of a bus: from the cache, or the last written database
+    row when the bus has not pinged recently. None when the bus has no location.
+    """
+    position = get_cached_live_location(bus_id)
+    if position is not None:
+        return position
+
+    live_location = LiveLocation.objects.select_related(
+        'bus').filter(bus_id=bus_id).first()
+    if live_location is None:
+        return None
+
+    return _position_from_row(live_location)
+
+
+_live_bus_index = {"built_at": None, "index": None}
+_live_bus_index_lock = threading.Lock()
+
+
+def get_live_bus_index():
+    """
+    Grid index of the buses that pinged within LIVE_LOCATION_TTL, items are
+    live_location_payload dicts. Rebuilt at most every LIVE_BUS_INDEX_TTL
+    seconds with one query and one cache round-trip, however many map
+    requests come in.
+    """
+    built_at = _live_bus_index["built_at"]
+    if built_at is not None and time.monotonic() - built_at < LIVE_BUS_INDEX_TTL:
+        return _live_bus_index["index"]
+
+    with _live_bus_index_lock:
+        built_at = _live_bus_index["built_at"]
+        if built_at is None or time.monotonic() - built_at >= LIVE_BUS_INDEX_TTL:
+            keys = [live_location_key(bus_id)
+                    for bus_id in Buses.objects.values_list('id', flat=True)]
+            positions = cache.get_many(keys).values()
+            _live_bus_index["index"] = GridIndex(
+                (position["latitude"], position["longitude"], live_location_payload(position))
+                for position in positions)
+            _live_bus_index["built_at"] = time.monotonic()
+
+    return _live_bus_index["index"]
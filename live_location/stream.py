@@ -0,0 +1,123 @@
+# live_location/stream.py
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LIVE_LOCATION_CHANNEL_PREFIX = "live_location:"
+# Updates waiting for a slow subscriber, older ones are dropped (only the latest position matters)
+SUBSCRIBER_QUEUE_SIZE = 8
+# Seconds before reconnecting a lost pub/sub subscription, doubled on every failure
+PUBSUB_RECONNECT_MIN_DELAY = 0.5
+PUBSUB_RECONNECT_MAX_DELAY = 30
+
+
+def uses_redis_pubsub():
+    """
+    Fan out through Redis pub/sub when the cache is Redis, so every worker
+    process receives the updates published by any other; otherwise in-process only.
+    """
+    return settings.CACHES['default']['BACKEND'].startswith('django_redis')
+
+
+class LiveLocationHub:
+    """
+    In-process fan-out of live position messages to the SSE streams of one
+    worker process. Messages are serialized once and shared by all subscribers.
+    Thread-safe: updates can be dispatched from sync views running in threads.
+    """
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)  # bus_id -> {(loop, queue), ...}
+        self._lock = threading.Lock()
+        self._listeners = {}  # event loop -> Redis listener task
+
+    def subscribe(self, bus_id):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers[bus_id].add((loop, queue))
+
+        if uses_redis_pubsub():
+            self._ensure_redis_listener(loop)
+        return queue
+
+    def unsubscribe(self, bus_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(bus_id, set())
+            subscribers.discard((asyncio.get_running_loop(), queue))
+            if not subscribers:
+                self._subscribers.pop(bus_id, None)
+
+    def dispatch(self, bus_id, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(bus_id, ()))
+
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_offer, queue, message)
+
+    def _ensure_redis_listener(self, loop):
+        # One Redis subscription per worker process, shared by all its streams
+        listener = self._listeners.get(loop)
+        if listener is None or listener.done():
+            self._listeners[loop] = loop.create_task(self._listen_redis())
+
+    async def _listen_redis(self):
+        import redis.asyncio as redis
+
+        url = getattr(settings, 'LIVE_LOCATION_PUBSUB_URL', None) or settings.CACHES['default']['LOCATION']
+        delay = PUBSUB_RECONNECT_MIN_DELAY
+        while True:
+            client = redis.from_url(url)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(f"{LIVE_LOCATION_CHANNEL_PREFIX}*")
+                delay = PUBSUB_RECONNECT_MIN_DELAY
+                async for message in pubsub.listen():
+                    if message['type'] != 'pmessage':
+                        continue
+                    bus_id = int(message['channel'].decode().rsplit(':', 1)[1])
+                    self.dispatch(bus_id, message['data'].decode())
+            except Exception:
+                # Streams stay open and get the updates again once reconnected
+                logger.exception("Live location pub/sub listener lost its connection, "
+                                 "reconnecting in %s s", delay)
+            finally:
+                await pubsub.aclose()
+                await client.aclose()
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, PUBSUB_RECONNECT_MAX_DELAY)
+
+
+def _offer(queue, message):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(message)
+
+
+hub = LiveLocationHub()
+
+
+def publish_live_location(bus_id, payload):
+    """
+    Push a position to every stream watching the bus, in all worker processes.
+    Never raises: a failed push must not fail the GPS ping that caused it.
+    """
+    message = json.dumps(payload)
+
+    if uses_redis_pubsub():
+        try:
+            from django_redis import get_redis_connection
+
+            get_redis_connection('default').publish(
+                f"{LIVE_LOCATION_CHANNEL_PREFIX}{bus_id}", message)
+            return
+        except Exception:
+            logger.exception("Could not publish the live location of bus %s", bus_id)
+
+    hub.dispatch(bus_id, message)
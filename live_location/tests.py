@@ -1,3 +1,380 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils.timezone import make_aware, now
+from rest_framework.test import APITestCase
+from booking.models import BusTrip
+from busstops.models import BoardingPoint, BusRoute, Buses, Section
+from .eta import get_route_geometry, get_live_stop_eta
+from .history import record_location_trace, get_trip_trace
+from rest_framework_simplejwt.tokens import AccessToken
+from members.models import User
+from .models import LiveLocation, LocationHistoryBucket
+from . import stream
+from .utils import parse_gps_points
+from .store import (
+    set_live_location, get_cached_live_location, buffer_history_point, drain_history_buffer,
+    flush_history_buffers, live_location_key, write_back_lock_key)
 
-# Create your tests here.
+
+# About 1 km north of the starting point
+ONE_KM = 0.009
+
+
+class LiveLocationStoreTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.bus = Buses.objects.create(
+            bus_name="Intercity", bus_number="WP-2", seat_count=40)
+
+    def setUp(self):
+        cache.clear()
+        self.start = now() - timedelta(hours=1)
+
+    def ping(self, seconds, latitude, longitude=80.0):
+        # The write-back lock only stands for real time, which tests don't wait for
+        cache.delete(write_back_lock_key(self.bus.id))
+        return set_live_location(
+            self.bus, latitude, longitude, self.start + timedelta(seconds=seconds))
+
+    def persisted_latitude(self):
+        return LiveLocation.objects.get(bus=self.bus).latitude
+
+    def test_first_ping_is_written_back(self):
+        self.ping(0, 7.0)
+        self.assertEqual(self.persisted_latitude(), 7.0)
+        self.assertEqual(get_cached_live_location(self.bus.id)["latitude"], 7.0)
+
+    def test_small_moves_are_written_back_on_the_interval(self):
+        self.ping(0, 7.0)
+        self.ping(30, 7.0001)
+        self.assertEqual(self.persisted_latitude(), 7.0)
+
+        self.ping(60, 7.0002)
+        self.assertEqual(self.persisted_latitude(), 7.0002)
+
+    def test_long_moves_wait_for_the_minimum_interval(self):
+        self.ping(0, 7.0)
+        self.ping(5, 7.0 + ONE_KM)
+        self.assertEqual(self.persisted_latitude(), 7.0)
+
+        self.ping(25, 7.0 + 2 * ONE_KM)
+        self.assertEqual(self.persisted_latitude(), 7.0 + 2 * ONE_KM)
+
+    def test_racing_pings_write_back_once(self):
+        self.ping(0, 7.0)
+        seen_by_both = get_cached_live_location(self.bus.id)
+        self.ping(61, 7.1)
+
+        # A concurrent ping read the position before the first one wrote back
+        cache.set(live_location_key(self.bus.id), seen_by_both)
+        set_live_location(self.bus, 7.2, 80.0, self.start + timedelta(seconds=62))
+        self.assertEqual(self.persisted_latitude(), 7.1)
+
+    def test_pings_are_only_buffered_on_the_request_path(self):
+        with mock.patch('live_location.store.record_location_trace') as record:
+            for seconds in range(0, 61, 15):
+                self.ping(seconds, 7.0 + seconds / 100000)
+        record.assert_not_called()
+        self.assertFalse(LocationHistoryBucket.objects.exists())
+
+        self.assertEqual(flush_history_buffers(), 1)
+        bucket_points = sum(LocationHistoryBucket.objects.filter(
+            bus=self.bus).values_list('point_count', flat=True))
+        self.assertEqual(bucket_points, 5)
+        self.assertEqual(drain_history_buffer(self.bus.id), [])
+
+    def test_drain_returns_points_in_time_order_once(self):
+        for seconds in (20, 0, 10):
+            buffer_history_point(self.bus.id, self.start + timedelta(seconds=seconds), 7.0, 80.0)
+
+        drained = drain_history_buffer(self.bus.id)
+        self.assertEqual([point[0] for point in drained],
+                         [self.start + timedelta(seconds=seconds) for seconds in (0, 10, 20)])
+        self.assertEqual(drain_history_buffer(self.bus.id), [])
+
+
+class LocationHistoryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.route = BusRoute.objects.create(name="Kandy - Nuwara Eliya")
+        Section.objects.create(
+            bus_route=cls.route, name="Section 1", position=1,
+            time=timedelta(hours=2), distance=80)
+        cls.bus = Buses.objects.create(
+            bus_name="Hill Express", bus_number="CP-1", seat_count=40)
+
+    def setUp(self):
+        cache.clear()
+
+    def trace(self, start, count, step=10):
+        return [(start + timedelta(seconds=index * step), 7.0 + index / 10000, 80.0)
+                for index in range(count)]
+
+    def test_points_are_attributed_to_the_running_trip(self):
+        bus_trip = BusTrip.objects.create(
+            bus=self.bus, route=self.route, start_time=now() - timedelta(hours=1))
+        start = bus_trip.start_time.replace(second=0, microsecond=0) + timedelta(minutes=30)
+        record_location_trace(self.bus, self.trace(start, 20))
+
+        self.assertEqual(len(get_trip_trace(bus_trip.id)), 20)
+        # 190 seconds of pings, one kept per minute
+        self.assertEqual(len(get_trip_trace(bus_trip.id, resolution=60)), 4)
+
+    def test_traces_without_a_trip_merge_into_one_bucket(self):
+        start = now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=3)
+        record_location_trace(self.bus, self.trace(start, 10))
+        record_location_trace(self.bus, self.trace(start + timedelta(seconds=100), 10))
+
+        buckets = LocationHistoryBucket.objects.filter(bus=self.bus, bus_trip=None)
+        self.assertEqual(buckets.count(), 1)
+        self.assertEqual(buckets.get().point_count, 20)
+
+    def test_existing_duplicate_buckets_do_not_fail_recording(self):
+        start = now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=3)
+        for _ in range(2):
+            LocationHistoryBucket.objects.create(bus=self.bus, bus_trip=None, bucket_start=start)
+
+        record_location_trace(self.bus, self.trace(start, 5))
+        self.assertEqual(sum(LocationHistoryBucket.objects.filter(
+            bus=self.bus).values_list('point_count', flat=True)), 5)
+
+    def test_buffered_pings_are_flushed_by_the_command(self):
+        other_bus = Buses.objects.create(
+            bus_name="Udarata", bus_number="CP-2", seat_count=40)
+        start = now() - timedelta(minutes=10)
+        set_live_location(self.bus, 7.0, 80.0, start)
+        cache.delete(write_back_lock_key(self.bus.id))
+        for seconds in (10, 20, 30):
+            set_live_location(self.bus, 7.001, 80.0, start + timedelta(seconds=seconds))
+        set_live_location(other_bus, 6.9, 79.9)
+
+        stdout = StringIO()
+        call_command('flush_location_history', stdout=stdout)
+        self.assertIn("Flushed the location history of 2 buses.", stdout.getvalue())
+        self.assertEqual(sum(LocationHistoryBucket.objects.filter(
+            bus=self.bus).values_list('point_count', flat=True)), 4)
+        self.assertEqual(LocationHistoryBucket.objects.filter(bus=other_bus).count(), 1)
+        self.assertEqual(drain_history_buffer(self.bus.id), [])
+
+        # Nothing buffered since
+        call_command('flush_location_history', stdout=stdout)
+        self.assertIn("Flushed the location history of 0 buses.", stdout.getvalue())
+
+
+class BulkTraceUploadTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.passenger = User.objects.create(phone_number="0770000500")
+        cls.conductor = User.objects.create(phone_number="0770000501")
+        User.objects.filter(id=cls.conductor.id).update(role=User.Role.BUS_CONDUCTOR)
+        cls.conductor.refresh_from_db()
+        cls.bus = Buses.objects.create(
+            bus_name="Night Mail", bus_number="WP-3", seat_count=40, owner=cls.conductor)
+
+    def setUp(self):
+        cache.clear()
+        self.start = (now() - timedelta(hours=2)).replace(microsecond=0)
+
+    def point(self, seconds, latitude=7.0, longitude=80.0):
+        return {"latitude": latitude, "longitude": longitude,
+                "timestamp": (self.start + timedelta(seconds=seconds)).isoformat()}
+
+    def upload(self, points, user=None):
+        self.client.force_authenticate(user or self.conductor)
+        return self.client.post(reverse('update_live_location_bulk'), {"points": points},
+                                format='json', HTTP_HOST='passenger.lk')
+
+    def test_points_are_validated_deduplicated_and_ordered(self):
+        epoch = self.start.timestamp()
+        naive = (self.start + timedelta(seconds=50)).replace(tzinfo=None)
+        trace = parse_gps_points([
+            self.point(20, 7.2), {**self.point(10), "timestamp": epoch + 10},
+            self.point(10, 7.1), self.point(0),
+            self.point(30, latitude=91), {**self.point(40), "timestamp": True},
+            {"latitude": 7.0, "timestamp": epoch}, "not a point",
+            {**self.point(0), "timestamp": (now() + timedelta(hours=1)).isoformat()},
+            {**self.point(50), "timestamp": naive.isoformat()}])
+
+        # Same timestamp: the last point sent wins; naive timestamps are local time
+        self.assertEqual(trace, sorted([
+            (self.start, 7.0, 80.0),
+            (self.start + timedelta(seconds=10), 7.1, 80.0),
+            (self.start + timedelta(seconds=20), 7.2, 80.0),
+            (make_aware(naive), 7.0, 80.0)]))
+
+    def test_upload_moves_the_bus_and_keeps_the_trace(self):
+        points = [self.point(seconds, 7.0 + seconds / 10000) for seconds in range(0, 100, 10)]
+        response = self.upload(points + [self.point(0, latitude=-91)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["accepted_points"], response.data["rejected_points"]), (10, 1))
+        self.assertTrue(response.data["latest_point_applied"])
+
+        position = get_cached_live_location(self.bus.id)
+        self.assertEqual((position["latitude"], position["last_updated"]),
+                         (7.009, self.start + timedelta(seconds=90)))
+        self.assertEqual(sum(LocationHistoryBucket.objects.filter(
+            bus=self.bus).values_list('point_count', flat=True)), 10)
+
+    def test_older_traces_do_not_move_the_bus(self):
+        set_live_location(self.bus, 6.0, 79.0, self.start + timedelta(minutes=5))
+        response = self.upload([self.point(0), self.point(10)])
+        self.assertFalse(response.data["latest_point_applied"])
+        self.assertEqual(get_cached_live_location(self.bus.id)["latitude"], 6.0)
+
+    def test_upload_limits(self):
+        self.assertEqual(self.upload([]).status_code, 400)
+        self.assertEqual(self.upload([self.point(0, latitude=100)]).status_code, 400)
+        self.assertEqual(self.upload([self.point(0)] * 5001).status_code, 400)
+        self.assertEqual(self.upload([self.point(0)], user=self.passenger).status_code, 403)
+
+
+class FakePubSub:
+
+    def __init__(self, messages=None):
+        # No messages: the connection is down
+        self.messages = messages
+
+    async def psubscribe(self, pattern):
+        if self.messages is None:
+            raise ConnectionError("Connection refused")
+
+    async def listen(self):
+        for message in self.messages:
+            yield message
+        await asyncio.Event().wait()
+
+    async def aclose(self):
+        pass
+
+
+class FakeRedisClient:
+
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def pubsub(self):
+        return self._pubsub
+
+    async def aclose(self):
+        pass
+
+
+class LiveLocationStreamTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(phone_number="0770000200")
+        cls.bus = Buses.objects.create(
+            bus_name="Night Mail", bus_number="NC-1", seat_count=40)
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('stream_bus_location', args=[self.bus.id])
+        self.token = str(AccessToken.for_user(self.user))
+
+    def test_stream_is_refused_under_wsgi(self):
+        response = self.client.get(self.url, {"token": self.token})
+        self.assertEqual(response.status_code, 501)
+
+    async def test_stream_sends_the_position_then_updates(self):
+        position = await sync_to_async(set_live_location)(self.bus, 7.0, 80.0)
+        response = await self.async_client.get(self.url, {"token": self.token})
+        self.assertEqual(response.status_code, 200)
+
+        events = aiter(response.streaming_content)
+        first = await anext(events)
+        self.assertIn(b'"latitude": 7.0', first)
+
+        stream.publish_live_location(self.bus.id, {**json.loads(
+            first.decode().split("data: ", 1)[1]), "latitude": 7.5})
+        second = await asyncio.wait_for(anext(events), 5)
+        self.assertIn(b'"latitude": 7.5', second)
+        await events.aclose()
+        self.assertEqual(position["bus_id"], self.bus.id)
+
+    async def test_stream_requires_a_token(self):
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(LIVE_LOCATION_PUBSUB_URL='redis://localhost:6379/0')
+    async def test_pubsub_listener_reconnects_after_a_failure(self):
+        hub = stream.LiveLocationHub()
+        queue = hub.subscribe(self.bus.id)
+        message = {"type": "pmessage", "channel": f"live_location:{self.bus.id}".encode(),
+                   "data": b'{"latitude": 7.0}'}
+        clients = [FakeRedisClient(FakePubSub()), FakeRedisClient(FakePubSub([message]))]
+
+        with mock.patch('redis.asyncio.from_url', side_effect=clients), \
+                mock.patch.object(stream, 'PUBSUB_RECONNECT_MIN_DELAY', 0.01), \
+                self.assertLogs('live_location.stream', 'ERROR'):
+            listener = asyncio.create_task(hub._listen_redis())
+            try:
+                self.assertEqual(await asyncio.wait_for(queue.get(), 5), '{"latitude": 7.0}')
+            finally:
+                listener.cancel()
+
+
+class RouteEtaTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # Created out of route order: lowest IDs don't tell where the route starts
+        cls.middle = BoardingPoint.objects.create(name="Middle", latitude=7.01, longitude=80.0)
+        cls.first = BoardingPoint.objects.create(name="First", latitude=7.0, longitude=80.0)
+        cls.last = BoardingPoint.objects.create(name="Last", latitude=7.03, longitude=80.0)
+        cls.route = BusRoute.objects.create(name="Ratnapura - Balangoda")
+        for position, boarding_points in enumerate(((cls.middle, cls.first), (cls.last,)), 1):
+            section = Section.objects.create(
+                bus_route=cls.route, name=f"Section {position}", position=position,
+                time=timedelta(minutes=30), distance=2)
+            section.section_boarding_points.set(boarding_points)
+        cls.bus = Buses.objects.create(
+            bus_name="Sabaragamuwa", bus_number="SG-1", seat_count=40)
+
+    def setUp(self):
+        cache.clear()
+        self.bus_trip = BusTrip.objects.create(
+            bus=self.bus, route=self.route, start_time=now() - timedelta(minutes=10))
+
+    def stop_ids(self, route):
+        return [stop[0] for stop in get_route_geometry(route.id)]
+
+    def test_route_starts_furthest_from_the_next_section(self):
+        self.assertEqual(self.stop_ids(self.route), [self.first.id, self.middle.id, self.last.id])
+
+    def test_single_section_route_starts_at_an_end(self):
+        route = BusRoute.objects.create(name="Loop")
+        section = Section.objects.create(
+            bus_route=route, name="Section 1", position=1, time=timedelta(minutes=30), distance=2)
+        section.section_boarding_points.set([self.middle, self.first, self.last])
+
+        self.assertEqual(self.stop_ids(route)[1], self.middle.id)
+
+    def test_live_eta_from_the_bus_position(self):
+        # Halfway between the middle and last stops, 5 minutes ahead of schedule
+        set_live_location(self.bus, 7.02, 80.0)
+
+        self.assertEqual(get_live_stop_eta(self.bus_trip, self.middle.id, None),
+                         {"eta": None, "source": "live", "delay_minutes": -5})
+        eta = get_live_stop_eta(self.bus_trip, self.last.id, None)
+        self.assertAlmostEqual((eta["eta"] - now()).total_seconds(), 15 * 60, delta=5)
+
+    def test_schedule_is_used_without_a_recent_position(self):
+        scheduled_time = self.bus_trip.start_time + timedelta(minutes=30)
+        self.assertEqual(get_live_stop_eta(self.bus_trip, self.last.id, scheduled_time),
+                         {"eta": scheduled_time, "source": "schedule", "delay_minutes": None})
+
+    def test_bus_far_off_the_route_falls_back_to_the_schedule(self):
+        set_live_location(self.bus, 8.0, 81.0)
+        self.assertEqual(get_live_stop_eta(self.bus_trip, self.last.id, None)["source"], "schedule")
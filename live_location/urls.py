@@ -1,7 +1,13 @@
 from django.urls import path
-from .views import update_live_location, get_live_location
+from .views import update_live_location, update_live_location_bulk, get_live_location, stream_bus_location, stream_trip_location
+from .views import get_trip_location_history, get_live_buses_in_bbox
 
 urlpatterns = [
     path('update/', update_live_location, name='update_live_location'),
+    path('update/bulk/', update_live_location_bulk, name='update_live_location_bulk'),
     path('get/<int:bus_id>/', get_live_location, name='get_live_location'),
+    path('buses/', get_live_buses_in_bbox, name='get_live_buses_in_bbox'),
+    path('stream/bus/<int:bus_id>/', stream_bus_location, name='stream_bus_location'),
+    path('stream/trip/<int:trip_id>/', stream_trip_location, name='stream_trip_location'),
+    path('history/trip/<int:trip_id>/', get_trip_location_history, name='get_trip_location_history'),
 ]
@@ -0,0 +1,58 @@
+# live_location/utils.py
+from datetime import datetime, timedelta, timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware, now
+
+# Points stamped further ahead than this are treated as device clock errors
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+
+
+def parse_gps_timestamp(value):
+    """
+    Aware datetime of an ISO 8601 string or seconds since the epoch, None if invalid.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            return datetime.fromtimestamp(value, tz=timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            return None
+
+    try:
+        timestamp = parse_datetime(str(value))
+    except ValueError:
+        return None
+    if timestamp is not None and is_naive(timestamp):
+        timestamp = make_aware(timestamp)
+    return timestamp
+
+
+def parse_gps_points(points):
+    """
+    Validate, de-duplicate and order uploaded GPS points.
+    Points with the same timestamp keep the last one sent; invalid points,
+    out of range coordinates and points from the future are dropped.
+
+    Returns:
+        list: [(timestamp, latitude, longitude), ...] ordered by timestamp.
+    """
+    latest_allowed = now() + MAX_CLOCK_SKEW
+    by_timestamp = {}
+
+    for point in points:
+        if not isinstance(point, dict):
+            continue
+        try:
+            latitude = float(point["latitude"])
+            longitude = float(point["longitude"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            continue
+
+        timestamp = parse_gps_timestamp(point.get("timestamp"))
+        if timestamp is None or timestamp > latest_allowed:
+            continue
+
+        by_timestamp[timestamp] = (timestamp, latitude, longitude)
+
+    return [by_timestamp[timestamp] for timestamp in sorted(by_timestamp)]
@@ -1,9 +1,32 @@
+import asyncio
+import json
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
-from .models import LiveLocation
-from busstops.models import Buses
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+from booking.models import BusTrip, Booking, CANCELED_BOOKING_STATUSES
+from busstops.spatial import parse_bbox
+from .history import get_trip_trace, encode_polyline
+from .signals import location_trace_received
+from .store import set_live_location, get_cached_live_location, get_live_location as get_bus_live_location
+from .store import live_location_payload, get_live_bus_index
+from .stream import hub
+from .utils import parse_gps_points
+
+# Largest GPS trace accepted in one upload
+MAX_BULK_POINTS = 5000
+# Seconds between keep-alive comments, and before a stream is closed
+LIVE_LOCATION_STREAM_HEARTBEAT = 15
+LIVE_LOCATION_STREAM_MAX_AGE = 30 * 60
+# Coarsest resolution of a trip trace (in seconds)
+MAX_HISTORY_RESOLUTION = 3600
+# Largest number of buses returned for a map area
+MAX_BBOX_BUSES = 500
 
 
 @api_view(['POST'])
@@ -29,11 +52,13 @@ def update_live_location(request):
     if latitude is None or longitude is None:
         return Response({"error": "Latitude and Longitude are required."}, status=status.HTTP_400_BAD_REQUEST)
 
-    # ✅ Update or create the bus location
-    LiveLocation.objects.update_or_create(
-        bus=bus,
-        defaults={"latitude": latitude, "longitude": longitude}
-    )
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return Response({"error": "Latitude and Longitude must be numbers."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # ✅ Update the bus location in the live store (written back to the DB periodically)
+    set_live_location(bus, latitude, longitude)
 
     return Response({"message": "Live location updated successfully!"}, status=status.HTTP_200_OK)
 
@@ -44,15 +69,207 @@ def get_live_location(request, bus_id):
     """
     API for users to get the live location of a specific bus.
     """
-    try:
-        live_location = LiveLocation.objects.get(bus_id=bus_id)
-        return Response({
-            "bus_id": live_location.bus.id,
-            "bus_name": live_location.bus.bus_name,
-            "latitude": live_location.latitude,
-            "longitude": live_location.longitude,
-            "last_updated": live_location.last_updated.strftime("%Y-%m-%d %H:%M:%S")
-        }, status=status.HTTP_200_OK)
-
-    except LiveLocation.DoesNotExist:
+    live_location = get_bus_live_location(bus_id)
+
+    if live_location is None:
         return Response({"error": "No live location available for this bus."}, status=status.HTTP_404_NOT_FOUND)
+
+    return Response(live_location_payload(live_location), status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def update_live_location_bulk(request):
+    """
+    API for conductor devices to upload the GPS points they buffered offline:
+    {"points": [{"latitude": .., "longitude": .., "timestamp": ..}, ...]}
+    Timestamps are ISO 8601 or seconds since the epoch. Points are de-duplicated
+    and ordered, only the latest one updates the live location and the whole
+    trace is handed to history storage.
+    """
+    user = request.user
+
+    # Ensure the user is a bus conductor
+    if user.role != user.Role.BUS_CONDUCTOR:
+        return Response({"error": "Only bus conductors can update live locations."}, status=status.HTTP_403_FORBIDDEN)
+
+    # Ensure the conductor has an assigned bus
+    bus = getattr(user, 'bus', None)
+    if not bus:
+        return Response({"error": "No bus assigned to this conductor."}, status=status.HTTP_400_BAD_REQUEST)
+
+    points = request.data.get("points")
+    if not isinstance(points, list) or not points:
+        return Response({"error": "A list of points is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    if len(points) > MAX_BULK_POINTS:
+        return Response({"error": f"At most {MAX_BULK_POINTS} points can be uploaded at once."}, status=status.HTTP_400_BAD_REQUEST)
+
+    trace = parse_gps_points(points)
+    if not trace:
+        return Response({"error": "No valid points."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # ✅ Only the latest point moves the bus, unless a newer ping already arrived
+    # (the database row is not compared: buses start with a placeholder row)
+    latest_at, latitude, longitude = trace[-1]
+    current = get_cached_live_location(bus.id)
+    applied = current is None or current["last_updated"] < latest_at
+    if applied:
+        set_live_location(bus, latitude, longitude, updated_at=latest_at)
+
+    location_trace_received.send(sender=bus.__class__, bus=bus, points=trace)
+
+    return Response({
+        "message": "Live location trace received.",
+        "accepted_points": len(trace),
+        "rejected_points": len(points) - len(trace),
+        "latest_point_applied": applied
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_live_buses_in_bbox(request):
+    """
+    API to get the live positions of the buses in a map area: ?bbox=south,west,north,east
+    """
+    bbox = parse_bbox(request.GET.get('bbox'))
+    if bbox is None:
+        return Response({"error": "bbox must be south,west,north,east in degrees."}, status=status.HTTP_400_BAD_REQUEST)
+
+    buses = get_live_bus_index().within_bbox(*bbox, limit=MAX_BBOX_BUSES + 1)
+
+    return Response({
+        "buses": buses[:MAX_BBOX_BUSES],
+        "truncated": len(buses) > MAX_BBOX_BUSES
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_trip_location_history(request, trip_id):
+    """
+    API to get the recorded trace of a bus trip as an encoded polyline.
+    ?resolution=<seconds> keeps one point per that many seconds,
+    ?include_points=true also returns the timestamped points.
+    Open to the bus owner and the passengers of the trip.
+    """
+    user = request.user
+
+    bus_trip = BusTrip.objects.select_related('bus').filter(id=trip_id).first()
+    if not bus_trip:
+        return Response({"error": "Bus trip not found."}, status=status.HTTP_404_NOT_FOUND)
+
+    is_bus_owner = bus_trip.bus.owner_id == user.id
+    is_passenger = Booking.objects.filter(bus_trip=bus_trip, user=user).exclude(
+        booking_status__in=CANCELED_BOOKING_STATUSES).exists()
+    if not (is_bus_owner or is_passenger or user.is_staff):
+        return Response({"error": "You do not have permission to view this trip's history."}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        resolution = int(request.GET.get("resolution", 0))
+    except ValueError:
+        return Response({"error": "Resolution must be a number of seconds."}, status=status.HTTP_400_BAD_REQUEST)
+    if not 0 <= resolution <= MAX_HISTORY_RESOLUTION:
+        return Response({"error": f"Resolution must be between 0 and {MAX_HISTORY_RESOLUTION} seconds."}, status=status.HTTP_400_BAD_REQUEST)
+
+    trace = get_trip_trace(bus_trip.id, resolution)
+
+    response_data = {
+        "trip_id": bus_trip.id,
+        "bus_id": bus_trip.bus_id,
+        "resolution": resolution,
+        "point_count": len(trace),
+        "started_at": trace[0][0].strftime("%Y-%m-%d %H:%M:%S") if trace else None,
+        "ended_at": trace[-1][0].strftime("%Y-%m-%d %H:%M:%S") if trace else None,
+        "polyline": encode_polyline((latitude, longitude) for _, latitude, longitude in trace),
+    }
+    if request.GET.get("include_points") == "true":
+        response_data["points"] = [
+            {"timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+             "latitude": latitude, "longitude": longitude}
+            for timestamp, latitude, longitude in trace
+        ]
+
+    return Response(response_data, status=status.HTTP_200_OK)
+
+
+async def stream_bus_location(request, bus_id):
+    """
+    Server-sent events stream of a bus's live position: the current position
+    first, then every update as a "location" event, with keep-alive comments
+    in between. EventSource cannot send headers, so the JWT access token can
+    be passed as ?token=. Needs the ASGI application (see passenger/asgi.py).
+    """
+    if not isinstance(request, ASGIRequest):
+        return stream_requires_asgi_response()
+    if not is_valid_access_token(request):
+        return JsonResponse({"error": "Authentication credentials were not provided or are invalid."}, status=401)
+
+    return live_location_event_stream(bus_id)
+
+
+async def stream_trip_location(request, trip_id):
+    """
+    Server-sent events stream of the live position of the bus running a trip.
+    """
+    if not isinstance(request, ASGIRequest):
+        return stream_requires_asgi_response()
+    if not is_valid_access_token(request):
+        return JsonResponse({"error": "Authentication credentials were not provided or are invalid."}, status=401)
+
+    bus_id = await BusTrip.objects.filter(id=trip_id).values_list('bus_id', flat=True).afirst()
+    if bus_id is None:
+        return JsonResponse({"error": "Bus trip not found."}, status=404)
+
+    return live_location_event_stream(bus_id)
+
+
+def stream_requires_asgi_response():
+    # WSGI servers buffer the whole async stream before sending anything,
+    # clients poll get_live_location instead
+    return JsonResponse({"error": "Live streams are only served by the ASGI application."}, status=501)
+
+
+def is_valid_access_token(request):
+    """
+    Check the JWT access token from the Authorization header or ?token=.
+    Only the signature and expiry are checked, so no database query is made.
+    """
+    header = request.headers.get('Authorization', '')
+    token = header[len('Bearer '):] if header.startswith('Bearer ') else request.GET.get('token')
+    if not token:
+        return False
+
+    try:
+        AccessToken(token)
+    except TokenError:
+        return False
+    return True
+
+
+def live_location_event_stream(bus_id):
+    async def events():
+        loop = asyncio.get_running_loop()
+        queue = hub.subscribe(bus_id)
+        try:
+            position = await sync_to_async(get_bus_live_location)(bus_id)
+            if position is not None:
+                yield f"event: location\ndata: {json.dumps(live_location_payload(position))}\n\n"
+
+            # Streams are recycled so clients reconnect (and re-authenticate) periodically
+            closes_at = loop.time() + LIVE_LOCATION_STREAM_MAX_AGE
+            while loop.time() < closes_at:
+                try:
+                    message = await asyncio.wait_for(queue.get(), LIVE_LOCATION_STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: location\ndata: {message}\n\n"
+        finally:
+            hub.unsubscribe(bus_id, queue)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Don't let nginx buffer the stream
+    return response
@@ -5,6 +5,12 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
+
+The live bus position streams (live_location/stream/...) are async
+server-sent events views and need to be served through this application
+(e.g. ``uvicorn passenger.asgi:application``); under WSGI a stream would tie up
+a worker thread per watcher. Each worker process keeps one Redis pub/sub
+subscription and fans position updates out to all of its streams.
 """
 
 import os
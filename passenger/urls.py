@@ -30,6 +30,10 @@ urlpatterns = [
          name='get_suggestions'),
     path('api/booking_details/',
          views.fetch_booking_details, name='booking_details'),
+    path('api/boarding_points/nearest/', views.get_nearest_boarding_points,
+         name='nearest_boarding_points'),
+    path('api/boarding_points/bbox/', views.get_boarding_points_in_bbox,
+         name='boarding_points_in_bbox'),
     path('api/members/', include('members.urls')),
     path('api/booking/', include('booking.urls')),
     path('api/conductor/', include('conductor.urls')),